@@ -0,0 +1,23 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+
+# --- DIRECTORIO DE DATOS LOCALES (cachés persistentes en disco) ---
+DIR_DATOS = os.environ.get("GESTOR_DIR_DATOS", ".datos")
+
+def ruta_datos(nombre):
+    os.makedirs(DIR_DATOS, exist_ok=True)
+    return os.path.join(DIR_DATOS, nombre)
+
+@contextmanager
+def conectar(nombre):
+    """Conexión SQLite nueva por uso (Streamlit atiende cada sesión en su propio hilo), para `with`.
+
+    Al salir confirma (o deshace si hubo excepción) y cierra: el `with` de sqlite3 por sí solo
+    no cierra la conexión y cada llamada dejaría abiertos sus descriptores.
+    """
+    con = sqlite3.connect(ruta_datos(nombre), timeout=30)
+    try:
+        con.execute("PRAGMA journal_mode=WAL")
+        with con: yield con
+    finally: con.close()
@@ -1,26 +1,35 @@
 import streamlit as st
 import pandas as pd
 import yfinance as yf
-import requests
 import altair as alt
-import numpy as np 
 from pyairtable import Api
-from datetime import datetime, timedelta
+from datetime import datetime
 from zoneinfo import ZoneInfo
-from fpdf import FPDF
 import time
 import io
-
-# --- INTENTO DE IMPORTAR TRADUCTOR ---
-try:
-    from deep_translator import GoogleTranslator
-    HAS_TRANSLATOR = True
-except ImportError:
-    HAS_TRANSLATOR = False
+from snapshots_fifo import AlmacenSnapshots, calcular_estado_incremental, tamaño_resultado, tamaño_vista
+from motor_fifo import GRANULARIDADES_ROI, serie_roi, vista_año
+from cotizaciones import CacheCotizaciones
+from metadatos import AlmacenMetadatos, url_logo
+from divisas import AlmacenDivisas
+from escritura_airtable import LimitadorTokens
+from importacion import PERFILES, IndiceOperaciones, detectar_perfil, importar_csv, leer_csv, preparar_registros, vista_previa
+from trabajos import ESTADOS_ACTIVOS, GestorTrabajos
+from sincronizacion_airtable import EspejoAirtable, VISTA_TODOS, formula_vista, vista_usuario
+from libro_columnar import LibroColumnar
+from usuarios import DirectorioUsuarios
+from cache_regiones import CacheRegiones
+from formato import fmt_dinamico, fmt_num_es
+from informes_pdf import CacheInformes, generar_informe_fiscal
+import exportaciones
+from historico_precios import AlmacenHistorico
+from indicadores import MEDIAS, MotorIndicadores
+from valoracion import CurvasValor, curva_valor
 
 # --- CONFIGURACIÓN ---
 st.set_page_config(page_title="Gestor V32.46 (Tax Perfect - Manual)", layout="wide") 
 MONEDA_BASE = "EUR" 
+TARJETAS_POR_PAGINA = 10  # Vista móvil: tarjetas por página de la cartera
 
 # --- ESTADO ---
 if "pending_data" not in st.session_state: st.session_state.pending_data = None
@@ -32,6 +41,9 @@ if "user_role" not in st.session_state: st.session_state.user_role = "user"
 
 if "cfg_zona" not in st.session_state: st.session_state.cfg_zona = "Europe/Madrid"
 if "cfg_movil" not in st.session_state: st.session_state.cfg_movil = False
+if "trabajo_importacion" not in st.session_state: st.session_state.trabajo_importacion = None
+if "trabajo_pdf" not in st.session_state: st.session_state.trabajo_pdf = None
+if "csv_validado" not in st.session_state: st.session_state.csv_validado = None
 
 # --- CONEXIÓN AIRTABLE ---
 try:
@@ -43,19 +55,13 @@ except Exception as e:
     st.stop()
 
 # --- FUNCIONES DE AUTENTICACIÓN ---
-def get_all_users():
-    try:
-        records = table_users.all()
-        return {r['fields']['Username']: r['fields'] for r in records if 'Username' in r['fields']}
-    except: return {}
+# Índice de usuarios compartido por todas las sesiones: un login no relee la tabla de Airtable
+@st.cache_resource(show_spinner=False)
+def get_directorio_usuarios():
+    return DirectorioUsuarios(table_users)
 
 def register_new_user(username, password, name):
-    try:
-        existing = get_all_users()
-        if username in existing: return False, "El usuario ya existe."
-        table_users.create({"Username": username, "Password": password, "Nombre": name, "Rol": "user"})
-        return True, "Usuario creado correctamente."
-    except Exception as e: return False, f"Error creando usuario: {e}"
+    return get_directorio_usuarios().registrar(username, password, name)
 
 def login_system():
     if st.session_state.current_user: return True
@@ -72,10 +78,11 @@ def login_system():
             user_in = st.text_input("Usuario")
             pass_in = st.text_input("Contraseña", type="password")
             if st.form_submit_button("Entrar", type="primary"):
-                users_db = get_all_users()
-                if user_in in users_db and users_db[user_in].get('Password') == pass_in:
+                try: usuario = get_directorio_usuarios().autenticar(user_in, pass_in)
+                except: usuario = None
+                if usuario:
                     st.session_state.current_user = user_in
-                    st.session_state.user_role = users_db[user_in].get('Rol', 'user')
+                    st.session_state.user_role = usuario.get('Rol', 'user')
                     st.rerun()
                 else: st.error("Incorrecto")
     with tab2:
@@ -97,43 +104,24 @@ def login_system():
                 else: st.error("Código inválido")
     return False
 
-# --- FUNCIONES DATOS Y FORMATO ---
-def traducir_texto(texto):
-    if not texto or texto == "Sin descripción.": return texto
-    if not HAS_TRANSLATOR: return texto
-    try: return GoogleTranslator(source='auto', target='es').translate(texto[:4999])
-    except: return texto
-
-def fmt_dinamico(valor, sufijo="", decimales=3):
-    if valor is None: return ""
-    s = f"{valor:,.{decimales}f}" 
-    s = s.replace(",", "X").replace(".", ",").replace("X", ".")
-    if "," in s: s = s.rstrip('0').rstrip(',')
-    if s == "": s = "0"
-    return f"{s} {sufijo}"
-
-def fmt_num_es(valor):
-    if valor is None: return "0,00"
-    return f"{valor:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-
 # --- FUNCION CRITICA: DIVISA HISTORICA ---
+# Series de cambio persistidas en disco: un par se descarga una vez y se consulta en memoria
+@st.cache_resource(show_spinner=False)
+def get_almacen_divisas():
+    return AlmacenDivisas()
+
 def get_historical_eur_rate(date_obj, from_currency):
     if from_currency == "EUR": return 1.0
-    ticker = f"{MONEDA_BASE}=X" if from_currency == "USD" else f"{from_currency}{MONEDA_BASE}=X"
-    start_date = date_obj - timedelta(days=3)
-    end_date = date_obj + timedelta(days=1)
-    try:
-        data = yf.download(ticker, start=start_date, end=end_date, progress=False)
-        if not data.empty:
-            rate = data['Close'].iloc[-1]
-            if isinstance(rate, (pd.Series, pd.DataFrame)): rate = float(rate.iloc[0])
-            return float(rate)
-    except: pass
-    return 1.0
+    try: return get_almacen_divisas().cambio(date_obj, from_currency)
+    except: return 1.0
 
-@st.cache_data(ttl=300, show_spinner=False) 
-def get_exchange_rate_now(from_curr, to_curr="EUR"):
-    if from_curr == to_curr: return 1.0
+# Cachés por región y clave: una escritura invalida el libro de su usuario, no el de todos
+@st.cache_resource(show_spinner=False)
+def get_cache_regiones():
+    # "motor": estado FIFO por (vista, versión del libro), acotado a ~256 MB
+    return CacheRegiones({"libro": 600, "cambio_actual": 300, "motor": 3600}, max_bytes={"motor": 256 * 1024 * 1024})
+
+def descargar_cambio_actual(from_curr, to_curr):
     try:
         pair = f"{to_curr}=X" if from_curr == "USD" else f"{from_curr}{to_curr}=X"
         hist = yf.Ticker(pair).history(period="1d")
@@ -142,210 +130,121 @@ def get_exchange_rate_now(from_curr, to_curr="EUR"):
     except: pass
     return 1.0 
 
-@st.cache_data(show_spinner=False)
-def get_ticker_isin(ticker):
-    try:
-        t = yf.Ticker(ticker)
-        isin = t.isin
-        if isin and isin != '-' and len(isin) > 5: return isin
-    except: pass
-    try:
-        api_key = st.secrets["fmp"]["api_key"]
-        url = f"https://financialmodelingprep.com/api/v3/profile/{ticker}?apikey={api_key}"
-        resp = requests.get(url, timeout=3)
-        if resp.status_code == 200:
-            data = resp.json()
-            if data and len(data) > 0:
-                isin = data[0].get('isin')
-                if isin and len(isin) > 5: return isin
-    except: pass
-    return ""
+def get_exchange_rate_now(from_curr, to_curr="EUR"):
+    if from_curr == to_curr: return 1.0
+    return get_cache_regiones().obtener("cambio_actual", (from_curr, to_curr), lambda: descargar_cambio_actual(from_curr, to_curr))
 
-def get_logo_url(ticker):
-    return f"https://financialmodelingprep.com/image-stock/{ticker}.png"
+# Metadatos persistentes (nombre, ISIN, logo, descripción traducida): separados del precio
+@st.cache_resource(show_spinner=False)
+def get_almacen_metadatos():
+    try: fmp_key = st.secrets["fmp"]["api_key"]
+    except: fmp_key = None
+    return AlmacenMetadatos(api_key=fmp_key)
 
-def get_stock_data_fmp(ticker):
-    try:
-        api_key = st.secrets["fmp"]["api_key"]
-        url = f"https://financialmodelingprep.com/api/v3/profile/{ticker}?apikey={api_key}"
-        response = requests.get(url, timeout=3)
-        if response.status_code == 200:
-            data = response.json()
-            if data and len(data) > 0:
-                return data[0].get('companyName'), data[0].get('price'), traducir_texto(data[0].get('description'))
-    except: pass
-    return None, None, None
+def get_ticker_isin(ticker):
+    return get_almacen_metadatos().isin(ticker)
 
-def get_stock_data_yahoo(ticker):
-    try:
-        stock = yf.Ticker(ticker)
-        precio = None
-        try: precio = stock.fast_info.last_price
-        except: pass
-        if precio is None:
-            try:
-                hist = stock.history(period="1d")
-                if not hist.empty: precio = hist['Close'].iloc[-1]
-            except: pass
-        try:
-            info = stock.info
-            nombre = info.get('longName') or info.get('shortName') or ticker
-            desc = traducir_texto(info.get('longBusinessSummary') or "Sin descripción.")
-        except:
-            nombre = ticker
-            desc = "Sin descripción."
-        if precio: return nombre, precio, desc
-    except: pass
-    return None, None, None
+def get_logo_url(ticker):
+    return url_logo(ticker)
+
+# Histórico OHLCV por ticker en disco: se descarga entero una vez y luego sólo se añaden sesiones
+@st.cache_resource(show_spinner=False)
+def get_almacen_historico():
+    return AlmacenHistorico()
+
+# Curvas de valor por versión del libro: cada día sólo se valoran las sesiones nuevas
+@st.cache_resource(show_spinner=False)
+def get_curvas_valor():
+    return CurvasValor()
+
+# Medias, tendencia y soportes por (ticker, versión de su serie): cambiar de indicador o periodo no recalcula
+@st.cache_resource(show_spinner=False)
+def get_motor_indicadores():
+    return MotorIndicadores(get_almacen_historico())
+
+# Caché de precios de proceso: compartida entre sesiones, ajena a las invalidaciones del libro
+@st.cache_resource(show_spinner=False)
+def get_cache_cotizaciones():
+    try: fmp_key = st.secrets["fmp"]["api_key"]
+    except: fmp_key = None
+    try: ttl = int(st.secrets["cotizaciones"]["ttl"])
+    except: ttl = 60
+    return CacheCotizaciones(api_key=fmp_key, ttl=ttl)
+
+# Limitador común a todas las sesiones: el límite de 5 req/s de Airtable es por base
+@st.cache_resource(show_spinner=False)
+def get_limitador_airtable():
+    return LimitadorTokens()
+
+# Importaciones, descargas de divisas e informes en hilos propios; la barra lateral consulta su avance
+@st.cache_resource(show_spinner=False)
+def get_gestor_trabajos():
+    gestor = GestorTrabajos()
+    gestor.purgar()
+    return gestor
 
 def guardar_en_airtable(record):
     try:
         record["Usuario"] = st.session_state.current_user
-        table_ops.create(record)
+        creado = table_ops.create(record)
         st.toast(f"✅ Operación Guardada: {record['Ticker']}", icon="💾")
         time.sleep(1) 
         st.session_state.pending_data = None
         st.session_state.adding_mode = False 
-        st.cache_data.clear() # Limpiar caché
+        registrar_escritura(st.session_state.current_user, [creado]) # Sólo el libro de este usuario
         st.rerun()
     except Exception as e: st.error(f"Error guardando: {e}")
 
-# --- GENERADORES PDF ---
-def generar_pdf_historial(dataframe, titulo):
-    class PDF(FPDF):
-        def header(self):
-            self.set_font('Arial', 'B', 12)
-            _ = self.cell(0, 10, titulo, 0, 1, 'C')
-            _ = self.ln(5)
-        def footer(self):
-            self.set_y(-15)
-            self.set_font('Arial', 'I', 8)
-            _ = self.cell(0, 10, f'Pagina {self.page_no()}', 0, 0, 'C')
-    pdf = PDF(orientation='L') 
-    pdf.add_page()
-    pdf.set_font("Arial", size=10)
-    cols_map = {'Fecha_str': ('Fecha', 35), 'Ticker': ('Ticker', 15), 'Descripcion': ('Empresa', 50), 'Cantidad': ('Cant.', 25), 'Precio': ('Precio', 25), 'Moneda': ('Div', 15), 'Comision': ('Com.', 20), 'Usuario': ('Usuario', 30)}
-    pdf.set_fill_color(200, 220, 255)
-    pdf.set_font("Arial", 'B', 10)
-    cols_validas = []
-    for k, (nombre_pdf, ancho) in cols_map.items():
-        if k in dataframe.columns:
-            cols_validas.append((k, nombre_pdf, ancho))
-            _ = pdf.cell(ancho, 10, nombre_pdf, 1, 0, 'C', 1)
-    _ = pdf.ln()
-    pdf.set_font("Arial", size=9)
-    for _, row in dataframe.iterrows():
-        for col_key, _, ancho in cols_validas:
-            val = row[col_key]
-            if isinstance(val, (int, float)) and col_key not in ['Cantidad']: 
-                valor = fmt_num_es(val)
-            else:
-                valor = str(val).replace("€", "EUR").encode('latin-1', 'replace').decode('latin-1')
-            _ = pdf.cell(ancho, 10, valor, 1, 0, 'C')
-        _ = pdf.ln()
-    return pdf.output(dest='S').encode('latin-1')
-
-def generar_informe_fiscal_completo(datos_fiscales, año, nombre_titular, dni_titular):
-    class PDF_Fiscal(FPDF):
-        def header(self):
-            self.set_font('Arial', 'B', 14)
-            _ = self.cell(0, 10, f"Informe Fiscal - Ejercicio {año}", 0, 1, 'C')
-            self.set_font('Arial', '', 10)
-            _ = self.cell(0, 5, f"Titular: {nombre_titular} | NIF/DNI: {dni_titular}", 0, 1, 'C')
-            self.set_font('Arial', 'I', 8)
-            _ = self.cell(0, 5, f"Generado el {datetime.now().strftime('%d/%m/%Y')}", 0, 1, 'C')
-            _ = self.ln(5)
-        def footer(self):
-            self.set_y(-15)
-            self.set_font('Arial', 'I', 8)
-            _ = self.cell(0, 10, f'Pág {self.page_no()}', 0, 0, 'C')
-
-    pdf = PDF_Fiscal(orientation='L')
-    pdf.add_page()
-    
-    # 1. GANANCIAS
-    pdf.set_font("Arial", 'B', 12)
-    pdf.set_fill_color(200, 200, 200)
-    _ = pdf.cell(0, 10, "1. Ganancias y Pérdidas Patrimoniales (Acciones)", 1, 1, 'L', 1)
-    _ = pdf.ln(2)
-
-    pdf.set_font("Arial", 'B', 8)
-    cols = [("Ticker", 15), ("Empresa", 35), ("ISIN", 25), ("F. Venta", 20), ("F. Compra", 20), ("Cant.", 15), ("V. Transm.", 25), ("V. Adquis.", 25), ("Rendimiento", 25)]
-    for txt, w in cols: _ = pdf.cell(w, 8, txt, 1, 0, 'C')
-    _ = pdf.ln()
-    
-    pdf.set_font("Arial", '', 8)
-    total_ganancias = 0.0
-    ops_acciones = [d for d in datos_fiscales if d['Tipo'] == "Ganancia/Pérdida"]
-    
-    for op in ops_acciones:
-        rend = op['Rendimiento']
-        total_ganancias += rend
-        empresa_txt = str(op.get('Empresa', ''))[:18]
-
-        _ = pdf.cell(15, 8, str(op['Ticker']), 1, 0, 'C')
-        _ = pdf.cell(35, 8, empresa_txt, 1, 0, 'L')
-        _ = pdf.cell(25, 8, str(op.get('ISIN', '')), 1, 0, 'C') 
-        _ = pdf.cell(20, 8, str(op['Fecha Venta']), 1, 0, 'C')
-        _ = pdf.cell(20, 8, str(op['Fecha Compra']), 1, 0, 'C')
-        _ = pdf.cell(15, 8, fmt_dinamico(op['Cantidad']), 1, 0, 'C')
-        _ = pdf.cell(25, 8, f"{fmt_num_es(op['V. Transmisión'])}", 1, 0, 'R')
-        _ = pdf.cell(25, 8, f"{fmt_num_es(op['V. Adquisición'])}", 1, 0, 'R')
-        
-        if rend >= 0: pdf.set_text_color(0, 150, 0)
-        else: pdf.set_text_color(200, 0, 0)
-        
-        _ = pdf.cell(25, 8, f"{fmt_num_es(rend)}", 1, 0, 'R')
-        pdf.set_text_color(0, 0, 0)
-        _ = pdf.ln()
-
-    # Total 1
-    pdf.set_font("Arial", 'B', 10)
-    _ = pdf.cell(170, 10, "TOTAL GANANCIA/PÉRDIDA PATRIMONIAL:", 0, 0, 'R')
-    if total_ganancias >= 0: pdf.set_text_color(0, 150, 0)
-    else: pdf.set_text_color(200, 0, 0)
-    _ = pdf.cell(35, 10, f"{fmt_num_es(total_ganancias)} EUR", 0, 1, 'R')
-    pdf.set_text_color(0, 0, 0)
-    _ = pdf.ln(5)
-
-    # 2. DIVIDENDOS
-    pdf.set_font("Arial", 'B', 12)
-    pdf.set_fill_color(200, 200, 200)
-    _ = pdf.cell(0, 10, "2. Rendimientos del Capital Mobiliario (Dividendos)", 1, 1, 'L', 1)
-    _ = pdf.ln(2)
-
-    pdf.set_font("Arial", 'B', 9)
-    cols_div = [("Ticker", 30), ("Fecha Cobro", 40), ("Importe Bruto", 40), ("Gastos Ded.", 40), ("Importe Neto", 40)]
-    for txt, w in cols: _ = pdf.cell(w, 8, txt, 1, 0, 'C')
-    _ = pdf.ln()
-
-    pdf.set_font("Arial", '', 9)
-    total_divs_neto = 0.0
-    ops_divs = [d for d in datos_fiscales if d['Tipo'] == "Dividendo"]
-
-    for op in ops_divs:
-        total_divs_neto += op['Neto']
-        _ = pdf.cell(30, 8, str(op['Ticker']), 1, 0, 'C')
-        _ = pdf.cell(40, 8, str(op['Fecha']), 1, 0, 'C')
-        _ = pdf.cell(40, 8, f"{fmt_num_es(op['Bruto'])}", 1, 0, 'R')
-        _ = pdf.cell(40, 8, f"{fmt_num_es(op['Gastos'])}", 1, 0, 'R')
-        _ = pdf.cell(40, 8, f"{fmt_num_es(op['Neto'])}", 1, 0, 'R')
-        _ = pdf.ln()
-
-    # Total 2
-    pdf.set_font("Arial", 'B', 10)
-    _ = pdf.cell(160, 10, "TOTAL RENDIMIENTOS (NETO):", 0, 0, 'R')
-    _ = pdf.cell(30, 10, f"{fmt_num_es(total_divs_neto)} EUR", 0, 1, 'R')
-    
-    return pdf.output(dest='S').encode('latin-1')
+# --- INFORMES Y EXPORTACIONES (bajo demanda, cacheados por usuario/año/versión del libro) ---
+@st.cache_resource(show_spinner=False)
+def get_cache_informes():
+    return CacheInformes()
 
 # --- APP INICIO: LECTURA CON CACHÉ ---
-@st.cache_data(ttl=600, show_spinner="Sincronizando con Airtable...")
-def fetch_data():
-    try:
-        return table_ops.all()
-    except:
-        return []
+# Espejo local de operaciones: cada vista (usuario o admin) sólo pide a Airtable sus filas nuevas o editadas
+@st.cache_resource(show_spinner=False)
+def get_espejo_operaciones():
+    return EspejoAirtable(table_ops)
+
+# Libro ya tipado en Parquet: se normaliza al sincronizar, no en cada rerun
+@st.cache_resource(show_spinner=False)
+def get_libro_columnar():
+    return LibroColumnar()
+
+def sincronizar_operaciones(vista, completa=False):
+    recibidos, completa = get_espejo_operaciones().sincronizar(vista, formula_vista(vista), completa=completa)
+    if completa or not get_libro_columnar().existe(vista):
+        get_libro_columnar().reconstruir(vista, get_espejo_operaciones().registros(vista))
+    elif recibidos: get_libro_columnar().fusionar(vista, recibidos) # Sólo el delta: el Parquet principal no se reescribe
+
+def fetch_data(vista):
+    def cargar():
+        with st.spinner("Sincronizando con Airtable..."):
+            try: sincronizar_operaciones(vista)
+            except: pass  # Sin conexión: se sirve la última copia local
+        return get_libro_columnar().version(vista)
+    return get_cache_regiones().obtener("libro", vista, cargar)
+
+# Huellas de las operaciones ya guardadas del usuario: las importaciones no vuelven a subirlas
+def get_indice_operaciones(usuario):
+    vista = vista_usuario(usuario)
+    _ = fetch_data(vista)
+    # Versión del Parquet, no la que memoriza fetch_data: registrar_escritura lo reescribe sin pasar por ella
+    version = get_libro_columnar().version(vista)
+    return get_cache_regiones().obtener("libro", ("indice", vista, version), lambda: IndiceOperaciones(get_libro_columnar().leer(vista), usuario))
+
+def invalidar_libro(usuario):
+    get_cache_regiones().invalidar("libro", [vista_usuario(usuario), VISTA_TODOS]) # La vista admin también contiene sus filas
+
+def registrar_escritura(usuario, registros):
+    """Fusiona en la copia local lo que la app acaba de crear; si la vista aún no existe, se sincronizará."""
+    for vista in (vista_usuario(usuario), VISTA_TODOS):
+        try:
+            if get_espejo_operaciones().fusionar(vista, registros):
+                if get_libro_columnar().existe(vista): get_libro_columnar().fusionar(vista, registros)
+                else: get_libro_columnar().reconstruir(vista, get_espejo_operaciones().registros(vista))
+            else: invalidar_libro(usuario)
+        except: invalidar_libro(usuario)
 
 if not login_system(): st.stop()
 
@@ -360,38 +259,18 @@ ver_todo = False
 if st.session_state.user_role == 'admin':
     ver_todo = st.toggle("👁️ Modo Admin", value=False)
 
-# Cargar datos desde Airtable
-data = fetch_data()
+# Cargar datos desde Airtable (sólo la vista necesaria; la tabla completa únicamente en Modo Admin)
+vista_libro = VISTA_TODOS if ver_todo else vista_usuario(st.session_state.current_user)
+_ = fetch_data(vista_libro)
 
-df = pd.DataFrame()
-if data:
-    df = pd.DataFrame([x['fields'] for x in data])
-    df.columns = df.columns.str.strip() 
+# Fechas, números y categorías llegan ya normalizados desde la copia columnar
+df = get_libro_columnar().leer(vista_libro)
+if not df.empty:
     if 'Usuario' in df.columns:
         if not ver_todo: df = df[df['Usuario'] == st.session_state.current_user]
     else:
         if not ver_todo: df = pd.DataFrame()
 
-    if not df.empty:
-        # AFINAMIENTO v32.45: Limpieza de datos manuales
-        if 'Fecha' in df.columns:
-            # Quitamos espacios invisibles y convertimos a datetime robusto
-            df['Fecha_dt'] = pd.to_datetime(df['Fecha'].astype(str).str.strip(), errors='coerce')
-            # Descartamos registros con fecha corrupta
-            df = df.dropna(subset=['Fecha_dt'])
-            df['Año'] = df['Fecha_dt'].dt.year 
-            df['Fecha_str'] = df['Fecha_dt'].dt.strftime('%Y/%m/%d %H:%M')
-        else: 
-            df['Año'] = datetime.now().year
-            df['Fecha_dt'] = datetime.now()
-        
-        # Asegurar tipos numéricos (limpiando comas de texto manual)
-        for col in ["Cantidad", "Precio", "Comision", "Cambio"]:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col].astype(str).str.replace(',', '.'), errors='coerce').fillna(0.0)
-                
-        if 'Cambio' not in df.columns: df['Cambio'] = 1.0
-
 # ==============================================================================
 # 1. SIDEBAR (TOP): FILTROS Y RECALCULAR
 # ==============================================================================
@@ -400,15 +279,24 @@ with st.sidebar:
     
     # --- BOTÓN RECALCULAR FIFO ---
     if st.button("🔄 Recalcular y Sincronizar", use_container_width=True, type="secondary"):
-        st.cache_data.clear() # Limpia la memoria de la lectura de Airtable
+        # Relectura completa de la vista: recoge también los borrados hechos en Airtable
+        try: sincronizar_operaciones(vista_libro, completa=True)
+        except Exception as e: st.error(f"Error sincronizando: {e}")
+        get_cache_regiones().invalidar("libro", [vista_libro]) # Sólo la lectura de esta vista
         st.toast("Recalculando motor FIFO con datos frescos...", icon="⚙️")
         time.sleep(1)
         st.rerun()
+
+    # --- DESCARGA DE DIVISAS EN SEGUNDO PLANO ---
+    if not df.empty and 'Moneda' in df.columns and (df['Moneda'] != MONEDA_BASE).any():
+        if st.button("💱 Precargar Histórico de Divisas", use_container_width=True):
+            rangos = {mon: (g.min(), g.max()) for mon, g in df.groupby('Moneda', observed=True)['Fecha_dt']}
+            get_gestor_trabajos().enviar(st.session_state.current_user, "divisas", "Histórico de divisas",
+                                         get_almacen_divisas().asegurar_rangos, rangos)
+            st.toast("Descargando cambios históricos en segundo plano...", icon="💱")
         
     lista_años = ["Todos los años"]
-    if not df.empty and 'Año' in df.columns:
-        años_disponibles = sorted(df['Año'].dropna().unique().astype(int), reverse=True)
-        lista_años += list(años_disponibles)
+    if not df.empty: lista_años += get_libro_columnar().años(vista_libro) # Sólo lee la columna Año
     año_seleccionado = st.selectbox("📅 Año Fiscal:", lista_años)
     ver_solo_activas = st.checkbox("👁️ Ocultar posiciones cerradas", value=False)
     _ = st.divider()
@@ -416,257 +304,176 @@ with st.sidebar:
 # ==============================================================================
 # 2. MOTOR DE CÁLCULO
 # ==============================================================================
-cartera = {}
-colas_fifo = {} # <--- INICIALIZADA AQUÍ (GLOBAL) PARA EVITAR NAMEERROR
-total_div, total_comi, pnl_cerrado, compras_eur, ventas_coste = 0.0, 0.0, 0.0, 0.0, 0.0
-roi_log = []
-reporte_fiscal_log = []
-validaciones_pendientes = [] # Para el script de validación manual
-
-if not df.empty:
-    isin_cache_local = {}
-
-    # Ordenamos cronológicamente para que el FIFO sea perfecto
-    for i, row in df.sort_values(by="Fecha_dt").iterrows():
-        tipo, tick = row.get('Tipo'), str(row.get('Ticker')).strip()
-        dinero, precio = float(row.get('Cantidad', 0)), float(row.get('Precio', 1))
-        mon, comi = row.get('Moneda', 'EUR'), float(row.get('Comision', 0))
-        
-        fx = 1.0 
-        val_cambio_db = float(row.get('Cambio', 1.0))
-        
-        # VALIDACIÓN: Detección de olvido de Cambio en edición manual
-        if mon != "EUR" and val_cambio_db == 1.0:
-            validaciones_pendientes.append(f"{tick} | {row.get('Fecha_str')}")
-
-        if mon != "EUR":
-             if val_cambio_db != 1.0 and val_cambio_db > 0:
-                 fx = val_cambio_db
-             else:
-                 fx = get_exchange_rate_now(mon, MONEDA_BASE)
-
-        dinero_eur = dinero * fx
-        if precio <= 0: precio = 1
-        
-        acciones_op = round(dinero / precio, 8) 
-        
-        en_rango_visual = (año_seleccionado == "Todos los años") or (row.get('Año') == int(año_seleccionado))
-        es_año_fiscal = (row.get('Año') == int(año_seleccionado)) if año_seleccionado != "Todos los años" else True
-
-        delta_p, delta_i = 0.0, 0.0
-        
-        if en_rango_visual: total_comi += (comi * fx)
-        delta_p -= (comi * fx)
-
-        if tick not in cartera:
-            colas_fifo[tick] = [] 
-            desc_ini = row.get('Descripcion', tick)
-            cartera[tick] = {'acciones': 0.0, 'coste_total_eur': 0.0, 'desc': desc_ini, 'pnl_cerrado': 0.0, 'pmc': 0.0, 'moneda_origen': mon, 'movimientos': [], 'lotes': colas_fifo[tick]}
-        
-        row['Fecha_Raw'] = row.get('Fecha_dt')
-        _ = cartera[tick]['movimientos'].append(row)
-
-        if tipo == "Compra":
-            # --- FIX FISCAL V32.45: SUMAR COMISION AL COSTE BASE ---
-            coste_real_compra = dinero_eur + (comi * fx)
-            delta_i = coste_real_compra
-            
-            cartera[tick]['acciones'] += acciones_op
-            cartera[tick]['coste_total_eur'] += coste_real_compra
-            
-            if en_rango_visual: compras_eur += coste_real_compra
-            
-            _ = colas_fifo[tick].append({'fecha': row.get('Fecha_dt'), 'fecha_str': row.get('Fecha_str', '').split(' ')[0], 'acciones_restantes': acciones_op, 'coste_por_accion_eur': coste_real_compra / acciones_op if acciones_op > 0 else 0})
-            if cartera[tick]['acciones'] > 0: cartera[tick]['pmc'] = cartera[tick]['coste_total_eur'] / cartera[tick]['acciones']
-
-        elif tipo == "Venta":
-            acciones_a_vender = acciones_op
-            
-            # --- PROTECCIÓN ANTI-DECIMALES (Limpieza de residuos) ---
-            if cartera[tick]['acciones'] > 0:
-                 ratio_venta = acciones_a_vender / cartera[tick]['acciones']
-                 if 0.98 < ratio_venta < 1.02: # Si está en un margen del 2%
-                     acciones_a_vender = cartera[tick]['acciones'] # Forzamos venta de todo el stock
-            # --------------------------------------------------------
-
-            coste_total_venta_fifo = 0.0
-            valor_transmision_neto_total = dinero_eur - (comi * fx) 
-            precio_venta_neto_unitario = valor_transmision_neto_total / acciones_a_vender if acciones_a_vender > 0 else 0
-
-            isin_actual = ""
-            if es_año_fiscal:
-                if tick not in isin_cache_local:
-                    isin_cache_local[tick] = get_ticker_isin(tick)
-                isin_actual = isin_cache_local[tick]
-
-            while acciones_a_vender > 0.00000001 and colas_fifo[tick]:
-                lote = colas_fifo[tick][0]
-                cantidad_consumida = 0
-                
-                if lote['acciones_restantes'] <= acciones_a_vender + 0.000001:
-                    cantidad_consumida = lote['acciones_restantes']
-                    coste_total_venta_fifo += cantidad_consumida * lote['coste_por_accion_eur']
-                    acciones_a_vender -= cantidad_consumida
-                    _ = colas_fifo[tick].pop(0)
-                else:
-                    cantidad_consumida = acciones_a_vender
-                    coste_total_venta_fifo += cantidad_consumida * lote['coste_por_accion_eur']
-                    lote['acciones_restantes'] -= cantidad_consumida
-                    acciones_a_vender = 0
-                
-                if es_año_fiscal:
-                    v_adquisicion = cantidad_consumida * lote['coste_por_accion_eur']
-                    v_transmision = cantidad_consumida * precio_venta_neto_unitario
-                    rendimiento = v_transmision - v_adquisicion
-                    nombre_empresa = cartera[tick]['desc']
-                    
-                    _ = reporte_fiscal_log.append({
-                        "Tipo": "Ganancia/Pérdida", 
-                        "Ticker": tick, 
-                        "Empresa": nombre_empresa,
-                        "ISIN": isin_actual, 
-                        "Fecha Venta": row.get('Fecha_str', '').split(' ')[0], 
-                        "Fecha Compra": lote['fecha_str'], 
-                        "Cantidad": cantidad_consumida, 
-                        "V. Transmisión": v_transmision, 
-                        "V. Adquisición": v_adquisicion, 
-                        "Rendimiento": rendimiento
-                    })
-
-            beneficio = (dinero_eur - (comi * fx)) - coste_total_venta_fifo
-            delta_p += beneficio
-            
-            if en_rango_visual: 
-                ventas_coste += coste_total_venta_fifo
-                pnl_cerrado += beneficio
-                cartera[tick]['pnl_cerrado'] += beneficio
-            
-            cartera[tick]['coste_total_eur'] -= coste_total_venta_fifo
-            
-            # RE-SINCRO: Recalculamos el total de acciones basándonos en los lotes FIFO restantes
-            total_acciones_restantes = sum(l['acciones_restantes'] for l in colas_fifo[tick])
-            cartera[tick]['acciones'] = total_acciones_restantes
-            
-            if cartera[tick]['acciones'] < 0.000001: 
-                cartera[tick]['acciones'] = 0.0
-                cartera[tick]['coste_total_eur'] = 0.0
-                cartera[tick]['pmc'] = 0.0
-            else:
-                cartera[tick]['pmc'] = cartera[tick]['coste_total_eur'] / cartera[tick]['acciones']
-
-        elif tipo == "Dividendo":
-            delta_p += dinero_eur
-            div_neto = (dinero_eur) - (comi * fx)
-            if en_rango_visual: total_div += dinero_eur
-            
-            if es_año_fiscal:
-                nombre_empresa = cartera[tick]['desc']
-                _ = reporte_fiscal_log.append({
-                    "Tipo": "Dividendo",
-                    "Ticker": tick,
-                    "Empresa": nombre_empresa,
-                    "Fecha": row.get('Fecha_str', '').split(' ')[0],
-                    "Bruto": dinero_eur,
-                    "Gastos": comi * fx,
-                    "Neto": div_neto
-                })
-        
-        _ = roi_log.append({'Fecha': row.get('Fecha_dt'), 'Year': row.get('Año'), 'Delta_Profit': delta_p, 'Delta_Invest': delta_i})
+# Snapshots FIFO persistidos: sólo se reproducen las operaciones posteriores al último checkpoint válido
+@st.cache_resource(show_spinner=False)
+def get_almacen_snapshots():
+    return AlmacenSnapshots()
+
+# Cambio histórico para operaciones en divisa sin Cambio: una serie por moneda, descargada antes del replay
+series_cambio_libro = {}
+def serie_cambio_historico(mon):
+    if mon not in series_cambio_libro:
+        fechas_mon = df.loc[df['Moneda'] == mon, 'Fecha_dt'] if 'Moneda' in df.columns else df['Fecha_dt']
+        try:
+            get_almacen_divisas().asegurar_rango(mon, fechas_mon.min(), fechas_mon.max())
+            series_cambio_libro[mon] = get_almacen_divisas().serie(mon)
+        except: series_cambio_libro[mon] = None
+    return series_cambio_libro[mon]
+
+# Curva diaria de valor de mercado: posiciones del libro × cierres locales × cambio a EUR
+def calcular_curva_valor(previa=None):
+    ops = df[df['Tipo'].isin(["Compra", "Venta"])] if 'Tipo' in df.columns else df.iloc[:0]
+    if ops.empty: return curva_valor(ops, pd.DataFrame(), {}, {})
+    tickers_ops = ops['Ticker'].astype(str).str.strip()
+    monedas = ops['Moneda'].astype(str).groupby(tickers_ops.to_numpy()).last().to_dict() if 'Moneda' in ops.columns else {}
+    series = {}
+    for mon in set(monedas.values()) - {MONEDA_BASE}:
+        try:
+            get_almacen_divisas().asegurar_rango(mon, ops['Fecha_dt'].min(), pd.Timestamp.now())
+            series[mon] = get_almacen_divisas().serie(mon)
+        except: pass
+    return curva_valor(ops, get_almacen_historico().cierres(tickers_ops.unique().tolist()), monedas, series, previa=previa)
+
+clave_snapshot = vista_libro
+# Mismo libro: los reruns de pura interfaz (checkbox, periodos, detalle) no recalculan, y el
+# estado lleva todos los ejercicios, así que cambiar de año es elegir un bucket
+clave_motor = (clave_snapshot, get_libro_columnar().version(vista_libro))
+estado_motor = get_cache_regiones().obtener("motor", clave_motor, lambda: calcular_estado_incremental(
+    df, clave_snapshot, get_almacen_snapshots(),
+    serie_cambio=serie_cambio_historico
+), medir=tamaño_resultado)
+# El ISIN se resuelve al proyectar: un fallo puntual de la consulta no queda guardado en los snapshots.
+# La proyección del año (con sus ISIN) se guarda junto al estado: un rerun no vuelve a pedirla
+resultado_motor = get_cache_regiones().obtener("motor", (clave_motor, "vista", año_seleccionado), lambda: vista_año(
+    estado_motor, año_seleccionado, resolver_isin=get_ticker_isin
+), medir=tamaño_vista)
+cartera = resultado_motor['cartera']
+colas_fifo = resultado_motor['colas_fifo']
+roi_log = resultado_motor['roi_log']
+reporte_fiscal_log = resultado_motor['reporte_fiscal_log']
+validaciones_pendientes = resultado_motor['validaciones_pendientes'] # Para el script de validación manual
+cambios_autocompletados = resultado_motor['cambios_autocompletados']
+cambios_sin_resolver = resultado_motor['cambios_sin_resolver']
+totales_motor = resultado_motor['totales']
+totales_por_año = resultado_motor['totales_por_año']
+total_div, total_comi, pnl_cerrado = totales_motor['total_div'], totales_motor['total_comi'], totales_motor['pnl_cerrado']
+compras_eur, ventas_coste = totales_motor['compras_eur'], totales_motor['ventas_coste']
 
 # --- AVISOS DE VALIDACIÓN MANUAL ---
+if cambios_sin_resolver:
+    st.error(f"💱 **{cambios_sin_resolver} operaciones en divisa sin cambio histórico disponible se están valorando a 1.0.** "
+             "Precarga el histórico de divisas o pulsa «Recalcular» cuando vuelva la conexión.")
 if validaciones_pendientes:
     st.warning(f"⚠️ **Detectadas {len(validaciones_pendientes)} operaciones en divisa con Cambio = 1.0 (posible error manual en Airtable).**")
     with st.expander("Ver detalle de operaciones a revisar"):
         for v in validaciones_pendientes: st.write(f"- {v}")
+        if cambios_autocompletados:
+            st.caption("Mientras tanto se aplica el cambio histórico de la fecha de cada operación:")
+            st.dataframe(pd.DataFrame(cambios_autocompletados), hide_index=True, use_container_width=True)
 
 # ==============================================================================
 # 3. SIDEBAR (RESTO)
 # ==============================================================================
+def panel_trabajos(sondeo=False):
+    trabajos = get_gestor_trabajos().trabajos_usuario(st.session_state.current_user, limite=5, solo_avisos=True)
+    if sondeo and not trabajos: st.rerun()  # Ya no queda nada que sondear
+    # Los terminados se marcan vistos al recargar, pero su aviso se muestra una vez más
+    recientes = st.session_state.pop("trabajos_terminados", []) if not sondeo else []
+    if not trabajos and not recientes: return
+    st.caption("⏳ Trabajos en segundo plano")
+    for t in recientes + trabajos:
+        if t['estado'] in ESTADOS_ACTIVOS:
+            avance = min(t['hechas'] / t['total'], 1.0) if t['total'] else 0.0
+            st.progress(avance, text=f"{t['descripcion']} ({t['hechas']}/{t['total']})")
+        elif t['estado'] == "completado": st.caption(f"✅ {t['descripcion']}")
+        else: st.caption(f"❌ {t['descripcion']}: {(t['mensaje'] or t['estado']).splitlines()[0]}")
+    # Al terminar un trabajo se recarga la app: una importación obliga a releer Airtable y
+    # unas divisas nuevas cambian el cambio autocompletado, así que los snapshots ya no sirven
+    terminados = [t for t in trabajos if t['estado'] not in ESTADOS_ACTIVOS]
+    for t in terminados: get_gestor_trabajos().marcar_visto(t['id'])
+    completados = [t for t in terminados if t['estado'] == "completado"]
+    if any(t['tipo'] == "importacion" for t in completados): invalidar_libro(st.session_state.current_user)
+    if any(t['tipo'] == "divisas" for t in completados):
+        # El almacén de divisas es común: afecta a los checkpoints y resultados de todas las vistas
+        get_almacen_snapshots().borrar_todos()
+        get_cache_regiones().invalidar("motor")
+        get_curvas_valor().invalidar()
+    # La recarga completa también decide de nuevo si hace falta seguir sondeando
+    if terminados:
+        st.session_state.trabajos_terminados = terminados
+        st.rerun()
+
+# Sondeo del avance sin recargar toda la página (st.fragment en Streamlit >= 1.37), sólo mientras haya
+# trabajos en marcha: sin ellos el panel se pinta una vez y no consulta SQLite cada 2 s
+panel_trabajos_sondeo = st.fragment(run_every=2)(panel_trabajos) if hasattr(st, "fragment") else None
+
 with st.sidebar:
+    if get_gestor_trabajos().hay_activos(st.session_state.current_user):
+        if panel_trabajos_sondeo: panel_trabajos_sondeo(sondeo=True)
+        else:
+            panel_trabajos()
+            if st.button("🔄 Actualizar estado", use_container_width=True): st.rerun()
+    else: panel_trabajos()
+
     # --- A. IMPORTACION MASIVA (OPCIÓN A: MANUAL + SOPORTE EUROPEO) ---
     with st.expander("📂 Importación Masiva (CSV)", expanded=False):
-        st.info("Sube tu CSV preparado (Opción A). Soporta formato 1.200,00 (EU) y 1,200.00 (US).")
+        st.info("Sube tu CSV preparado (Opción A) o la exportación de tu bróker. Soporta formato 1.200,00 (EU) y 1,200.00 (US).")
         uploaded_file = st.file_uploader("Subir archivo CSV", type=["csv"])
         
         if uploaded_file is not None:
             try:
-                df_upload = pd.read_csv(uploaded_file, sep=None, engine='python')
-                st.dataframe(df_upload.head(3), hide_index=True)
+                # Lectura y validación una vez por fichero/perfil: los reruns reutilizan el resultado
+                perfil_sel = st.selectbox("Formato del fichero", ["Automático"] + list(PERFILES), key="cfg_perfil_csv")
+                clave_csv = (uploaded_file.file_id, perfil_sel, st.session_state.current_user)
+                if st.session_state.csv_validado is None or st.session_state.csv_validado['clave'] != clave_csv:
+                    df_upload = leer_csv(uploaded_file)
+                    perfil = detectar_perfil(df_upload.columns) if perfil_sel == "Automático" else perfil_sel
+                    st.session_state.csv_validado = {'clave': clave_csv, 'perfil': perfil, 'filas': len(df_upload),
+                                                     'validado': preparar_registros(df_upload, st.session_state.current_user, perfil)}
+                csv_validado = st.session_state.csv_validado
+                preparados_csv, errores_csv = csv_validado['validado']
+                st.caption(f"Formato: {csv_validado['perfil']} · {len(preparados_csv)} de {csv_validado['filas']} filas válidas")
+                st.dataframe(vista_previa(preparados_csv, 3), hide_index=True)
+                if errores_csv:
+                    st.warning(f"⚠️ {len(errores_csv)} filas con errores no se importarán.")
+                    st.dataframe(pd.DataFrame(errores_csv), hide_index=True, use_container_width=True)
+                indice_ops = get_indice_operaciones(st.session_state.current_user)
+                if csv_validado.get('indice') is not indice_ops: # Se recuenta sólo si el libro cambió
+                    csv_validado['indice'], csv_validado['repetidas'] = indice_ops, len(indice_ops.separar(preparados_csv)[1])
+                n_repetidas = csv_validado['repetidas']
+                omitir_repetidas = True
+                if n_repetidas:
+                    st.info(f"♻️ {n_repetidas} filas ya están en tu libro (misma fecha, ticker, tipo, cantidad y precio).")
+                    omitir_repetidas = not st.checkbox("Importarlas igualmente", value=False, key="cfg_importar_repetidas")
                 
-                if st.button("🚀 Procesar e Importar"):
-                    progress_bar = st.progress(0)
-                    total_rows = len(df_upload)
-                    
-                    # --- FUNCIÓN DE LIMPIEZA DE NÚMEROS (CRÍTICA) ---
-                    def limpiar_numero_eu(valor):
-                        """Convierte formato 1.234,56 (EU) a 1234.56 (Python)"""
-                        if pd.isna(valor) or str(valor).strip() == '': return 0.0
-                        s = str(valor).strip()
-                        # Si detectamos formato europeo (puntos como miles y coma como decimal)
-                        # O simplemente comas como decimal
-                        if ',' in s:
-                            s = s.replace('.', '')  # Eliminar puntos de miles
-                            s = s.replace(',', '.') # Cambiar coma por punto decimal
-                        return float(s)
-                    # ------------------------------------------------
-                    
-                    for idx, row in df_upload.iterrows():
-                        try:
-                            # Preparar Fecha
-                            fecha_raw = row.get('Fecha') or row.get('Date')
-                            hora_raw = row.get('Hora', '00:00')
-                            dt_obj = pd.to_datetime(f"{fecha_raw} {hora_raw}", dayfirst=True)
-                            
-                            mon = (row.get('Moneda') or row.get('Currency', 'EUR')).upper().strip()
-                            
-                            # Preparar valores usando la limpieza robusta
-                            total_dinero_bruto = limpiar_numero_eu(row.get('Total_Dinero', 0))
-                            precio_unitario = limpiar_numero_eu(row.get('Precio', 0))
-                            comision_val = limpiar_numero_eu(row.get('Comision', 0))
-                            
-                            # Preparar Ticker y Tipo
-                            ticker_val = str(row.get('Ticker')).upper().strip()
-                            tipo_val = str(row.get('Tipo')).capitalize()
-                            
-                            # Cambio
-                            fx_val = 1.0
-                            if 'Cambio' in row: fx_val = limpiar_numero_eu(row['Cambio'])
-                            elif 'FX Rate' in row: fx_val = limpiar_numero_eu(row['FX Rate'])
-                            elif mon != "EUR":
-                                fx_val = get_historical_eur_rate(dt_obj, mon)
-                            
-                            record = {
-                                "Usuario": st.session_state.current_user,
-                                "Fecha": dt_obj.strftime("%Y/%m/%d %H:%M"),
-                                "Ticker": ticker_val,
-                                "Tipo": tipo_val,
-                                "Cantidad": total_dinero_bruto,
-                                "Precio": precio_unitario,
-                                "Comision": comision_val,
-                                "Moneda": mon,
-                                "Cambio": fx_val,
-                                "Descripcion": "Importado CSV (Opción A)"
-                            }
-                            try:
-                                n, _, _ = get_stock_data_yahoo(record['Ticker'])
-                                if n: record['Descripcion'] = n
-                            except: pass
-
-                            table_ops.create(record)
-                            time.sleep(0.25)
-                            progress_bar.progress((idx + 1) / total_rows)
-                            
-                        except Exception as e:
-                            st.error(f"Error fila {idx}: {e}")
-                    
-                    st.success("✅ Importación completada!")
-                    st.cache_data.clear()
-                    time.sleep(1)
-                    st.rerun()
+                if preparados_csv and st.button("🚀 Procesar e Importar"):
+                    st.session_state.trabajo_importacion = get_gestor_trabajos().enviar(
+                        st.session_state.current_user, "importacion", f"Importar {uploaded_file.name}",
+                        importar_csv, None, st.session_state.current_user, table_ops,
+                        get_almacen_divisas(), get_almacen_metadatos().nombre_empresa,
+                        limitador=get_limitador_airtable(), validado=csv_validado['validado'],
+                        indice=indice_ops, omitir_repetidos=omitir_repetidas
+                    )
+                    st.toast("Importación en segundo plano. Puedes seguir usando la app.", icon="⏳")
                     
             except Exception as e:
                 st.error(f"Error leyendo CSV: {e}")
 
+        # Resultado de la última importación lanzada en esta sesión
+        if st.session_state.trabajo_importacion:
+            trabajo = get_gestor_trabajos().estado(st.session_state.trabajo_importacion)
+            if trabajo and trabajo['estado'] == "completado":
+                df_informe = pd.DataFrame(trabajo['resultado'])
+                n_ok = int((df_informe['Estado'] == "Creado").sum()) if not df_informe.empty else 0
+                n_rep = int((df_informe['Estado'] == "Repetido").sum()) if not df_informe.empty else 0
+                if n_ok + n_rep == len(df_informe):
+                    st.success(f"✅ Importación completada! {n_ok} operaciones creadas." + (f" {n_rep} omitidas por estar ya en el libro." if n_rep else ""))
+                else:
+                    st.warning(f"⚠️ Importadas {n_ok} de {len(df_informe)} filas ({n_rep} omitidas por repetidas).")
+                    st.dataframe(df_informe[~df_informe['Estado'].isin(["Creado", "Repetido"])], hide_index=True, use_container_width=True)
+            elif trabajo and trabajo['estado'] in ("error", "interrumpido"):
+                st.error(f"Error en la importación: {trabajo['mensaje']}")
+
     # --- B. IMPUESTOS ---
     if año_seleccionado != "Todos los años" and reporte_fiscal_log:
         st.markdown(f"**⚖️ Impuestos {año_seleccionado}**")
@@ -680,19 +487,32 @@ with st.sidebar:
                 cols_view = ['Ticker', 'Fecha Venta', 'Cantidad', 'Rendimiento'] if 'Rendimiento' in df_fiscal.columns else ['Ticker', 'Fecha', 'Neto']
                 st.dataframe(df_fiscal[cols_view], hide_index=True, use_container_width=True, height=150)
 
-                pdf_fiscal = generar_informe_fiscal_completo(
-                    reporte_fiscal_log, 
-                    año_seleccionado, 
-                    nombre_titular if nombre_titular else "______________________", 
-                    dni_titular if dni_titular else "______________________"
-                )
-                st.download_button(
-                    label=f"📄 Descargar Informe {año_seleccionado}", 
-                    data=pdf_fiscal, 
-                    file_name=f"Informe_Fiscal_{año_seleccionado}.pdf", 
-                    mime="application/pdf", 
-                    use_container_width=True
-                )
+                # El PDF se genera en segundo plano y se reutiliza mientras no cambien libro, año ni titular
+                clave_pdf = ("fiscal", vista_libro, get_libro_columnar().version(vista_libro), año_seleccionado, nombre_titular, dni_titular)
+                pdf_fiscal = get_cache_informes().leer(clave_pdf)
+                trabajo_pdf = st.session_state.trabajo_pdf
+                estado_pdf = get_gestor_trabajos().estado(trabajo_pdf['id'], con_resultado=False) if trabajo_pdf and trabajo_pdf['clave'] == clave_pdf else None
+                if pdf_fiscal is not None:
+                    with pdf_fiscal: # Se le pasa el fichero, no una copia en bytes
+                        st.download_button(
+                            label=f"📄 Descargar Informe {año_seleccionado}", 
+                            data=pdf_fiscal, 
+                            file_name=f"Informe_Fiscal_{año_seleccionado}.pdf", 
+                            mime="application/pdf", 
+                            use_container_width=True
+                        )
+                elif estado_pdf and estado_pdf['estado'] in ("pendiente", "ejecutando"):
+                    st.caption("⏳ Generando informe...")
+                elif st.button(f"⚙️ Preparar Informe {año_seleccionado}", use_container_width=True):
+                    st.session_state.trabajo_pdf = {'clave': clave_pdf, 'id': get_gestor_trabajos().enviar(
+                        st.session_state.current_user, "pdf", f"Informe fiscal {año_seleccionado}",
+                        generar_informe_fiscal, get_cache_informes(), clave_pdf,
+                        list(reporte_fiscal_log), 
+                        año_seleccionado, 
+                        nombre_titular if nombre_titular else "______________________", 
+                        dni_titular if dni_titular else "______________________"
+                    )}
+                    st.rerun()
         except Exception as e:
             st.error(f"Error PDF: {e}")
         _ = st.divider()
@@ -734,8 +554,8 @@ with st.sidebar:
                 
                 if st.form_submit_button("🔍 Validar y Guardar"):
                     if ticker and dinero_total > 0:
-                        nom, pre, _ = get_stock_data_fmp(ticker)
-                        if not nom: nom, pre, _ = get_stock_data_yahoo(ticker)
+                        nom = get_almacen_metadatos().nombre_empresa(ticker)
+                        pre = get_cache_cotizaciones().obtener([ticker]).get(ticker)
                         nombre_final = desc_manual if desc_manual else (nom if nom else ticker)
                         
                         cantidad_final = float(dinero_total)
@@ -786,8 +606,8 @@ if st.session_state.ticker_detalle:
 
     acc = info.get('acciones', 0)
     with st.spinner("Cargando..."):
-        nom, now, desc = get_stock_data_fmp(t)
-        if not now: nom, now, desc = get_stock_data_yahoo(t)
+        now = get_cache_cotizaciones().obtener([t]).get(t)
+        desc = get_almacen_metadatos().descripcion(t)
     
     valor_mercado_eur, rent = 0.0, 0.0
     fx_actual = 1.0
@@ -827,7 +647,6 @@ if st.session_state.ticker_detalle:
     c_tools = st.columns([2, 1, 3])
     with c_tools[0]:
         label_t = st.select_slider("Periodo", options=["1 Sem", "1 Mes", "6 Meses", "1 Año", "5 Años", "Todo"], value="1 Año", label_visibility="collapsed")
-        periodo_map = {"1 Sem": "5d", "1 Mes": "1mo", "6 Meses": "6mo", "1 Año": "1y", "5 Años": "5y", "Todo": "max"}
         width_map = {"1 Sem": 20, "1 Mes": 10, "6 Meses": 4, "1 Año": 2, "5 Años": 1, "Todo": 1}
     with c_tools[1]:
         type_g = st.radio("Estilo", ["Línea", "Velas", "Barras (OHLC)"], horizontal=True, label_visibility="collapsed")
@@ -843,23 +662,16 @@ if st.session_state.ticker_detalle:
     if i_sma: inds.append("SMA")
     if i_sup: inds.append("Soportes")
     if i_ten: inds.append("Tendencia")
-    sma_p = 50
-    if i_sma: sma_p = c_tools[2].selectbox("Periodo SMA", [5, 10, 20, 50, 100, 200], index=3, label_visibility="collapsed")
+    media = "SMA 50"
+    if i_sma: media = c_tools[2].selectbox("Media", MEDIAS, index=MEDIAS.index("SMA 50"), label_visibility="collapsed")
 
-    hist = pd.DataFrame()
+    hist, niveles = pd.DataFrame(), {'soportes': [], 'resistencias': []}
     try:
-        hist = yf.Ticker(t).history(period=periodo_map[label_t]).reset_index()
-        hist['Date'] = pd.to_datetime(hist['Date']).dt.date
-        hist['Volume'] = pd.to_numeric(hist['Volume'], errors='coerce').fillna(0)
+        hist, niveles = get_motor_indicadores().periodo(t, label_t) # Corte local: cambiar periodo o indicador no descarga ni recalcula
+        if not hist.empty: hist['Date'] = pd.to_datetime(hist['Date']).dt.date
     except: pass
 
     if not hist.empty:
-        if i_sma: hist['SMA'] = hist['Close'].rolling(window=sma_p).mean()
-        if i_ten:
-            hist['Ord'] = pd.to_datetime(hist['Date']).map(datetime.toordinal)
-            x, y = hist['Ord'].values, hist['Close'].values
-            if len(x)>1: m, b = np.polyfit(x,y,1); hist['Trend'] = m*x+b
-        
         stat_max = hist['Close'].max(); stat_min = hist['Close'].min(); stat_avg = hist['Close'].mean()
         last_date = hist['Date'].max()
         df_price_stats = pd.DataFrame([{'Val': stat_max, 'Label': f"Max: {stat_max:.2f}", 'Color': 'green'}, {'Val': stat_min, 'Label': f"Min: {stat_min:.2f}", 'Color': 'red'}, {'Val': stat_avg, 'Label': f"Med: {stat_avg:.2f}", 'Color': 'blue'}])
@@ -891,9 +703,9 @@ if st.session_state.ticker_detalle:
             stats_layers.append(alt.Chart(pd.DataFrame({'x':[r['Date']], 'y':[r['Val']], 't':[r['Label']]})).mark_text(color=r['Color'], align='left', dx=5).encode(x='x', y='y', text='t'))
 
         layers = [main, points, rule_hover] + stats_layers
-        movs_raw = info.get('movimientos', [])
-        if movs_raw:
-            df_m_chart = pd.DataFrame(movs_raw)
+        movs_raw = info.get('movimientos', pd.DataFrame())
+        if not movs_raw.empty:
+            df_m_chart = movs_raw.copy()
             df_m_chart['Date'] = pd.to_datetime(df_m_chart['Fecha_Raw']).dt.date
             df_m_chart = df_m_chart[df_m_chart['Date'] >= hist['Date'].min()]
             if not df_m_chart.empty:
@@ -902,7 +714,12 @@ if st.session_state.ticker_detalle:
                 ventas = df_m_chart[df_m_chart['Tipo'] == 'Venta']
                 if not ventas.empty: layers.append(alt.Chart(ventas).mark_point(shape='triangle', size=100, color='red', filled=True).encode(x='Date:T', y='Precio', tooltip=['Date', 'Precio', 'Cantidad']))
 
-        if i_sma: layers.append(base.mark_line(color='orange', strokeDash=[2,2]).encode(y='SMA'))
+        if i_sma: layers.append(base.mark_line(color='orange', strokeDash=[2,2]).encode(y=alt.Y(f'{media}:Q', title=media)))
+        if i_sup:
+            df_niveles = pd.DataFrame([{'y': v, 'Tipo': 'Soporte'} for v in niveles['soportes']] + [{'y': v, 'Tipo': 'Resistencia'} for v in niveles['resistencias']])
+            if not df_niveles.empty:
+                color_nivel = alt.Color('Tipo:N', scale=alt.Scale(domain=['Soporte', 'Resistencia'], range=['#00C805', '#FF0000']), legend=None)
+                layers.append(alt.Chart(df_niveles).mark_rule(strokeDash=[6,3], opacity=0.7).encode(y='y:Q', color=color_nivel, tooltip=[alt.Tooltip('Tipo'), alt.Tooltip('y', title='Nivel', format=',.2f')]))
         if i_ten and 'Trend' in hist: layers.append(base.mark_line(color='purple').encode(y='Trend'))
 
         chart_final = alt.layer(*layers).properties(height=400, width='container')
@@ -933,9 +750,8 @@ if st.session_state.ticker_detalle:
 
     with st.expander("📖 Descripción"): st.write(desc if desc else "N/A")
     st.subheader("📝 Movimientos Históricos")
-    if info['movimientos']:
-        df_m = pd.DataFrame(info['movimientos'])
-        df_m = df_m.sort_values(by='Fecha_dt', ascending=False)
+    if not info.get('movimientos', pd.DataFrame()).empty:
+        df_m = info['movimientos'].sort_values(by='Fecha_dt', ascending=False)
         cols_ver = ['Fecha_str', 'Ticker', 'Tipo', 'Cantidad', 'Precio', 'Moneda', 'Comision', 'Cambio']
         for c in cols_ver:
             if c not in df_m.columns: df_m[c] = None
@@ -948,19 +764,18 @@ else:
     tabla = []
     valor_total_cartera = 0.0
     
-    # --- PRECIO CACHÉ PARA FIFO GLOBAL ---
-    cache_precios_dashboard = {} 
-
+    # --- PRECIOS EN LOTE (cartera + FIFO global en una sola llamada) ---
+    tickers_vivos = [t for t, i in cartera.items() if i['acciones'] > 0.001]
+    tickers_vivos += [t for t, lotes in colas_fifo.items() if lotes and t not in tickers_vivos]
     with st.spinner("Conectando con el mercado..."):
+        cache_precios_dashboard = get_cache_cotizaciones().obtener(tickers_vivos)
+
         for t, i in cartera.items():
             alive = i['acciones'] > 0.001
             act = abs(i['pnl_cerrado']) > 0.01
             if (ver_solo_activas and alive) or (not ver_solo_activas and (alive or act)):
                 p_now = 0
-                if i['acciones'] > 0.001:
-                    _, p_now, _ = get_stock_data_fmp(t)
-                    if not p_now: _, p_now, _ = get_stock_data_yahoo(t)
-                    cache_precios_dashboard[t] = p_now # Guardamos para usar en la tabla FIFO de abajo
+                if i['acciones'] > 0.001: p_now = cache_precios_dashboard.get(t, 0)
 
                 val = i['acciones'] * p_now if p_now else 0
                 valor_total_cartera += val
@@ -988,18 +803,24 @@ else:
     m3.metric("Dividendos", fmt_dinamico(total_div, '€'))
     m4.metric("Comisiones", f"-{fmt_dinamico(total_comi, '€')}")
 
-    if roi_log:
+    if len(totales_por_año) > 1:
+        with st.expander("🗓️ Comparar Ejercicios", expanded=False):
+            df_años = pd.DataFrame.from_dict(totales_por_año, orient='index').sort_index(ascending=False)
+            df_años['Bº Neto'] = df_años['pnl_cerrado'] + df_años['total_div'] - df_años['total_comi']
+            df_años['ROI %'] = (df_años['Bº Neto'] / df_años['compras_eur'].where(df_años['compras_eur'] > 0) * 100).fillna(0.0)
+            df_años = df_años.rename(columns={'pnl_cerrado': 'Trading', 'total_div': 'Dividendos', 'total_comi': 'Comisiones', 'compras_eur': 'Compras', 'ventas_coste': 'Coste Ventas'})
+            df_años.index.name = 'Año'
+            st.dataframe(
+                df_años[['Bº Neto', 'ROI %', 'Trading', 'Dividendos', 'Comisiones', 'Compras', 'Coste Ventas']].style.format(lambda x: fmt_num_es(x)),
+                use_container_width=True
+            )
+
+    if len(roi_log['fecha']):
         with st.expander("📈 Ver Evolución ROI", expanded=False):
-            df_r = pd.DataFrame(roi_log)
-            df_r['Fecha'] = pd.to_datetime(df_r['Fecha'])
-            if año_seleccionado != "Todos los años": df_r = df_r[df_r['Year'] == int(año_seleccionado)]
-            if not df_r.empty:
-                df_r.set_index('Fecha', inplace=True)
-                df_w = df_r.resample('W').sum().fillna(0)
-                df_w['Cum_P'] = df_w['Delta_Profit'].cumsum()
-                df_w['Cum_I'] = df_w['Delta_Invest'].cumsum()
-                df_w['ROI'] = df_w.apply(lambda x: (x['Cum_P']/x['Cum_I']*100) if x['Cum_I']>0 else 0, axis=1)
-                df_w = df_w.reset_index()
+            granularidad = st.radio("Granularidad", GRANULARIDADES_ROI, index=1, horizontal=True, label_visibility="collapsed", key="cfg_granularidad_roi")
+            # Serie derivada del estado del motor: se cachea con él y caduca con él
+            df_w = get_cache_regiones().obtener("motor", (clave_motor, "roi", granularidad, año_seleccionado), lambda: serie_roi(roi_log, granularidad, año_seleccionado), medir=lambda d: int(d.memory_usage().sum()))
+            if not df_w.empty:
                 ymin, ymax = df_w['ROI'].min(), df_w['ROI'].max()
                 stops = [alt.GradientStop(color='#00C805', offset=0), alt.GradientStop(color='#00C805', offset=1)]
                 if ymax <= 0: stops = [alt.GradientStop(color='#FF0000', offset=0), alt.GradientStop(color='#FF0000', offset=1)]
@@ -1009,11 +830,28 @@ else:
                 rule_zero = alt.Chart(pd.DataFrame({'y':[0]})).mark_rule(color='black', strokeDash=[2,2]).encode(y='y')
                 st.altair_chart((area + rule_zero), use_container_width=True)
 
+    with st.expander("💹 Evolución del Valor de la Cartera", expanded=False):
+        # El primer cálculo descarga en bloque el histórico de todos los tickers: sólo bajo demanda
+        if st.toggle("Calcular con el histórico de precios", value=False, key="cfg_curva_valor"):
+            with st.spinner("Valorando la cartera día a día..."):
+                df_valor = get_curvas_valor().obtener(clave_motor, calcular_curva_valor)
+            if año_seleccionado != "Todos los años": df_valor = df_valor[df_valor['Fecha'].dt.year == int(año_seleccionado)]
+            if df_valor['Sin_cambio'].any():
+                st.caption(f"💱 {int(df_valor['Sin_cambio'].sum())} días sin valorar: falta el histórico de cambio de alguna divisa en cartera.")
+                df_valor = df_valor[~df_valor['Sin_cambio']]
+            if not df_valor.empty:
+                base_valor = alt.Chart(df_valor).encode(x=alt.X('Fecha:T', title='Fecha'))
+                area_valor = base_valor.mark_area(opacity=0.5, line={'color': '#29b5e8'}, color='#29b5e8').encode(y=alt.Y('Valor:Q', title='Valor (€)'), tooltip=[alt.Tooltip('Fecha:T'), alt.Tooltip('Valor:Q', format=',.2f')])
+                st.altair_chart(area_valor, use_container_width=True)
+
     _ = st.divider()
     if tabla:
         st.subheader("📊 Mi Portafolio") 
         if vista_movil:
-            for row in tabla:
+            # Tarjetas paginadas: sólo se envían al navegador las de la página visible
+            n_paginas = max(1, -(-len(tabla) // TARJETAS_POR_PAGINA))
+            pagina = st.number_input(f"Página (de {n_paginas})", min_value=1, max_value=n_paginas, value=1, step=1, key="pag_cartera_movil") if n_paginas > 1 else 1
+            for row in tabla[(pagina - 1) * TARJETAS_POR_PAGINA:pagina * TARJETAS_POR_PAGINA]:
                 with st.container(border=True):
                     c_top_1, c_top_2 = st.columns([1, 4])
                     with c_top_1: st.image(row["Logo"], width=50)
@@ -1027,27 +865,24 @@ else:
                         st.session_state.ticker_detalle = row['Ticker']
                         st.rerun()
         else:
-            c = st.columns([0.6, 0.8, 1.5, 0.8, 1, 1, 1, 1, 0.8, 0.5])
-            titles = ["Logo", "Ticker", "Empresa", "Acciones", "PMC", "Invertido", "Valor", "% Latente", "Trading", "Ver"]
-            for i, title in enumerate(titles): _ = c[i].markdown(f"**{title}**")
-            for row in tabla:
-                c = st.columns([0.6, 0.8, 1.5, 0.8, 1, 1, 1, 1, 0.8, 0.5])
-                with c[0]: st.image(row["Logo"], width=30)
-                with c[1]: st.write(f"**{row['Ticker']}**")
-                with c[2]: st.caption(row["Empresa"])
-                with c[3]: st.write(fmt_dinamico(row['Acciones']))
-                with c[4]: st.write(fmt_dinamico(row['PMC'], '€'))
-                with c[5]: st.write(fmt_dinamico(row['Invertido'], '€'))
-                with c[6]: st.write(f"**{fmt_dinamico(row['Valor'], '€')}**") 
-                color_lat = "green" if row['Latente'] >= 0 else "red"
-                with c[7]: st.markdown(f":{color_lat}[{fmt_num_es(row['Latente']*100)}%]")
-                color_trad = "green" if row['Trading'] >= 0 else "red"
-                with c[8]: st.markdown(f":{color_trad}[{fmt_dinamico(row['Trading'], '€')}]")
-                with c[9]:
-                    if st.button("🔍", key=f"btn_{row['Ticker']}"): 
-                        st.session_state.ticker_detalle = row['Ticker']
-                        st.rerun()
-                _ = st.divider()
+            # Una sola tabla para toda la cartera: el coste de pintar no crece con el nº de posiciones
+            df_tabla = pd.DataFrame(tabla)[["Logo", "Ticker", "Empresa", "Acciones", "PMC", "Invertido", "Valor", "Latente", "Trading"]]
+            df_tabla['Latente'] = df_tabla['Latente'] * 100
+            def color_signo(v): return f"color: {'#00C805' if v >= 0 else '#FF0000'}"
+            estilo_tabla = df_tabla.style.format({
+                "Acciones": lambda x: fmt_dinamico(x), "PMC": lambda x: fmt_dinamico(x, '€'), "Invertido": lambda x: fmt_dinamico(x, '€'),
+                "Valor": lambda x: fmt_dinamico(x, '€'), "Latente": lambda x: fmt_num_es(x) + "%", "Trading": lambda x: fmt_dinamico(x, '€')
+            }).map(color_signo, subset=["Latente", "Trading"])
+            seleccion = st.dataframe(
+                estilo_tabla, use_container_width=True, hide_index=True, key="tabla_cartera",
+                on_select="rerun", selection_mode="single-row",
+                column_config={"Logo": st.column_config.ImageColumn("", width="small"), "Latente": "% Latente"}
+            )
+            st.caption("Selecciona una fila para ver la ficha detallada.")
+            filas = seleccion.selection.rows if seleccion else []
+            if filas:
+                st.session_state.ticker_detalle = df_tabla.iloc[filas[0]]['Ticker']
+                st.rerun()
     
     # --- NUEVA SECCIÓN: TABLA FIFO GLOBAL ---
     st.divider()
@@ -1057,12 +892,8 @@ else:
         for t, lotes in colas_fifo.items():
             if not lotes: continue
             
-            # Recuperamos precio actual si lo tenemos del bucle anterior, si no (raro), buscamos
+            # Precio actual de la consulta en lote de arriba
             p_now = cache_precios_dashboard.get(t, 0)
-            if p_now == 0:
-                 # Fallback por si acaso
-                 _, p_now, _ = get_stock_data_fmp(t)
-                 if not p_now: _, p_now, _ = get_stock_data_yahoo(t)
 
             moneda = cartera[t].get('moneda_origen', 'EUR')
             fx = 1.0
@@ -1112,12 +943,20 @@ else:
     st.subheader("📜 Historial")
     if not df.empty:
         c1, c2, c3 = st.columns([1, 1, 6])
-        with c1: st.download_button("Descargar CSV", df.to_csv(index=False).encode('utf-8'), "historial.csv")
+        with c1: formato_export = st.selectbox("Formato", exportaciones.formatos_disponibles(), label_visibility="collapsed")
         try: 
             with c2: 
-                st.download_button("Descargar PDF", generar_pdf_historial(df, f"Historial {año_seleccionado}"), f"historial.pdf")
-        except: 
-            pass
+                # Cada formato sólo se genera al pedirlo y queda cacheado para esta versión del libro
+                clave_export = ("historial", formato_export, vista_libro, get_libro_columnar().version(vista_libro), año_seleccionado)
+                datos_export = get_cache_informes().leer(clave_export)
+                if datos_export is None and st.button("Preparar"):
+                    with st.spinner(f"Generando {formato_export}..."):
+                        get_cache_informes().generar(clave_export, lambda destino: exportaciones.exportar(df, formato_export, destino, f"Historial {año_seleccionado}"))
+                    datos_export = get_cache_informes().leer(clave_export)
+                if datos_export is not None:
+                    with datos_export: st.download_button(f"Descargar {formato_export}", datos_export, exportaciones.nombre_archivo("historial", formato_export), mime=exportaciones.mime(formato_export))
+        except Exception as e: 
+            st.error(f"Error exportando: {e}")
         cols_display = ['Fecha_str', 'Ticker', 'Tipo', 'Cantidad', 'Precio', 'Moneda', 'Comision', 'Cambio']
         df_sorted_main = df.sort_values(by='Fecha_dt', ascending=False)
         st.dataframe(df_sorted_main[cols_display], use_container_width=True, hide_index=True)
@@ -0,0 +1,77 @@
+import threading
+import time
+from collections import OrderedDict
+
+MAX_ENTRADAS_REGION = 500
+
+class CacheRegiones:
+    """Caché de proceso dividida en regiones con nombre ('libro', 'cambio_actual', ...).
+
+    Cada región tiene su TTL y su límite LRU (en entradas y, si se indica, en bytes), y se
+    invalida por clave: guardar una operación sólo descarta el libro de ese usuario, no los
+    cambios ni el libro de los demás. Cada invalidación sube la generación de la clave (o de la
+    región): una carga que empezó antes no se guarda al terminar.
+    """
+
+    def __init__(self, ttls, max_entradas=MAX_ENTRADAS_REGION, max_bytes=None):
+        self.ttls, self.max_entradas = dict(ttls), max_entradas
+        self.max_bytes = dict(max_bytes or {})
+        self._regiones = {nombre: OrderedDict() for nombre in self.ttls}
+        self._bytes = dict.fromkeys(self.ttls, 0)
+        self._lock = threading.Lock()
+        self._cargando = {}
+        self._generaciones = {}                                 # (region, clave) -> invalidaciones de la clave
+        self._generaciones_region = dict.fromkeys(self.ttls, 0) # region -> invalidaciones de la región entera
+
+    def obtener(self, region, clave, cargar, medir=None):
+        """Valor vigente de (region, clave); si falta o caducó se llama a `cargar()` una sola vez.
+
+        `medir(valor)` estima su tamaño en bytes para las regiones con límite de memoria.
+        """
+        datos = self._regiones[region]
+        with self._lock:
+            entrada = datos.get(clave)
+            if entrada is not None and time.monotonic() - entrada[1] < self.ttls[region]:
+                datos.move_to_end(clave)
+                return entrada[0]
+            lock_clave = self._cargando.setdefault((region, clave), threading.Lock())
+        # Varias sesiones pidiendo la misma clave a la vez: carga una, las demás esperan su resultado
+        with lock_clave:
+            with self._lock:
+                entrada = datos.get(clave)
+                if entrada is not None and time.monotonic() - entrada[1] < self.ttls[region]: return entrada[0]
+                generacion = self._generacion(region, clave)
+            valor = cargar()
+            tamaño = medir(valor) if medir else 0
+            with self._lock:
+                if self._generacion(region, clave) != generacion: # Invalidada durante la carga: no se guarda
+                    self._cargando.pop((region, clave), None)
+                    return valor
+                self._quitar(region, clave)
+                datos[clave] = (valor, time.monotonic(), tamaño)
+                self._bytes[region] += tamaño
+                limite = self.max_bytes.get(region)
+                while len(datos) > self.max_entradas or (limite and self._bytes[region] > limite and len(datos) > 1):
+                    self._quitar(region, next(iter(datos)))
+                self._cargando.pop((region, clave), None)
+            return valor
+
+    def _generacion(self, region, clave):
+        return self._generaciones_region[region], self._generaciones.get((region, clave), 0)
+
+    def _quitar(self, region, clave):
+        entrada = self._regiones[region].pop(clave, None)
+        if entrada is not None: self._bytes[region] -= entrada[2]
+
+    def invalidar(self, region, claves=None):
+        """Descarta `claves` de la región (o la región entera si es None)."""
+        with self._lock:
+            if claves is None:
+                self._regiones[region].clear()
+                self._bytes[region] = 0
+                self._generaciones_region[region] += 1
+                for k in [k for k in self._generaciones if k[0] == region]: del self._generaciones[k]
+            else:
+                for clave in claves:
+                    self._quitar(region, clave)
+                    self._generaciones[(region, clave)] = self._generaciones.get((region, clave), 0) + 1
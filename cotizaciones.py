@@ -0,0 +1,110 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import yfinance as yf
+
+URL_FMP_QUOTE = "https://financialmodelingprep.com/api/v3/quote/{}?apikey={}"
+MAX_HILOS = 8        # Peticiones simultáneas a Yahoo como máximo
+TAM_LOTE_FMP = 50    # Tickers por llamada al endpoint batch de FMP
+TTL_COTIZACIONES = 60        # Segundos antes de considerar un precio caducado
+MAX_COTIZACIONES = 2000      # Entradas máximas de la caché (LRU)
+
+# --- PRECIOS EN LOTE ---
+def precios_fmp(tickers, api_key, tam_lote=TAM_LOTE_FMP):
+    """Precio actual vía el endpoint batch `quote` de FMP (una llamada por cada `tam_lote` tickers)."""
+    precios = {}
+    if not api_key: return precios
+    for i in range(0, len(tickers), tam_lote):
+        lote = tickers[i:i + tam_lote]
+        try:
+            resp = requests.get(URL_FMP_QUOTE.format(",".join(lote), api_key), timeout=5)
+            if resp.status_code == 200:
+                for q in resp.json() or []:
+                    if q.get('symbol') in lote and q.get('price'): precios[q['symbol']] = q['price']
+        except: pass
+    return precios
+
+def precio_yahoo(ticker):
+    """Sólo el precio (sin `.info` ni traducción): fast_info y, si falla, el último cierre."""
+    try:
+        stock = yf.Ticker(ticker)
+        try:
+            precio = stock.fast_info.last_price
+            if precio: return precio
+        except: pass
+        hist = stock.history(period="1d")
+        if not hist.empty: return hist['Close'].iloc[-1]
+    except: pass
+    return None
+
+def obtener_precios(tickers, api_key=None, max_hilos=MAX_HILOS):
+    """Precios de todos los `tickers` de una vez: batch FMP y, para los que falten, Yahoo en paralelo.
+
+    Devuelve {ticker: precio}; los tickers sin cotización no aparecen.
+    """
+    tickers = list(dict.fromkeys(t for t in tickers if t))
+    precios = precios_fmp(tickers, api_key)
+    faltan = [t for t in tickers if t not in precios]
+    if faltan:
+        with ThreadPoolExecutor(max_workers=min(max_hilos, len(faltan))) as pool:
+            for t, p in zip(faltan, pool.map(precio_yahoo, faltan)):
+                if p: precios[t] = p
+    return precios
+
+# --- CACHÉ COMPARTIDA (TTL + LRU + stale-while-revalidate) ---
+class CacheCotizaciones:
+    """Caché de precios por ticker compartida por todo el proceso (todas las sesiones y usuarios).
+
+    Un precio caducado se sirve al momento y se refresca en segundo plano; sólo los tickers
+    nunca vistos bloquean. No depende de `st.cache_data`, así que sobrevive a sus `clear()`.
+    """
+
+    def __init__(self, api_key=None, ttl=TTL_COTIZACIONES, max_entradas=MAX_COTIZACIONES, max_hilos=MAX_HILOS):
+        self.api_key, self.ttl, self.max_entradas, self.max_hilos = api_key, ttl, max_entradas, max_hilos
+        self._datos = OrderedDict()   # ticker -> (precio | None, instante)
+        self._refrescando = set()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="refresco-cotizaciones")
+
+    def _descargar(self, tickers):
+        precios = obtener_precios(tickers, self.api_key, self.max_hilos)
+        ahora = time.monotonic()
+        with self._lock:
+            for t in tickers:
+                self._datos[t] = (precios.get(t), ahora)   # también se recuerda "sin cotización"
+                self._datos.move_to_end(t)
+            while len(self._datos) > self.max_entradas: self._datos.popitem(last=False)
+        return precios
+
+    def _refrescar(self, tickers):
+        try: self._descargar(tickers)
+        except: pass
+        finally:
+            with self._lock: self._refrescando.difference_update(tickers)
+
+    def obtener(self, tickers):
+        """{ticker: precio} para `tickers`; los que no tienen cotización no aparecen."""
+        ahora = time.monotonic()
+        resultado, faltan, caducados = {}, [], []
+        with self._lock:
+            for t in dict.fromkeys(t for t in tickers if t):
+                entrada = self._datos.get(t)
+                if entrada is None:
+                    faltan.append(t)
+                    continue
+                self._datos.move_to_end(t)
+                if entrada[0]: resultado[t] = entrada[0]
+                if ahora - entrada[1] > self.ttl and t not in self._refrescando: caducados.append(t)
+            self._refrescando.update(caducados)
+        if caducados: self._pool.submit(self._refrescar, caducados)
+        if faltan: resultado.update(self._descargar(faltan))
+        return resultado
+
+    def invalidar(self, tickers=None):
+        with self._lock:
+            if tickers is None: self._datos.clear()
+            else:
+                for t in tickers: self._datos.pop(t, None)
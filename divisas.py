@@ -0,0 +1,129 @@
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import yfinance as yf
+
+from almacen_local import conectar
+
+MONEDA_BASE = "EUR"
+ARCHIVO_DIVISAS = "divisas.sqlite"
+DIAS_RETROCESO = 3        # Fin de semana / festivo: se usa el último cierre de los 3 días anteriores
+MARGEN_DESCARGA = 7       # Días extra al descargar, para que el primer día del rango tenga retroceso
+REINTENTO_HOY = 600       # Segundos entre reintentos del tramo que incluye hoy (cierre aún abierto) o de una descarga fallida
+
+def ticker_par(moneda, base=MONEDA_BASE):
+    return f"{base}=X" if moneda == "USD" else f"{moneda}{base}=X"
+
+def _cierres(data):
+    if data is None or data.empty: return pd.Series(dtype=float)
+    cierre = data['Close']
+    if isinstance(cierre, pd.DataFrame): cierre = cierre.iloc[:, 0]
+    cierre = cierre.dropna()
+    cierre.index = pd.DatetimeIndex(cierre.index).tz_localize(None).normalize()
+    return cierre.astype(float)
+
+class AlmacenDivisas:
+    """Series históricas de cambio a EUR por divisa: SQLite en disco y copia en memoria.
+
+    Cada par se descarga con una sola petición por tramo que falte; después las consultas
+    (fecha, moneda) se resuelven en memoria.
+    """
+
+    def __init__(self, nombre=ARCHIVO_DIVISAS):
+        self.nombre = nombre
+        self._series, self._intentos_hoy, self._fallos = {}, {}, {}
+        self._lock = threading.RLock()
+        with conectar(self.nombre) as con:
+            con.execute("CREATE TABLE IF NOT EXISTS cambios (par TEXT, fecha TEXT, cierre REAL, PRIMARY KEY (par, fecha))")
+            con.execute("CREATE TABLE IF NOT EXISTS cobertura (par TEXT PRIMARY KEY, desde TEXT, hasta TEXT)")
+
+    def _cobertura(self, par):
+        with conectar(self.nombre) as con:
+            fila = con.execute("SELECT desde, hasta FROM cobertura WHERE par=?", (par,)).fetchone()
+        return (pd.Timestamp(fila[0]), pd.Timestamp(fila[1])) if fila else None
+
+    def serie(self, moneda):
+        """Serie de cierres (índice diario normalizado) ya descargada para `moneda`."""
+        par = ticker_par(moneda)
+        with self._lock:
+            if par not in self._series:
+                with conectar(self.nombre) as con:
+                    filas = con.execute("SELECT fecha, cierre FROM cambios WHERE par=? ORDER BY fecha", (par,)).fetchall()
+                self._series[par] = pd.Series([c for _, c in filas], index=pd.DatetimeIndex([f for f, _ in filas]), dtype=float)
+            return self._series[par]
+
+    def _descargar(self, par, desde, hasta):
+        """Cierres de [desde, hasta]; None si la descarga falla. yfinance no lanza error al fallar
+        sino que devuelve un DataFrame vacío: sin cierres en un tramo con días hábiles también es fallo."""
+        try: data = yf.download(par, start=desde.date(), end=(hasta + pd.Timedelta(days=1)).date(), progress=False)
+        except: return None
+        cierres = _cierres(data)
+        if cierres.empty and len(pd.bdate_range(desde, hasta)): return None
+        return cierres
+
+    def asegurar_rango(self, moneda, desde, hasta):
+        """Garantiza datos de [desde, hasta] descargando sólo los tramos que falten (uno por lado)."""
+        if moneda == MONEDA_BASE: return
+        par = ticker_par(moneda)
+        hoy = pd.Timestamp.now().normalize()
+        desde = pd.Timestamp(desde).normalize() - pd.Timedelta(days=MARGEN_DESCARGA)
+        hasta = min(pd.Timestamp(hasta).normalize(), hoy)
+        with self._lock:
+            cob = self._cobertura(par)
+            tramos = []
+            if cob is None: tramos.append((desde, hasta))
+            else:
+                if desde < cob[0]: tramos.append((desde, cob[0]))
+                if hasta > cob[1]: tramos.append((cob[1], hasta))
+            if not tramos: return
+            # Tras una descarga fallida no se reintenta el par hasta pasados REINTENTO_HOY segundos
+            if time.monotonic() - self._fallos.get(par, -1e9) < REINTENTO_HOY: return
+            # El tramo que llega a hoy se reintenta como mucho cada REINTENTO_HOY segundos
+            if tramos[-1][1] >= hoy and time.monotonic() - self._intentos_hoy.get(par, -1e9) < REINTENTO_HOY:
+                tramos = tramos[:-1]
+                if not tramos: return
+            nuevos = []
+            for a, b in tramos:
+                if b >= hoy: self._intentos_hoy[par] = time.monotonic()
+                cierres = self._descargar(par, a, b)
+                if cierres is None:
+                    self._fallos[par] = time.monotonic()  # Sin cobertura nueva: el rango se volverá a pedir
+                    return
+                nuevos.append(cierres)
+            self._fallos.pop(par, None)
+            nuevos = pd.concat(nuevos) if nuevos else pd.Series(dtype=float)
+            nuevo_desde = min(desde, cob[0]) if cob else desde
+            # Hoy no cuenta como cubierto: su cierre aún puede cambiar
+            nuevo_hasta = max(min(hasta, hoy - pd.Timedelta(days=1)), cob[1] if cob else nuevo_desde)
+            with conectar(self.nombre) as con:
+                con.executemany("INSERT OR REPLACE INTO cambios VALUES (?, ?, ?)",
+                                [(par, f.strftime('%Y-%m-%d'), float(c)) for f, c in nuevos.items()])
+                con.execute("INSERT OR REPLACE INTO cobertura VALUES (?, ?, ?)", (par, nuevo_desde.isoformat(), nuevo_hasta.isoformat()))
+            self._series.pop(par, None)
+
+    def asegurar_rangos(self, rangos, progreso=None):
+        """Descarga en bloque {moneda: (desde, hasta)}; pensado para lanzarse como trabajo en segundo plano."""
+        rangos = {m: r for m, r in rangos.items() if m != MONEDA_BASE}
+        for i, (moneda, (desde, hasta)) in enumerate(rangos.items(), 1):
+            self.asegurar_rango(moneda, desde, hasta)
+            if progreso: progreso(i, len(rangos), moneda)
+        return sorted(rangos)
+
+    def cambios(self, fechas, moneda):
+        """Cambio a EUR para cada fecha (vectorizado): último cierre en [fecha - 3 días, fecha]; 1.0 si no hay."""
+        fechas = pd.DatetimeIndex(pd.to_datetime(fechas)).normalize()
+        if moneda == MONEDA_BASE or len(fechas) == 0: return np.ones(len(fechas))
+        serie = self.serie(moneda)
+        if serie.empty: return np.ones(len(fechas))
+        pos = serie.index.searchsorted(fechas, side='right') - 1
+        valido = pos >= 0
+        pos_ok = np.where(valido, pos, 0)
+        valido &= (fechas - serie.index[pos_ok]).days <= DIAS_RETROCESO
+        return np.where(valido, serie.to_numpy()[pos_ok], 1.0)
+
+    def cambio(self, fecha, moneda):
+        if moneda == MONEDA_BASE: return 1.0
+        self.asegurar_rango(moneda, fecha, fecha)
+        return float(self.cambios([fecha], moneda)[0])
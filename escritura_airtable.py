@@ -0,0 +1,90 @@
+import threading
+import time
+
+LIMITE_AIRTABLE_RPS = 5     # Airtable admite 5 peticiones/segundo por base
+TAM_LOTE_AIRTABLE = 10      # Máximo de registros por batch_create
+REINTENTOS = 4
+
+# --- LIMITADOR TOKEN BUCKET ---
+class LimitadorTokens:
+    """Token bucket: `tasa` peticiones/segundo con ráfagas de hasta `capacidad`. Compartible entre hilos."""
+
+    def __init__(self, tasa=LIMITE_AIRTABLE_RPS, capacidad=LIMITE_AIRTABLE_RPS):
+        self.tasa, self.capacidad = float(tasa), float(capacidad)
+        self._tokens, self._ultimo = self.capacidad, time.monotonic()
+        self._lock = threading.Lock()
+
+    def esperar(self):
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self._tokens = min(self.capacidad, self._tokens + (ahora - self._ultimo) * self.tasa)
+                self._ultimo = ahora
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                espera = (1 - self._tokens) / self.tasa
+            time.sleep(espera)
+
+def _estado_http(error):
+    resp = getattr(error, 'response', None)
+    return getattr(resp, 'status_code', None)
+
+def _reintentable(error):
+    """429 o 5xx devuelto por Airtable: la petición no se aplicó y puede repetirse."""
+    estado = _estado_http(error)
+    return estado is not None and (estado == 429 or estado >= 500)
+
+def _respuesta_perdida(error):
+    """Timeout o conexión cortada (requests los lanza como OSError): el lote pudo crearse igualmente."""
+    return _estado_http(error) is None and isinstance(error, OSError)
+
+def _crear_con_reintentos(table, registros, limitador, reintentos, comprobar=None, excluidos=frozenset()):
+    """(creados, error): el registro creado de cada fila (None si no se creó) y el último error.
+
+    `batch_create` no es idempotente: sólo se repiten los 429/5xx. Si se pierde la respuesta,
+    `comprobar(registros, excluidos)` relee qué filas llegaron a Airtable y se reenvían las demás;
+    sin `comprobar` no se reintenta, para no duplicarlas.
+    """
+    creados, espera = [None] * len(registros), 1.0
+    for intento in range(reintentos + 1):
+        pendientes = [i for i, c in enumerate(creados) if c is None]
+        limitador.esperar()
+        try:
+            for i, c in zip(pendientes, table.batch_create([registros[i] for i in pendientes])): creados[i] = c
+            return creados, None
+        except Exception as e:
+            perdida = _respuesta_perdida(e) and comprobar is not None
+            if intento == reintentos or not (_reintentable(e) or perdida): return creados, e
+            time.sleep(30.0 if _estado_http(e) == 429 else espera)  # 429: Airtable pide 30 s de pausa
+            espera *= 2
+            if perdida:
+                limitador.esperar()
+                try: ya_creados = comprobar([registros[i] for i in pendientes], excluidos)
+                except Exception: return creados, e  # Sin saber qué llegó, reenviar podría duplicar
+                for i, c in zip(pendientes, ya_creados): creados[i] = c
+                if all(creados): return creados, None
+
+# --- ESCRITURA EN LOTES ---
+def crear_en_lotes(table, registros, limitador=None, tam_lote=TAM_LOTE_AIRTABLE, reintentos=REINTENTOS, progreso=None, comprobar=None):
+    """Crea `registros` con `batch_create` en lotes de 10, respetando el límite de Airtable.
+
+    Devuelve un resultado por fila: {'fila', 'ok', 'id', 'error'}. Si un lote falla (p. ej. 422
+    por un campo inválido, o un 5xx que no se recupera) se reintenta fila a fila para aislar la
+    que falla; si se perdió la respuesta no, porque el lote pudo crearse. `comprobar` es el de
+    `_crear_con_reintentos`. `progreso(hechas, total)` se llama tras cada lote.
+    """
+    limitador = limitador or LimitadorTokens()
+    resultados, total, ids_creados = [], len(registros), set()
+    for inicio in range(0, total, tam_lote):
+        lote = registros[inicio:inicio + tam_lote]
+        creados, error = _crear_con_reintentos(table, lote, limitador, reintentos, comprobar, ids_creados)
+        errores = dict.fromkeys((i for i, c in enumerate(creados) if c is None), error)
+        if error is not None and len(errores) > 1 and not _respuesta_perdida(error):
+            for i in errores:
+                (creados[i],), errores[i] = _crear_con_reintentos(table, [lote[i]], limitador, reintentos, comprobar, ids_creados)
+        for i, c in enumerate(creados):
+            if c is not None: ids_creados.add(c.get('id'))
+            resultados.append({'fila': inicio + i, 'ok': c is not None, 'id': c and c.get('id'), 'error': None if c is not None else str(errores[i])})
+        if progreso: progreso(min(inicio + tam_lote, total), total)
+    return resultados
@@ -0,0 +1,37 @@
+from informes_pdf import pdf_historial
+
+# --- INTENTO DE IMPORTAR MOTOR XLSX (opcional) ---
+try:
+    import openpyxl  # noqa: F401
+    MOTOR_XLSX = "openpyxl"
+except ImportError:
+    try:
+        import xlsxwriter  # noqa: F401
+        MOTOR_XLSX = "xlsxwriter"
+    except ImportError:
+        MOTOR_XLSX = None
+
+# Formato -> (extensión, mime)
+FORMATOS = {
+    "CSV": ("csv", "text/csv"),
+    "PDF": ("pdf", "application/pdf"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+    "XLSX": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
+
+def formatos_disponibles():
+    return [f for f in FORMATOS if f != "XLSX" or MOTOR_XLSX]
+
+def nombre_archivo(base, formato):
+    return f"{base}.{FORMATOS[formato][0]}"
+
+def mime(formato):
+    return FORMATOS[formato][1]
+
+def exportar(df, formato, destino, titulo=""):
+    """Escribe `df` en `destino` (fichero binario) en el formato pedido. Todos salen del mismo DataFrame."""
+    if formato == "CSV": destino.write(df.to_csv(index=False).encode('utf-8'))
+    elif formato == "Parquet": df.to_parquet(destino, index=False)
+    elif formato == "XLSX": df.to_excel(destino, index=False, engine=MOTOR_XLSX)
+    elif formato == "PDF": pdf_historial(df, titulo, destino)
+    else: raise ValueError(f"Formato no soportado: {formato}")
@@ -0,0 +1,12 @@
+# --- FORMATO DE NÚMEROS (estilo español: 1.234,56) ---
+def fmt_dinamico(valor, sufijo="", decimales=3):
+    if valor is None: return ""
+    s = f"{valor:,.{decimales}f}" 
+    s = s.replace(",", "X").replace(".", ",").replace("X", ".")
+    if "," in s: s = s.rstrip('0').rstrip(',')
+    if s == "": s = "0"
+    return f"{s} {sufijo}"
+
+def fmt_num_es(valor):
+    if valor is None: return "0,00"
+    return f"{valor:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
@@ -0,0 +1,186 @@
+import itertools
+import threading
+import time
+
+import pandas as pd
+import yfinance as yf
+
+from almacen_local import conectar
+
+ARCHIVO_HISTORICO = "historico_precios.sqlite"
+COLUMNAS_OHLCV = ['Open', 'High', 'Low', 'Close', 'Volume']
+CIERRE_REAL = 'Raw Close'         # Cierre sin ajustar por dividendos: el precio al que cotizó ese día
+COLUMNAS_BARRAS = COLUMNAS_OHLCV + [CIERRE_REAL]
+REINTENTO_ACTUALIZACION = 600   # Segundos entre peticiones de barras nuevas de un mismo ticker
+TOLERANCIA_AJUSTE = 1e-6        # Una barra ya cerrada que cambia (salvo redondeo) indica split/dividendo: se recarga todo.
+                                # Un dividendo pequeño mueve el cierre ajustado bastante menos de un 0,5 %
+# Etiqueta del selector -> ventana (None = todo; int = últimas N sesiones, como period="5d")
+PERIODOS = {"1 Sem": 5, "1 Mes": pd.DateOffset(months=1), "6 Meses": pd.DateOffset(months=6), "1 Año": pd.DateOffset(years=1), "5 Años": pd.DateOffset(years=5), "Todo": None}
+
+def cortar_periodo(serie, etiqueta):
+    """Corte de `serie` (índice Date) para una etiqueta de PERIODOS."""
+    ventana = PERIODOS[etiqueta]
+    if serie.empty or ventana is None: return serie
+    if isinstance(ventana, int): return serie.iloc[-ventana:]
+    return serie[serie.index > pd.Timestamp.now().normalize() - ventana]
+
+def _barras(data):
+    """Barras ajustadas (como `auto_adjust=True`) más el cierre real, a partir de una descarga con `auto_adjust=False`."""
+    if data is None or data.empty: return pd.DataFrame(columns=COLUMNAS_BARRAS, index=pd.DatetimeIndex([], name='Date'))
+    barras = data[COLUMNAS_OHLCV].copy()
+    barras[CIERRE_REAL] = barras['Close']
+    if 'Adj Close' in data.columns:
+        factor = data['Adj Close'] / data['Close']
+        for c in ('Open', 'High', 'Low', 'Close'): barras[c] = barras[c] * factor
+    barras.index = pd.DatetimeIndex(barras.index).tz_localize(None).normalize().rename('Date')
+    barras['Volume'] = pd.to_numeric(barras['Volume'], errors='coerce').fillna(0)
+    barras = barras.dropna(subset=['Close'])  # Descarga en bloque: días sin sesión de este ticker
+    return barras[~barras.index.duplicated(keep='last')].astype(float)
+
+def _por_ticker(data, grupo):
+    """Descarga de `yf.download` -> {ticker: barras con columnas de precio planas}.
+
+    La forma depende de la versión de yfinance: con uno o varios tickers las columnas pueden venir
+    planas o como MultiIndex (ticker, precio) o (precio, ticker). El nivel de los tickers es el que
+    no contiene los nombres de precio.
+    """
+    if data is None or data.empty: return {}
+    if not isinstance(data.columns, pd.MultiIndex): return {grupo[0]: data} if len(grupo) == 1 else {}
+    nivel = next((n for n in range(data.columns.nlevels) if 'Close' not in data.columns.get_level_values(n)), 0)
+    tickers = set(data.columns.get_level_values(nivel))
+    return {t: data.xs(t, axis=1, level=nivel) for t in grupo if t in tickers}
+
+class AlmacenHistorico:
+    """Barras diarias OHLCV por ticker: el histórico completo se descarga una vez y después sólo
+    se añaden las sesiones nuevas. Cada periodo del gráfico es un corte de la misma serie.
+
+    OHLC van ajustados por dividendos (gráfico e indicadores); CIERRE_REAL guarda además el
+    cierre de cada día tal cual, que es el que sirve para valorar posiciones.
+    """
+
+    def __init__(self, nombre=ARCHIVO_HISTORICO):
+        self.nombre = nombre
+        self._series, self._revisado = {}, {}
+        self._versiones, self._contador = {}, itertools.count(1)
+        self._lock = threading.Lock()
+        self._locks_ticker = {}
+        with conectar(self.nombre) as con:
+            con.execute("""CREATE TABLE IF NOT EXISTS barras (
+                ticker TEXT, fecha TEXT, open REAL, high REAL, low REAL, close REAL, volume REAL, close_real REAL, PRIMARY KEY (ticker, fecha))""")
+            if 'close_real' not in [c[1] for c in con.execute("PRAGMA table_info(barras)")]:
+                # Barras guardadas sin cierre real: se descartan y se vuelven a descargar completas
+                con.execute("DELETE FROM barras")
+                con.execute("ALTER TABLE barras ADD COLUMN close_real REAL")
+
+    def _leer_disco(self, ticker):
+        with conectar(self.nombre) as con:
+            filas = con.execute("SELECT fecha, open, high, low, close, volume, close_real FROM barras WHERE ticker=? ORDER BY fecha", (ticker,)).fetchall()
+        return pd.DataFrame([f[1:] for f in filas], columns=COLUMNAS_BARRAS, index=pd.DatetimeIndex([f[0] for f in filas], name='Date'), dtype=float)
+
+    def _guardar(self, ticker, barras, reemplazar=False):
+        with conectar(self.nombre) as con:
+            if reemplazar: con.execute("DELETE FROM barras WHERE ticker=?", (ticker,))
+            con.executemany("INSERT OR REPLACE INTO barras VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            [(ticker, f.strftime('%Y-%m-%d'), *map(float, v)) for f, v in zip(barras.index, barras.to_numpy())])
+
+    def _fusionar(self, ticker, serie, delta):
+        """Añade `delta` a `serie`; None si una barra ya cerrada cambió (el ajuste histórico cambió)."""
+        if delta.empty: return serie
+        solape = serie.index[-2] if len(serie) > 1 else None
+        if solape is not None and solape in delta.index:
+            previo, nuevo = serie.at[solape, 'Close'], delta.at[solape, 'Close']
+            if previo and abs(nuevo / previo - 1) > TOLERANCIA_AJUSTE: return None
+        self._guardar(ticker, delta)
+        return pd.concat([serie[serie.index < delta.index[0]], delta])
+
+    def _actualizar(self, ticker, serie, recargar=False):
+        """Completa `serie` con las sesiones que falten; recarga entera si el ajuste histórico cambió
+        (o con `recargar`). Una descarga vacía (yfinance no lanza error al fallar) deja `serie` como estaba."""
+        if not serie.empty and not recargar:
+            # Se pide desde la penúltima barra: la última puede ser una sesión aún abierta
+            solape = serie.index[-2] if len(serie) > 1 else serie.index[-1]
+            fusionada = self._fusionar(ticker, serie, _barras(yf.Ticker(ticker).history(start=solape.date(), auto_adjust=False)))
+            if fusionada is not None: return fusionada
+        nueva = _barras(yf.Ticker(ticker).history(period="max", auto_adjust=False))
+        if nueva.empty: return serie
+        self._guardar(ticker, nueva, reemplazar=True)
+        return nueva
+
+    def _lock_ticker(self, ticker):
+        with self._lock: return self._locks_ticker.setdefault(ticker, threading.Lock())
+
+    def _publicar(self, ticker, serie):
+        """Deja `serie` en memoria; si es otra (sesiones nuevas o recarga) sube la versión del ticker."""
+        if self._series.get(ticker) is not serie:
+            self._series[ticker] = serie
+            self._versiones[ticker] = next(self._contador)
+
+    def version(self, ticker):
+        """Cambia cada vez que la serie de `ticker` se reemplaza, también si se recarga el mismo día."""
+        return self._versiones.get(ticker, 0)
+
+    def _pendiente(self, ticker, serie):
+        """True si faltan sesiones y no se ha preguntado por este ticker en los últimos REINTENTO_ACTUALIZACION s."""
+        if not serie.empty and serie.index[-1] >= pd.Timestamp.now().normalize(): return False
+        return time.monotonic() - self._revisado.get(ticker, -1e9) > REINTENTO_ACTUALIZACION
+
+    def serie(self, ticker):
+        """Histórico diario completo de `ticker` (índice Date normalizado)."""
+        return self.serie_versionada(ticker)[0]
+
+    def serie_versionada(self, ticker):
+        """(serie, versión) leídas juntas, para usar la versión como clave de caché de lo derivado."""
+        with self._lock_ticker(ticker):
+            serie = self._series.get(ticker)
+            if serie is None: serie = self._leer_disco(ticker)
+            if self._pendiente(ticker, serie):
+                self._revisado[ticker] = time.monotonic()
+                try: serie = self._actualizar(ticker, serie)
+                except: pass  # Sin conexión: se sirve lo que haya en disco
+            self._publicar(ticker, serie)
+            return serie, self.version(ticker)
+
+    def precargar(self, tickers):
+        """Pone al día muchos tickers con dos descargas en bloque (históricos nuevos y sesiones que falten)
+        en vez de una petición por ticker."""
+        locales = {}
+        for t in dict.fromkeys(tickers):
+            serie = self._series.get(t)
+            locales[t] = self._leer_disco(t) if serie is None else serie
+        pendientes = [t for t, serie in locales.items() if self._pendiente(t, serie)]
+        for t in pendientes: self._revisado[t] = time.monotonic()
+        nuevos = [t for t in pendientes if locales[t].empty]
+        a_completar = [t for t in pendientes if not locales[t].empty]
+        bloques = []
+        if nuevos: bloques.append((nuevos, {'period': "max"}))
+        if a_completar: bloques.append((a_completar, {'start': min(locales[t].index[max(len(locales[t]) - 2, 0)] for t in a_completar).date()}))
+        for grupo, rango in bloques:
+            try: data = _por_ticker(yf.download(grupo, group_by='ticker', auto_adjust=False, progress=False, **rango), grupo)
+            except: data = {}
+            for t in grupo:
+                delta = _barras(data.get(t))
+                with self._lock_ticker(t):
+                    serie = locales[t]
+                    try:
+                        if serie.empty:
+                            if not delta.empty: self._guardar(t, delta, reemplazar=True); serie = delta
+                        else:
+                            fusionada = self._fusionar(t, serie, delta)
+                            serie = fusionada if fusionada is not None else self._actualizar(t, serie, recargar=True)
+                    except: pass
+                    self._publicar(t, serie)
+        for t, serie in locales.items():
+            if t not in self._series: self._publicar(t, serie)
+
+    def cierres(self, tickers, ajustados=False):
+        """Matriz de cierres (fechas × tickers) a partir del histórico local, puesto al día en bloque.
+        Por defecto los reales de cada día; con `ajustados`, los ajustados por dividendos."""
+        tickers = list(dict.fromkeys(tickers))
+        if not tickers: return pd.DataFrame()
+        self.precargar(tickers)
+        columna = 'Close' if ajustados else CIERRE_REAL
+        return pd.concat({t: self.serie(t)[columna] for t in tickers}, axis=1, sort=True)
+
+    def periodo(self, ticker, etiqueta):
+        """Corte del histórico para una etiqueta de PERIODOS, con la forma de `history().reset_index()`."""
+        return cortar_periodo(self.serie(ticker), etiqueta).reset_index()
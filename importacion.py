@@ -0,0 +1,299 @@
+import csv
+import io
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+from escritura_airtable import crear_en_lotes
+from libro_columnar import normalizar_registros
+from sincronizacion_airtable import formula_campo, formula_usuario
+
+MONEDA_BASE = "EUR"
+DESCRIPCION_IMPORTADO = "Importado CSV (Opción A)"
+
+SEPARADORES = ",;\t|"
+TAM_MUESTRA = 64 * 1024     # Bytes del inicio del fichero usados para detectar el separador
+TIPOS_VALIDOS = ("Compra", "Venta", "Dividendo")
+# Formatos de fecha probados sobre una muestra; el que mejor la lee se aplica a todo el fichero
+FORMATOS_FECHA = (
+    "%d/%m/%Y %H:%M", "%d/%m/%Y %H:%M:%S", "%d/%m/%Y", "%d-%m-%Y %H:%M", "%d-%m-%Y", "%d.%m.%Y %H:%M", "%d.%m.%Y",
+    "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d", "%Y/%m/%d %H:%M", "%Y/%m/%d", "%Y%m%d;%H%M%S", "%Y%m%d",
+)
+
+# --- PERFILES DE EXPORTACIÓN POR BRÓKER ---
+# Campo del registro -> columnas candidatas del CSV (se usa la primera que exista).
+# 'Acciones' (nº de títulos) se usa si no hay importe: Cantidad = |Acciones| × Precio.
+PERFILES = {
+    "Plantilla (Opción A)": {
+        'columnas': {'Fecha': ['Fecha', 'Date'], 'Hora': ['Hora'], 'Ticker': ['Ticker'], 'Tipo': ['Tipo'], 'Cantidad': ['Total_Dinero'],
+                     'Precio': ['Precio'], 'Comision': ['Comision'], 'Moneda': ['Moneda', 'Currency'], 'Cambio': ['Cambio', 'FX Rate']},
+    },
+    "Exportación del Gestor": {
+        'columnas': {'Fecha': ['Fecha_str', 'Fecha'], 'Ticker': ['Ticker'], 'Tipo': ['Tipo'], 'Cantidad': ['Cantidad'], 'Precio': ['Precio'],
+                     'Comision': ['Comision'], 'Moneda': ['Moneda'], 'Cambio': ['Cambio'], 'Descripcion': ['Descripcion']},
+        'formato_fecha': "%Y/%m/%d %H:%M",
+    },
+    "Interactive Brokers (Flex: Trades)": {
+        'columnas': {'Fecha': ['DateTime', 'Date/Time', 'TradeDate'], 'Ticker': ['Symbol'], 'Tipo': ['Buy/Sell'], 'Acciones': ['Quantity'],
+                     'Precio': ['TradePrice'], 'Comision': ['IBCommission'], 'Moneda': ['CurrencyPrimary'], 'Cambio': ['FXRateToBase']},
+        'tipos': {'BUY': "Compra", 'SELL': "Venta"},
+        'valores_absolutos': True,  # Ventas con cantidad negativa y comisiones en negativo
+    },
+}
+PERFIL_POR_DEFECTO = "Plantilla (Opción A)"
+
+def detectar_perfil(columnas):
+    """Perfil cuyas columnas de fecha, ticker y precio aparecen en el CSV (el de más coincidencias)."""
+    columnas = set(columnas)
+    def coincidencias(perfil):
+        mapa = PERFILES[perfil]['columnas']
+        if not all(any(c in columnas for c in mapa[campo]) for campo in ('Fecha', 'Ticker', 'Precio')): return -1
+        return sum(any(c in columnas for c in candidatas) for candidatas in mapa.values())
+    return max(PERFILES, key=coincidencias) if any(coincidencias(p) >= 0 for p in PERFILES) else PERFIL_POR_DEFECTO
+
+# --- LECTURA ---
+def detectar_separador(muestra):
+    """Separador del CSV a partir de una muestra de texto (una sola detección por fichero)."""
+    muestra = muestra[:muestra.rfind('\n') + 1] or muestra  # Sin la última línea, posiblemente cortada
+    try: return csv.Sniffer().sniff(muestra, delimiters=SEPARADORES).delimiter
+    except csv.Error:
+        cabecera = muestra.splitlines()[0] if muestra else ""
+        return max(SEPARADORES, key=cabecera.count)
+
+def leer_csv(fuente):
+    """Lee el CSV todo como texto: los números y fechas se interpretan después, por columnas.
+
+    Con pyarrow.csv y cada columna de la cabecera declarada string: `read_csv(dtype=str,
+    engine='pyarrow')` infiere tipos antes de pasar a texto ("007" -> "7", "10:30" -> "10:30:00").
+    Si falla (p. ej. el fichero no es UTF-8) se usa el motor de C, que no infiere con dtype=str.
+    """
+    contenido = fuente if isinstance(fuente, bytes) else fuente.getvalue()
+    muestra = contenido[:TAM_MUESTRA].decode('utf-8-sig', errors='replace')
+    sep = detectar_separador(muestra)
+    try:
+        cabecera = next(csv.reader(io.StringIO(muestra), delimiter=sep), [])
+        tabla = pa_csv.read_csv(io.BytesIO(contenido), parse_options=pa_csv.ParseOptions(delimiter=sep),
+                                convert_options=pa_csv.ConvertOptions(column_types=dict.fromkeys(cabecera, pa.string()), strings_can_be_null=True))
+        df = tabla.to_pandas()
+    except Exception:
+        try: df = pd.read_csv(io.BytesIO(contenido), sep=sep, dtype=str, engine='c', encoding='utf-8-sig')
+        except UnicodeDecodeError: df = pd.read_csv(io.BytesIO(contenido), sep=sep, dtype=str, engine='c', encoding='latin-1')
+    df.columns = [str(c).strip() for c in df.columns]
+    return df
+
+# --- NÚMEROS Y FECHAS POR COLUMNA ---
+def limpiar_numeros(serie):
+    """Convierte una columna de texto a float admitiendo 1.234,56 (EU) y 1,234.56 (US).
+
+    El separador que aparece más a la derecha es el decimal; con sólo comas se asume formato
+    europeo. Vacío -> 0.0; lo que no es número -> NaN (error de la fila).
+    """
+    s = serie.astype(str).str.strip().str.replace("[\\s\u00a0'€$]", "", regex=True)
+    vacio = serie.isna() | (s == "") | (s.str.lower() == "nan")
+    eu = s.str.contains(",[^.]*$", regex=True)  # La última coma va detrás del último punto
+    s = s.where(~eu, s.str.replace('.', '', regex=False).str.replace(',', '.', regex=False))
+    s = s.where(eu, s.str.replace(',', '', regex=False))
+    return pd.to_numeric(s, errors='coerce').where(~vacio, 0.0)
+
+def parsear_fechas(textos, formato=None):
+    """Fechas en bloque con un formato explícito (el del perfil o el detectado en una muestra)."""
+    textos = textos.astype(str).str.strip()
+    if formato is None:
+        muestra = textos[textos != ""].head(200)
+        # El que más filas de la muestra entiende (una fecha errónea no invalida el formato)
+        leidas = {f: int(pd.to_datetime(muestra, format=f, errors='coerce').notna().sum()) for f in FORMATOS_FECHA}
+        formato = max(leidas, key=leidas.get) if leidas and max(leidas.values()) >= 0.9 * len(muestra) > 0 else None
+    if formato is None: return pd.to_datetime(textos, dayfirst=True, format='mixed', errors='coerce')
+    return pd.to_datetime(textos, format=formato, errors='coerce')
+
+def _fechas_airtable(fechas):
+    """'%Y/%m/%d %H:%M' en bloque (datetime_as_string es mucho más rápido que strftime)."""
+    iso = pd.Series(np.datetime_as_string(fechas.to_numpy(dtype='datetime64[m]'), unit='m'), index=fechas.index)
+    return iso.str.replace('-', '/', regex=False).str.replace('T', ' ', regex=False)
+
+def _columna(df, candidatas):
+    return next((df[c] for c in candidatas if c in df.columns), None)
+
+# --- FASE 1: FILAS CSV -> REGISTROS AIRTABLE ---
+def preparar_registros(df_upload, usuario, perfil=None):
+    """Devuelve (preparados, errores). Cada preparado es {'fila', 'fecha', 'record'}; el Cambio
+    histórico que haya que buscar queda a None para resolverlo en bloque.
+
+    Todo se calcula por columnas; las filas con fecha, número, ticker o tipo inválidos van a `errores`.
+    """
+    conf = PERFILES[perfil or detectar_perfil(df_upload.columns)]
+    mapa = conf['columnas']
+    def texto(campo, defecto=""):
+        col = _columna(df_upload, mapa.get(campo, []))
+        return pd.Series(defecto, index=df_upload.index) if col is None else col.fillna(defecto).astype(str).str.strip()
+    def numero(campo, defecto=0.0):
+        col = _columna(df_upload, mapa.get(campo, []))
+        valores = pd.Series(defecto, index=df_upload.index, dtype=float) if col is None else limpiar_numeros(col)
+        return valores.abs() if conf.get('valores_absolutos') else valores
+
+    fecha_txt = texto('Fecha')
+    if _columna(df_upload, mapa.get('Hora', [])) is not None: fecha_txt = fecha_txt + " " + texto('Hora', "00:00")
+    fechas = parsear_fechas(fecha_txt, conf.get('formato_fecha'))
+
+    monedas = texto('Moneda', MONEDA_BASE).str.upper().replace("", MONEDA_BASE)
+    tipos_txt = texto('Tipo')
+    tipos = tipos_txt.str.upper().map(conf['tipos']) if 'tipos' in conf else tipos_txt.str.capitalize()
+    tickers = texto('Ticker').str.upper()
+    precios, comisiones = numero('Precio'), numero('Comision')
+    cantidades = numero('Cantidad') if _columna(df_upload, mapa.get('Cantidad', [])) is not None else numero('Acciones').abs() * precios
+
+    # Cambio: el del fichero; si falta o está vacío, 1.0 en EUR y pendiente (None) en divisa
+    col_cambio = _columna(df_upload, mapa.get('Cambio', []))
+    cambios_csv = limpiar_numeros(col_cambio) if col_cambio is not None else pd.Series(0.0, index=df_upload.index)
+    cambios = cambios_csv.where(cambios_csv > 0)
+    cambios = cambios.where(cambios.notna() | (monedas != MONEDA_BASE), 1.0)
+
+    invalidas = pd.DataFrame({
+        "fecha": fechas.isna(), "ticker": tickers.isin(["", "NAN", "NONE"]), "tipo": ~tipos.isin(TIPOS_VALIDOS),
+        "número": cantidades.isna() | precios.isna() | comisiones.isna() | cambios_csv.isna(),
+    })
+    malas = invalidas.any(axis=1).to_numpy()
+    errores = [{'Fila': fila, 'Ticker': ticker, 'Estado': "Error", 'Detalle': "Fila inválida: " + ", ".join(invalidas.columns[marcas])}
+               for fila, ticker, marcas in zip(df_upload.index[malas], tickers[malas], invalidas.to_numpy()[malas])]
+
+    ok = ~malas
+    descripciones = texto('Descripcion', DESCRIPCION_IMPORTADO).replace("", DESCRIPCION_IMPORTADO) if 'Descripcion' in mapa else pd.Series(DESCRIPCION_IMPORTADO, index=df_upload.index)
+    # Columnas -> listas de Python una vez; los dicts se montan con zip (sin iterar filas de pandas)
+    columnas = {
+        "Fecha": _fechas_airtable(fechas[ok]), "Ticker": tickers[ok], "Tipo": tipos[ok],
+        "Cantidad": cantidades[ok], "Precio": precios[ok], "Comision": comisiones[ok], "Moneda": monedas[ok],
+        "Cambio": cambios[ok].astype(object).where(cambios[ok].notna(), None), "Descripcion": descripciones[ok],
+    }
+    claves = ("Usuario", *columnas)
+    valores = [[usuario] * int(ok.sum())] + [col.to_numpy(dtype=object).tolist() for col in columnas.values()]
+    # 'fecha' como datetime64 de numpy: crear un Timestamp por fila cuesta más que todo lo demás
+    preparados = [{'fila': fila, 'fecha': fecha, 'record': dict(zip(claves, fila_valores))}
+                  for fila, fecha, fila_valores in zip(df_upload.index[ok].tolist(), list(fechas[ok].to_numpy()), zip(*valores))]
+    return preparados, errores
+
+def vista_previa(preparados, n=5):
+    """Primeras filas ya normalizadas, tal como se escribirían."""
+    return pd.DataFrame([p['record'] for p in preparados[:n]])
+
+# --- ÍNDICE DE DUPLICADOS ---
+DECIMALES_DEDUP = 4     # Cantidad y Precio se comparan redondeados (Airtable puede recortar decimales)
+
+def huellas_operaciones(datos):
+    """Hash uint64 por fila de (Usuario, Fecha, Ticker, Tipo, Cantidad, Precio) normalizados.
+
+    `datos` trae Fecha como '%Y/%m/%d %H:%M' (la del registro de Airtable o Fecha_str del libro).
+    """
+    def texto(col): return datos[col].astype(str).str.strip().to_numpy(dtype=object)
+    def numero(col): return pd.to_numeric(datos[col], errors='coerce').fillna(0.0).round(DECIMALES_DEDUP).to_numpy(dtype=float)
+    normalizado = pd.DataFrame({
+        "Usuario": texto("Usuario"), "Fecha": texto("Fecha"), "Ticker": datos["Ticker"].astype(str).str.strip().str.upper().to_numpy(dtype=object),
+        "Tipo": texto("Tipo"), "Cantidad": numero("Cantidad"), "Precio": numero("Precio"),
+    })
+    return pd.util.hash_pandas_object(normalizado, index=False).to_numpy(dtype=np.uint64)
+
+class IndiceOperaciones:
+    """Huellas de las operaciones que ya están en el libro, para no volver a subirlas.
+
+    Se construye una vez desde el libro local (sin llamadas a Airtable) y cada fila importada
+    se comprueba contra un set: O(1) por fila.
+    """
+
+    def __init__(self, libro, usuario=None):
+        self._huellas, self._filas = set(), ([], [])
+        self.ids = set()
+        if libro is None or libro.empty or 'Fecha_str' not in libro.columns: return
+        datos = libro.assign(Fecha=libro['Fecha_str'])
+        if 'Usuario' not in datos.columns: datos['Usuario'] = usuario
+        if not all(c in datos.columns for c in ("Ticker", "Tipo", "Cantidad", "Precio")): return
+        huellas = huellas_operaciones(datos).tolist()
+        ids = datos['id'].tolist() if 'id' in datos.columns else [None] * len(huellas)
+        self._huellas, self._filas, self.ids = set(huellas), (huellas, ids), set(ids) - {None}
+
+    def __len__(self):
+        return len(self._huellas)
+
+    def separar(self, preparados):
+        """(nuevos, repetidos): los preparados cuya operación ya existe van a `repetidos`."""
+        if not preparados or not self._huellas: return preparados, []
+        repetido = pd.Series(huellas_operaciones(pd.DataFrame([p['record'] for p in preparados]))).isin(self._huellas).to_numpy()
+        return [p for p, r in zip(preparados, repetido) if not r], [p for p, r in zip(preparados, repetido) if r]
+
+    def emparejar(self, registros):
+        """Por registro, la fila del libro con su misma operación ({'id', 'fields'}) o None; cada fila se usa una vez."""
+        libres = {}
+        for huella, id_ in zip(*self._filas): libres.setdefault(huella, []).append(id_)
+        if not registros: return []
+        huellas = huellas_operaciones(pd.DataFrame(registros)).tolist()
+        return [{'id': libres[h].pop(), 'fields': r} if libres.get(h) else None for h, r in zip(huellas, registros)]
+
+def comprobador_creados(table, indice):
+    """`comprobar` de `crear_en_lotes`: tras perderse una respuesta, qué registros llegaron a crearse.
+
+    Relee de Airtable las operaciones del usuario con los tickers del lote y las empareja por
+    huella, descontando las que ya estaban en el libro (`indice`) y las creadas antes en la
+    misma importación (`excluidos`).
+    """
+    def comprobar(registros, excluidos):
+        tickers = sorted({r['Ticker'] for r in registros})
+        formula = f"AND({formula_usuario(registros[0]['Usuario'])}, OR({', '.join(formula_campo('Ticker', t) for t in tickers)}))"
+        leidos = normalizar_registros(table.all(formula=formula))
+        if not leidos.empty: leidos = leidos[~leidos['id'].isin(indice.ids | set(excluidos))]
+        return IndiceOperaciones(leidos).emparejar(registros)
+    return comprobar
+
+# --- FASE 2: DIVISAS Y NOMBRES, UNA VEZ POR MONEDA / TICKER ---
+def resolver_cambios(preparados, almacen_divisas):
+    """Cambio histórico de las filas en divisa sin Cambio: un rango y una consulta vectorizada por moneda."""
+    pendientes = {}
+    for p in preparados:
+        if p['record']['Cambio'] is None: pendientes.setdefault(p['record']['Moneda'], []).append(p)
+    for mon, filas in pendientes.items():
+        fechas = pd.DatetimeIndex([p['fecha'] for p in filas])
+        try:
+            almacen_divisas.asegurar_rango(mon, fechas.min(), fechas.max())
+            cambios = almacen_divisas.cambios(fechas, mon)
+        except: cambios = [1.0] * len(filas)
+        for p, fx in zip(filas, cambios): p['record']['Cambio'] = float(fx)
+
+def resolver_descripciones(preparados, nombre_empresa):
+    nombres = {}
+    for p in preparados:
+        if p['record']['Descripcion'] != DESCRIPCION_IMPORTADO: continue  # El fichero ya trae el nombre
+        ticker = p['record']['Ticker']
+        if ticker not in nombres:
+            try: nombres[ticker] = nombre_empresa(ticker)
+            except: nombres[ticker] = None
+        if nombres[ticker]: p['record']['Descripcion'] = nombres[ticker]
+
+# --- PIPELINE COMPLETO ---
+def importar_csv(df_upload, usuario, table, almacen_divisas, nombre_empresa, limitador=None, progreso=None, perfil=None, validado=None,
+                 indice=None, omitir_repetidos=True):
+    """Prepara, resuelve FX/nombres en bloque y escribe con `batch_create` limitado.
+
+    `validado` es el (preparados, errores) de la vista previa, para no repetir la fase 1.
+    Con `indice` (IndiceOperaciones) las filas que ya están en el libro se omiten (o, con
+    `omitir_repetidos=False`, se suben marcadas en el informe).
+    Devuelve el informe por fila: [{'Fila', 'Ticker', 'Estado', 'Detalle'}].
+    """
+    preparados, informe = validado if validado is not None else preparar_registros(df_upload, usuario, perfil)
+    preparados, informe = [dict(p, record=dict(p['record'])) for p in preparados], list(informe)
+    repetidos = set()
+    if indice is not None:
+        nuevos, ya_existen = indice.separar(preparados)
+        if omitir_repetidos:
+            preparados = nuevos
+            informe.extend({'Fila': p['fila'], 'Ticker': p['record']['Ticker'], 'Estado': "Repetido", 'Detalle': "Ya existe en el libro: omitida"} for p in ya_existen)
+        else: repetidos = {p['fila'] for p in ya_existen}
+    resolver_cambios(preparados, almacen_divisas)
+    resolver_descripciones(preparados, nombre_empresa)
+    # Sin índice no se distingue lo recién creado de lo que ya había: una respuesta perdida no se reintenta
+    comprobar = comprobador_creados(table, indice) if indice is not None else None
+    resultados = crear_en_lotes(table, [p['record'] for p in preparados], limitador, progreso=progreso, comprobar=comprobar)
+    for r in resultados:
+        p = preparados[r['fila']]
+        informe.append({'Fila': p['fila'], 'Ticker': p['record']['Ticker'],
+                        'Estado': "Creado" if r['ok'] else "Error",
+                        'Detalle': (r['id'] + (" (posible repetido)" if p['fila'] in repetidos else "")) if r['ok'] else r['error']})
+    return sorted(informe, key=lambda x: x['Fila'])
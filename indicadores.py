@@ -0,0 +1,97 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from historico_precios import cortar_periodo
+
+VENTANAS_MEDIA = (5, 10, 20, 50, 100, 200)
+MEDIAS = [f"{tipo} {n}" for tipo in ("SMA", "EMA") for n in VENTANAS_MEDIA]
+MAX_INDICADORES = 64        # Entradas (ticker, última barra[, periodo]) que se conservan (LRU)
+RADIO_PIVOTE = 5            # Un pivote es el mínimo/máximo de las 2·R+1 sesiones a su alrededor
+TOLERANCIA_NIVEL = 0.015    # Pivotes a menos de un 1,5 % entre sí forman el mismo nivel
+MAX_NIVELES = 3             # Soportes y resistencias que se dibujan de cada lado
+
+# --- CÁLCULOS VECTORIZADOS ---
+def medias_moviles(cierres):
+    """SMA y EMA de todas las ventanas ofrecidas sobre el histórico completo (columnas de MEDIAS)."""
+    c = np.asarray(cierres, dtype=float)
+    acumulado = np.concatenate(([0.0], np.cumsum(c)))
+    columnas = {}
+    for n in VENTANAS_MEDIA:
+        sma = np.full(len(c), np.nan)
+        if len(c) >= n: sma[n - 1:] = (acumulado[n:] - acumulado[:-n]) / n
+        columnas[f"SMA {n}"] = sma
+    serie = pd.Series(c)
+    for n in VENTANAS_MEDIA: columnas[f"EMA {n}"] = serie.ewm(span=n, adjust=False, min_periods=n).mean().to_numpy()
+    return columnas
+
+def tendencia(fechas, cierres):
+    """Recta de mínimos cuadrados del cierre frente a los días transcurridos."""
+    if len(cierres) < 2: return None
+    fechas = pd.DatetimeIndex(fechas)
+    x = ((fechas - fechas[0]) / pd.Timedelta(days=1)).to_numpy(dtype=float)  # Origen en la primera barra: ajuste bien condicionado
+    m, b = np.polyfit(x, np.asarray(cierres, dtype=float), 1)
+    return m * x + b
+
+def _pivotes(valores, radio, funcion):
+    extremo = getattr(pd.Series(valores).rolling(2 * radio + 1, center=True), funcion)().to_numpy()
+    return valores[valores == extremo]
+
+def _agrupar(precios):
+    """Agrupa precios cercanos en niveles: [(nivel medio, nº de toques)]."""
+    if len(precios) == 0: return []
+    p = np.sort(precios)
+    grupos = np.concatenate(([0], np.cumsum(np.diff(p) / p[:-1] > TOLERANCIA_NIVEL)))
+    toques = np.bincount(grupos)
+    return list(zip(np.bincount(grupos, weights=p) / toques, toques))
+
+def soportes_resistencias(bajos, altos, ultimo_cierre):
+    """Niveles con más toques por debajo (soportes) y por encima (resistencias) del último cierre."""
+    bajos, altos = np.asarray(bajos, dtype=float), np.asarray(altos, dtype=float)
+    radio = RADIO_PIVOTE if len(bajos) >= 10 * RADIO_PIVOTE else 2
+    niveles = _agrupar(np.concatenate((_pivotes(bajos, radio, 'min'), _pivotes(altos, radio, 'max'))))
+    def mejores(candidatos): return [float(nivel) for nivel, _ in sorted(candidatos, key=lambda n: -n[1])[:MAX_NIVELES]]
+    return {'soportes': mejores([n for n in niveles if n[0] < ultimo_cierre]),
+            'resistencias': mejores([n for n in niveles if n[0] >= ultimo_cierre])}
+
+# --- MOTOR CON MEMORIA ---
+class MotorIndicadores:
+    """Indicadores del detalle de un ticker, memorizados por (ticker, versión de su serie en el almacén).
+
+    Las medias se calculan una vez sobre todo el histórico (así no arrancan en NaN al cortar el
+    periodo); tendencia y niveles dependen del periodo visible y se memorizan también por él.
+    """
+
+    def __init__(self, almacen, max_entradas=MAX_INDICADORES):
+        self.almacen, self.max_entradas = almacen, max_entradas
+        self._memoria = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _memo(self, clave, calcular):
+        with self._lock:
+            if clave in self._memoria:
+                self._memoria.move_to_end(clave)
+                return self._memoria[clave]
+        valor = calcular()
+        with self._lock:
+            self._memoria[clave] = valor
+            while len(self._memoria) > self.max_entradas: self._memoria.popitem(last=False)
+        return valor
+
+    def _completo(self, ticker, serie, version):
+        return self._memo((ticker, version), lambda: serie.assign(**medias_moviles(serie['Close'].to_numpy())))
+
+    def periodo(self, ticker, etiqueta):
+        """(hist, niveles): barras del periodo con columnas MEDIAS y 'Trend', y soportes/resistencias."""
+        serie, version = self.almacen.serie_versionada(ticker)
+        if serie.empty: return pd.DataFrame(), {'soportes': [], 'resistencias': []}
+        def calcular():
+            corte = cortar_periodo(self._completo(ticker, serie, version), etiqueta)
+            trend = tendencia(corte.index, corte['Close'].to_numpy())
+            if trend is not None: corte = corte.assign(Trend=trend)
+            niveles = soportes_resistencias(corte['Low'].to_numpy(), corte['High'].to_numpy(), corte['Close'].iloc[-1])
+            return corte.reset_index(), niveles
+        hist, niveles = self._memo((ticker, version, etiqueta), calcular)
+        return hist.copy(), niveles
@@ -0,0 +1,224 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import pandas as pd
+from fpdf import FPDF
+
+from formato import fmt_dinamico, fmt_num_es
+
+MAX_INFORMES = 32                     # PDFs terminados que se conservan (LRU)
+UMBRAL_MEMORIA = 1024 * 1024          # Por encima de 1 MB el PDF pasa de RAM a un fichero temporal
+COLUMNAS_HISTORIAL = {'Fecha_str': ('Fecha', 35), 'Ticker': ('Ticker', 15), 'Descripcion': ('Empresa', 50), 'Cantidad': ('Cant.', 25), 'Precio': ('Precio', 25), 'Moneda': ('Div', 15), 'Comision': ('Com.', 20), 'Usuario': ('Usuario', 30)}
+
+def _latin1(valor):
+    return str(valor).replace("€", "EUR").encode('latin-1', 'replace').decode('latin-1')
+
+def _fmt_celda(val):
+    return fmt_num_es(val) if isinstance(val, (int, float)) else _latin1(val)
+
+def _formateador(serie, columna):
+    """Formateador elegido una vez por columna según su dtype (no por celda)."""
+    if columna == 'Cantidad': return _latin1
+    if pd.api.types.is_float_dtype(serie): return fmt_num_es
+    if pd.api.types.is_object_dtype(serie): return _fmt_celda
+    return _latin1
+
+# --- HISTORIAL ---
+def pdf_historial(dataframe, titulo, destino):
+    """Escribe en `destino` (fichero binario) el historial de operaciones en PDF."""
+    class PDF(FPDF):
+        def header(self):
+            self.set_font('Arial', 'B', 12)
+            _ = self.cell(0, 10, titulo, 0, 1, 'C')
+            _ = self.ln(5)
+        def footer(self):
+            self.set_y(-15)
+            self.set_font('Arial', 'I', 8)
+            _ = self.cell(0, 10, f'Pagina {self.page_no()}', 0, 0, 'C')
+    pdf = PDF(orientation='L')
+    pdf.add_page()
+    pdf.set_fill_color(200, 220, 255)
+    pdf.set_font("Arial", 'B', 10)
+    cols_validas = [(k, nombre_pdf, ancho) for k, (nombre_pdf, ancho) in COLUMNAS_HISTORIAL.items() if k in dataframe.columns]
+    for _, nombre_pdf, ancho in cols_validas: _ = pdf.cell(ancho, 10, nombre_pdf, 1, 0, 'C', 1)
+    _ = pdf.ln()
+    pdf.set_font("Arial", size=9)
+    celdas = [(_formateador(dataframe[k], k), ancho) for k, _, ancho in cols_validas]
+    for fila in dataframe[[k for k, _, _ in cols_validas]].itertuples(index=False, name=None):
+        for val, (fmt, ancho) in zip(fila, celdas): _ = pdf.cell(ancho, 10, fmt(val), 1, 0, 'C')
+        _ = pdf.ln()
+    destino.write(pdf.output(dest='S').encode('latin-1'))
+
+# --- INFORME FISCAL ---
+def pdf_fiscal(datos_fiscales, año, nombre_titular, dni_titular, destino, progreso=None):
+    """Escribe en `destino` el informe fiscal (ganancias patrimoniales y dividendos) de `año`."""
+    class PDF_Fiscal(FPDF):
+        def header(self):
+            self.set_font('Arial', 'B', 14)
+            _ = self.cell(0, 10, f"Informe Fiscal - Ejercicio {año}", 0, 1, 'C')
+            self.set_font('Arial', '', 10)
+            _ = self.cell(0, 5, f"Titular: {nombre_titular} | NIF/DNI: {dni_titular}", 0, 1, 'C')
+            self.set_font('Arial', 'I', 8)
+            _ = self.cell(0, 5, f"Generado el {datetime.now().strftime('%d/%m/%Y')}", 0, 1, 'C')
+            _ = self.ln(5)
+        def footer(self):
+            self.set_y(-15)
+            self.set_font('Arial', 'I', 8)
+            _ = self.cell(0, 10, f'Pág {self.page_no()}', 0, 0, 'C')
+
+    # Una sola pasada para separar acciones y dividendos
+    ops_acciones, ops_divs = [], []
+    for d in datos_fiscales:
+        if d['Tipo'] == "Ganancia/Pérdida": ops_acciones.append(d)
+        elif d['Tipo'] == "Dividendo": ops_divs.append(d)
+    total_filas = len(ops_acciones) + len(ops_divs)
+
+    pdf = PDF_Fiscal(orientation='L')
+    pdf.add_page()
+
+    # 1. GANANCIAS
+    pdf.set_font("Arial", 'B', 12)
+    pdf.set_fill_color(200, 200, 200)
+    _ = pdf.cell(0, 10, "1. Ganancias y Pérdidas Patrimoniales (Acciones)", 1, 1, 'L', 1)
+    _ = pdf.ln(2)
+
+    pdf.set_font("Arial", 'B', 8)
+    cols = [("Ticker", 15), ("Empresa", 35), ("ISIN", 25), ("F. Venta", 20), ("F. Compra", 20), ("Cant.", 15), ("V. Transm.", 25), ("V. Adquis.", 25), ("Rendimiento", 25)]
+    for txt, w in cols: _ = pdf.cell(w, 8, txt, 1, 0, 'C')
+    _ = pdf.ln()
+
+    pdf.set_font("Arial", '', 8)
+    total_ganancias = 0.0
+    for i, op in enumerate(ops_acciones, 1):
+        rend = op['Rendimiento']
+        total_ganancias += rend
+
+        _ = pdf.cell(15, 8, str(op['Ticker']), 1, 0, 'C')
+        _ = pdf.cell(35, 8, str(op.get('Empresa', ''))[:18], 1, 0, 'L')
+        _ = pdf.cell(25, 8, str(op.get('ISIN', '')), 1, 0, 'C')
+        _ = pdf.cell(20, 8, str(op['Fecha Venta']), 1, 0, 'C')
+        _ = pdf.cell(20, 8, str(op['Fecha Compra']), 1, 0, 'C')
+        _ = pdf.cell(15, 8, fmt_dinamico(op['Cantidad']), 1, 0, 'C')
+        _ = pdf.cell(25, 8, fmt_num_es(op['V. Transmisión']), 1, 0, 'R')
+        _ = pdf.cell(25, 8, fmt_num_es(op['V. Adquisición']), 1, 0, 'R')
+
+        if rend >= 0: pdf.set_text_color(0, 150, 0)
+        else: pdf.set_text_color(200, 0, 0)
+
+        _ = pdf.cell(25, 8, fmt_num_es(rend), 1, 0, 'R')
+        pdf.set_text_color(0, 0, 0)
+        _ = pdf.ln()
+        if progreso and i % 100 == 0: progreso(i, total_filas)
+
+    # Total 1
+    pdf.set_font("Arial", 'B', 10)
+    _ = pdf.cell(170, 10, "TOTAL GANANCIA/PÉRDIDA PATRIMONIAL:", 0, 0, 'R')
+    if total_ganancias >= 0: pdf.set_text_color(0, 150, 0)
+    else: pdf.set_text_color(200, 0, 0)
+    _ = pdf.cell(35, 10, f"{fmt_num_es(total_ganancias)} EUR", 0, 1, 'R')
+    pdf.set_text_color(0, 0, 0)
+    _ = pdf.ln(5)
+
+    # 2. DIVIDENDOS
+    pdf.set_font("Arial", 'B', 12)
+    pdf.set_fill_color(200, 200, 200)
+    _ = pdf.cell(0, 10, "2. Rendimientos del Capital Mobiliario (Dividendos)", 1, 1, 'L', 1)
+    _ = pdf.ln(2)
+
+    pdf.set_font("Arial", 'B', 9)
+    cols_div = [("Ticker", 30), ("Fecha Cobro", 40), ("Importe Bruto", 40), ("Gastos Ded.", 40), ("Importe Neto", 40)]
+    for txt, w in cols_div: _ = pdf.cell(w, 8, txt, 1, 0, 'C')
+    _ = pdf.ln()
+
+    pdf.set_font("Arial", '', 9)
+    total_divs_neto = 0.0
+    for i, op in enumerate(ops_divs, len(ops_acciones) + 1):
+        total_divs_neto += op['Neto']
+        _ = pdf.cell(30, 8, str(op['Ticker']), 1, 0, 'C')
+        _ = pdf.cell(40, 8, str(op['Fecha']), 1, 0, 'C')
+        _ = pdf.cell(40, 8, fmt_num_es(op['Bruto']), 1, 0, 'R')
+        _ = pdf.cell(40, 8, fmt_num_es(op['Gastos']), 1, 0, 'R')
+        _ = pdf.cell(40, 8, fmt_num_es(op['Neto']), 1, 0, 'R')
+        _ = pdf.ln()
+        if progreso and i % 100 == 0: progreso(i, total_filas)
+
+    # Total 2
+    pdf.set_font("Arial", 'B', 10)
+    _ = pdf.cell(160, 10, "TOTAL RENDIMIENTOS (NETO):", 0, 0, 'R')
+    _ = pdf.cell(30, 10, f"{fmt_num_es(total_divs_neto)} EUR", 0, 1, 'R')
+    destino.write(pdf.output(dest='S').encode('latin-1'))
+    if progreso: progreso(total_filas, total_filas)
+
+# --- CACHÉ DE INFORMES TERMINADOS ---
+def _liberar(informe):
+    """Los de disco se borran; en Windows un fichero aún abierto por una descarga se queda hasta reiniciar."""
+    if isinstance(informe, str):
+        try: os.remove(informe)
+        except OSError: pass
+
+class CacheInformes:
+    """PDFs ya generados por clave (usuario, año, versión del libro, ...).
+
+    Nada se genera hasta que se pide; los pequeños quedan en RAM (bytes) y los grandes en un
+    fichero temporal. Una clave se genera una sola vez aunque la pidan varias sesiones a la vez.
+    """
+
+    def __init__(self, max_entradas=MAX_INFORMES, umbral_memoria=UMBRAL_MEMORIA):
+        self.max_entradas, self.umbral_memoria = max_entradas, umbral_memoria
+        self._informes = OrderedDict()
+        self._lock = threading.Lock()
+        self._en_curso = {}
+
+    def contiene(self, clave):
+        with self._lock: return clave in self._informes
+
+    def generar(self, clave, escribir):
+        """Llama a `escribir(destino)` si `clave` no está ya generada ni generándose."""
+        with self._lock:
+            if clave in self._informes: return
+            en_curso = self._en_curso.get(clave)
+            propio = en_curso is None
+            if propio: en_curso = self._en_curso[clave] = threading.Event()
+        if not propio: # Otra sesión ya lo está generando: se espera a que termine
+            en_curso.wait()
+            return
+        try:
+            with tempfile.SpooledTemporaryFile(max_size=self.umbral_memoria) as destino:
+                escribir(destino)
+                tamaño = destino.seek(0, io.SEEK_END)
+                destino.seek(0)
+                if tamaño <= self.umbral_memoria: informe = destino.read()
+                else:
+                    with tempfile.NamedTemporaryFile(suffix=".informe", delete=False) as fichero: shutil.copyfileobj(destino, fichero)
+                    informe = fichero.name
+            with self._lock:
+                _liberar(self._informes.pop(clave, None))
+                self._informes[clave] = informe
+                while len(self._informes) > self.max_entradas: _liberar(self._informes.popitem(last=False)[1])
+        finally:
+            with self._lock: self._en_curso.pop(clave, None)
+            en_curso.set()
+
+    def leer(self, clave):
+        """Fichero (binario, de sólo lectura) con el informe, o None; quien lo pide lo cierra.
+
+        Cada lectura abre el suyo: las sesiones no comparten posición ni se copia el contenido.
+        """
+        with self._lock:
+            informe = self._informes.get(clave)
+            if informe is None: return None
+            self._informes.move_to_end(clave)
+            if isinstance(informe, bytes): return io.BytesIO(informe)
+            try: return open(informe, "rb")
+            except OSError:
+                del self._informes[clave]
+                return None
+
+def generar_informe_fiscal(cache, clave, datos_fiscales, año, nombre_titular, dni_titular, progreso=None):
+    """Punto de entrada para el gestor de trabajos: deja el PDF fiscal en `cache` bajo `clave`."""
+    cache.generar(clave, lambda destino: pdf_fiscal(datos_fiscales, año, nombre_titular, dni_titular, destino, progreso))
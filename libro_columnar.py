@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from datetime import datetime
+
+import pandas as pd
+
+from almacen_local import ruta_datos
+
+COLUMNAS_NUMERICAS = ["Cantidad", "Precio", "Comision", "Cambio"]
+COLUMNAS_CATEGORICAS = ["Ticker", "Tipo", "Moneda"]
+MAX_TRAMOS = 8      # Deltas que se acumulan como Parquet aparte antes de compactarlos en el principal
+
+# --- NORMALIZACIÓN (una vez por sincronización, no en cada rerun) ---
+def normalizar_registros(registros):
+    """[{'id', 'fields'}] de Airtable -> DataFrame con Fecha_dt/Año/Fecha_str, numéricos y categóricas."""
+    if not registros: return pd.DataFrame()
+    df = pd.DataFrame([x['fields'] for x in registros])
+    df.columns = df.columns.str.strip()
+    df['id'] = [x['id'] for x in registros]
+
+    # AFINAMIENTO v32.45: Limpieza de datos manuales
+    if 'Fecha' in df.columns:
+        # Quitamos espacios invisibles y convertimos a datetime robusto
+        df['Fecha_dt'] = pd.to_datetime(df['Fecha'].astype(str).str.strip(), errors='coerce')
+        # Descartamos registros con fecha corrupta
+        df = df.dropna(subset=['Fecha_dt'])
+        df['Año'] = df['Fecha_dt'].dt.year
+        df['Fecha_str'] = df['Fecha_dt'].dt.strftime('%Y/%m/%d %H:%M')
+    else:
+        df['Año'] = datetime.now().year
+        df['Fecha_dt'] = datetime.now()
+
+    # Asegurar tipos numéricos (limpiando comas de texto manual)
+    for col in COLUMNAS_NUMERICAS:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col].astype(str).str.replace(',', '.'), errors='coerce').fillna(0.0)
+    if 'Cambio' not in df.columns: df['Cambio'] = 1.0
+
+    for col in COLUMNAS_CATEGORICAS:
+        if col in df.columns: df[col] = df[col].astype('category')
+    return df.reset_index(drop=True)
+
+def _unir(partes):
+    """Concatena tramos del libro restaurando lo que concat pierde: categóricas y ceros en numéricos."""
+    partes = [p for p in partes if not p.empty]
+    if not partes: return pd.DataFrame()
+    if len(partes) == 1: return partes[0].reset_index(drop=True)
+    df = pd.concat(partes, ignore_index=True)
+    for col in COLUMNAS_NUMERICAS:
+        if col in df.columns: df[col] = df[col].fillna(1.0 if col == 'Cambio' else 0.0)
+    for col in COLUMNAS_CATEGORICAS:
+        if col in df.columns: df[col] = df[col].astype('category')
+    return df
+
+# --- COPIA COLUMNAR POR VISTA ---
+def _escribir_atomico(ruta, escribir):
+    """Escribe en un temporal único del mismo directorio y lo publica con os.replace."""
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(ruta) or ".", suffix=".tmp", delete=False) as f: temporal = f.name
+    try:
+        escribir(temporal)
+        os.replace(temporal, ruta)
+    except BaseException:
+        try: os.remove(temporal)
+        except OSError: pass
+        raise
+
+def _borrar(rutas):
+    for ruta in rutas:
+        try: os.remove(ruta)
+        except OSError: pass
+
+class LibroColumnar:
+    """Libro de operaciones ya tipado, un Parquet por vista (usuario o admin).
+
+    Una sincronización completa reescribe el Parquet principal; un delta se añade como tramo
+    aparte (los tramos se compactan al llegar a MAX_TRAMOS). Junto a cada vista un manifiesto
+    guarda sus tramos y un contador de versión. En cada rerun sólo se lee (con memory map),
+    y las lecturas por año o ticker filtran en el propio Parquet.
+    """
+
+    def __init__(self, prefijo="libro"):
+        self.prefijo = prefijo
+        self._lock, self._locks_vista = threading.Lock(), {}
+
+    def _nombre(self, vista):
+        return f"{self.prefijo}_{hashlib.sha1(vista.encode('utf-8')).hexdigest()[:16]}"
+
+    def _ruta(self, vista):
+        return ruta_datos(self._nombre(vista) + ".parquet")
+
+    def _ruta_manifiesto(self, vista):
+        return ruta_datos(self._nombre(vista) + ".json")
+
+    def _manifiesto(self, vista):
+        try:
+            with open(self._ruta_manifiesto(vista), encoding="utf-8") as f: return json.load(f)
+        except (OSError, ValueError): return {'version': 0, 'tramos': []}
+
+    def _publicar(self, vista, version, tramos):
+        def escribir(temporal):
+            with open(temporal, "w", encoding="utf-8") as f: json.dump({'version': version, 'tramos': tramos}, f)
+        _escribir_atomico(self._ruta_manifiesto(vista), escribir)
+
+    def _lock_vista(self, vista):
+        with self._lock: return self._locks_vista.setdefault(vista, threading.Lock())
+
+    def existe(self, vista):
+        return os.path.exists(self._ruta(vista))
+
+    def version(self, vista):
+        """Contador que sube en cada escritura de la vista; sirve como clave de caché del libro."""
+        return self._manifiesto(vista)['version'] if self.existe(vista) else 0
+
+    def _reescribir(self, vista, df, version):
+        _escribir_atomico(self._ruta(vista), lambda temporal: df.to_parquet(temporal, index=False))
+        tramos = self._manifiesto(vista)['tramos']
+        self._publicar(vista, version, [])
+        _borrar(ruta_datos(t) for t in tramos)
+
+    def reconstruir(self, vista, registros):
+        """Reescribe la vista entera (sincronización completa o primera lectura)."""
+        with self._lock_vista(vista):
+            self._reescribir(vista, normalizar_registros(registros), self._manifiesto(vista)['version'] + 1)
+
+    def fusionar(self, vista, registros):
+        """Añade un delta (registros nuevos o editados) como tramo, sin reescribir el Parquet principal."""
+        if not registros: return
+        with self._lock_vista(vista):
+            manifiesto = self._manifiesto(vista)
+            version = manifiesto['version'] + 1
+            if len(manifiesto['tramos']) + 1 >= MAX_TRAMOS:
+                libro = self._leer(vista, manifiesto, None, None, None)
+                delta = normalizar_registros(registros)
+                completo = _unir([libro[~libro['id'].isin(delta['id'])], delta]) if 'id' in libro.columns else delta
+                return self._reescribir(vista, completo, version)
+            tramo = f"{self._nombre(vista)}.tramo{version}.parquet"
+            _escribir_atomico(ruta_datos(tramo), lambda temporal: normalizar_registros(registros).to_parquet(temporal, index=False))
+            self._publicar(vista, version, manifiesto['tramos'] + [tramo])
+
+    def _leer(self, vista, manifiesto, años, tickers, columnas):
+        filtros = []
+        if años is not None: filtros.append(('Año', 'in', [int(a) for a in años]))
+        if tickers is not None: filtros.append(('Ticker', 'in', list(tickers)))
+        rutas = [self._ruta(vista)] + [ruta_datos(t) for t in manifiesto['tramos']]
+        leidas = list(columnas) + ['id'] if len(rutas) > 1 and columnas is not None and 'id' not in columnas else columnas
+        partes = []
+        for ruta in rutas:
+            try: partes.append(pd.read_parquet(ruta, columns=leidas, filters=filtros or None, memory_map=True))
+            except (KeyError, ValueError): partes.append(pd.DataFrame())  # Vista vacía: no hay columnas que filtrar
+        if len(partes) == 1: return partes[0]
+        # Un registro editado en un tramo posterior sustituye al anterior, aunque éste ya no pase el filtro
+        posteriores = set()
+        for i in range(len(rutas) - 1, 0, -1):
+            posteriores.update(pd.read_parquet(rutas[i], columns=['id'])['id'])
+            if 'id' in partes[i - 1].columns: partes[i - 1] = partes[i - 1][~partes[i - 1]['id'].isin(posteriores)]
+        df = _unir(partes)
+        return df if columnas is None else df[[c for c in columnas if c in df.columns]]
+
+    def leer(self, vista, años=None, tickers=None, columnas=None):
+        if not self.existe(vista): return pd.DataFrame()
+        try: return self._leer(vista, self._manifiesto(vista), años, tickers, columnas)
+        except FileNotFoundError:  # Una compactación borró un tramo entre leer el manifiesto y abrirlo
+            return self._leer(vista, self._manifiesto(vista), años, tickers, columnas)
+
+    def años(self, vista):
+        df = self.leer(vista, columnas=['Año'])
+        return sorted(df['Año'].dropna().unique().astype(int), reverse=True) if 'Año' in df.columns else []
@@ -0,0 +1,138 @@
+import threading
+import time
+
+import requests
+import yfinance as yf
+
+from almacen_local import conectar
+
+# --- INTENTO DE IMPORTAR TRADUCTOR ---
+try:
+    from deep_translator import GoogleTranslator
+    HAS_TRANSLATOR = True
+except ImportError:
+    HAS_TRANSLATOR = False
+
+ARCHIVO_METADATOS = "metadatos.sqlite"
+URL_FMP_PROFILE = "https://financialmodelingprep.com/api/v3/profile/{}?apikey={}"
+SIN_DESCRIPCION = "Sin descripción."
+
+def traducir_texto(texto, idioma="es"):
+    """Texto traducido a `idioma`; None si no se pudo traducir (sin traductor o fallo de red)."""
+    if not texto or texto == SIN_DESCRIPCION: return texto
+    if not HAS_TRANSLATOR: return None
+    try: return GoogleTranslator(source='auto', target=idioma).translate(texto[:4999]) or None
+    except Exception: return None
+
+def url_logo(ticker):
+    return f"https://financialmodelingprep.com/image-stock/{ticker}.png"
+
+def _isin_valido(isin):
+    return bool(isin) and isin != '-' and len(isin) > 5
+
+# --- DESCARGA DE PERFILES (FMP con relleno desde Yahoo) ---
+def _perfil_fmp(ticker, api_key):
+    if not api_key: return {}
+    try:
+        resp = requests.get(URL_FMP_PROFILE.format(ticker, api_key), timeout=3)
+        if resp.status_code == 200:
+            data = resp.json()
+            if data:
+                d = data[0]
+                return {'nombre': d.get('companyName'), 'descripcion': d.get('description'), 'isin': d.get('isin'), 'logo_url': d.get('image')}
+    except: pass
+    return {}
+
+def _perfil_yahoo(ticker):
+    perfil = {}
+    try:
+        stock = yf.Ticker(ticker)
+        try:
+            isin = stock.isin
+            if _isin_valido(isin): perfil['isin'] = isin
+        except: pass
+        info = stock.info
+        perfil['nombre'] = info.get('longName') or info.get('shortName')
+        perfil['descripcion'] = info.get('longBusinessSummary')
+    except: pass
+    return perfil
+
+def descargar_perfil(ticker, api_key=None):
+    perfil = _perfil_fmp(ticker, api_key)
+    if not perfil.get('nombre') or not _isin_valido(perfil.get('isin')):
+        for k, v in _perfil_yahoo(ticker).items():
+            if v and (not perfil.get(k) or (k == 'isin' and not _isin_valido(perfil.get('isin')))): perfil[k] = v
+    if not perfil.get('nombre'): return None
+    return {
+        'nombre': perfil['nombre'],
+        'descripcion': perfil.get('descripcion') or SIN_DESCRIPCION,
+        'isin': perfil['isin'] if _isin_valido(perfil.get('isin')) else "",
+        'logo_url': perfil.get('logo_url') or url_logo(ticker),
+    }
+
+# --- ALMACÉN PERSISTENTE ---
+class AlmacenMetadatos:
+    """Nombre, ISIN, logo y descripción traducida por ticker, en SQLite y sin caducidad.
+
+    Los precios van por `cotizaciones`; aquí sólo se paga `.info` y el traductor una vez por ticker/idioma.
+    """
+
+    def __init__(self, api_key=None, nombre=ARCHIVO_METADATOS):
+        self.api_key, self.nombre = api_key, nombre
+        self._perfiles, self._descripciones, self._fallidos, self._traducciones_fallidas = {}, {}, {}, {}
+        self._lock = threading.Lock()
+        with conectar(self.nombre) as con:
+            con.execute("""CREATE TABLE IF NOT EXISTS perfiles (
+                ticker TEXT PRIMARY KEY, nombre TEXT, isin TEXT, logo_url TEXT, descripcion_original TEXT, actualizado REAL)""")
+            con.execute("""CREATE TABLE IF NOT EXISTS descripciones (
+                ticker TEXT, idioma TEXT, texto TEXT, PRIMARY KEY (ticker, idioma))""")
+
+    def perfil(self, ticker):
+        """{'nombre', 'isin', 'logo_url', 'descripcion_original'} o None si no se encuentra."""
+        with self._lock:
+            if ticker in self._perfiles: return self._perfiles[ticker]
+        with conectar(self.nombre) as con:
+            fila = con.execute("SELECT nombre, isin, logo_url, descripcion_original FROM perfiles WHERE ticker=?", (ticker,)).fetchone()
+        if fila is None:
+            # Un fallo de red no se persiste; se reintenta pasados 10 minutos
+            if time.monotonic() - self._fallidos.get(ticker, -1e9) < 600: return None
+            datos = descargar_perfil(ticker, self.api_key)
+            if datos is None:
+                self._fallidos[ticker] = time.monotonic()
+                return None
+            fila = (datos['nombre'], datos['isin'], datos['logo_url'], datos['descripcion'])
+            with conectar(self.nombre) as con:
+                con.execute("INSERT OR REPLACE INTO perfiles VALUES (?, ?, ?, ?, ?, ?)", (ticker, *fila, time.time()))
+        perfil = dict(zip(('nombre', 'isin', 'logo_url', 'descripcion_original'), fila))
+        with self._lock: self._perfiles[ticker] = perfil
+        return perfil
+
+    def nombre_empresa(self, ticker):
+        p = self.perfil(ticker)
+        return p['nombre'] if p else None
+
+    def isin(self, ticker):
+        p = self.perfil(ticker)
+        return p['isin'] if p else ""
+
+    def descripcion(self, ticker, idioma="es"):
+        """Descripción traducida a `idioma`; la traducción se hace una sola vez y queda guardada."""
+        clave = (ticker, idioma)
+        with self._lock:
+            if clave in self._descripciones: return self._descripciones[clave]
+        with conectar(self.nombre) as con:
+            fila = con.execute("SELECT texto FROM descripciones WHERE ticker=? AND idioma=?", clave).fetchone()
+        if fila is not None: texto = fila[0]
+        else:
+            p = self.perfil(ticker)
+            if p is None: return None
+            # Sólo se guarda una traducción real; si falla se muestra el original y se reintenta a los 10 minutos
+            if time.monotonic() - self._traducciones_fallidas.get(clave, -1e9) < 600: return p['descripcion_original']
+            texto = traducir_texto(p['descripcion_original'], idioma)
+            if texto is None:
+                self._traducciones_fallidas[clave] = time.monotonic()
+                return p['descripcion_original']
+            with conectar(self.nombre) as con:
+                con.execute("INSERT OR REPLACE INTO descripciones VALUES (?, ?, ?)", (ticker, idioma, texto))
+        with self._lock: self._descripciones[clave] = texto
+        return texto
@@ -0,0 +1,386 @@
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+MONEDA_BASE = "EUR"
+TODOS_LOS_AÑOS = "Todos los años"
+# Sube al cambiar la forma del estado del motor (invalida snapshots persistidos)
+VERSION_ESTADO = 7
+_SIN_MOVIMIENTOS = pd.DataFrame()
+MARGEN_VENTA_TOTAL = (0.98, 1.02)  # Una venta entre el 98 % y el 102 % de la posición la cierra entera
+RESIDUO_ACCIONES = 0.000001        # Por debajo, la posición se da por cerrada
+
+# --- PREPARACIÓN VECTORIZADA DE COLUMNAS ---
+def _columna_num(ops, col, defecto):
+    if col not in ops.columns: return np.full(len(ops), defecto, dtype=float)
+    return pd.to_numeric(ops[col], errors='coerce').fillna(defecto).to_numpy(dtype=float)
+
+def _columna_txt(ops, col, defecto):
+    if col not in ops.columns: return np.full(len(ops), defecto, dtype=object)
+    return ops[col].astype(object).fillna(defecto).astype(str).to_numpy(dtype=object)  # admite categóricas
+
+# --- PRE-PASE DE DIVISAS (cambio histórico para las operaciones sin Cambio) ---
+def _cambio_asof(fechas, serie):
+    """Cambio de `serie` para cada fecha: último cierre de los 3 días previos o, si no hay, el más cercano."""
+    izq = pd.DataFrame({'Fecha': pd.DatetimeIndex(fechas).normalize().astype('datetime64[ns]'), 'i': np.arange(len(fechas))}).sort_values('Fecha')
+    der = pd.DataFrame({'Fecha': pd.DatetimeIndex(serie.index).astype('datetime64[ns]'), 'Cambio': serie.to_numpy(dtype=float)}).sort_values('Fecha')
+    unidos = pd.merge_asof(izq, der, on='Fecha', direction='backward', tolerance=pd.Timedelta(days=3))
+    huecos = unidos['Cambio'].isna().to_numpy()
+    if huecos.any():
+        unidos.loc[huecos, 'Cambio'] = pd.merge_asof(izq[huecos], der, on='Fecha', direction='nearest')['Cambio'].to_numpy()
+    cambio = np.empty(len(fechas))
+    cambio[unidos['i'].to_numpy()] = unidos['Cambio'].to_numpy()
+    return cambio
+
+def completar_cambios(ops, serie_cambio=None):
+    """FX de cada operación y máscaras de las autocompletadas y de las que se quedan sin cambio.
+
+    Se usa el Cambio guardado; si falta (1.0 / <= 0) en una operación en divisa, el histórico
+    de su fecha, resuelto en bloque por moneda con `serie_cambio(moneda)` (Series diaria de cierres).
+    Sin histórico de su moneda (sin red, aún no descargado) la fila queda a 1.0 y en `sin_resolver`.
+    """
+    monedas, cambios = _columna_txt(ops, 'Moneda', MONEDA_BASE), _columna_num(ops, 'Cambio', 1.0)
+    fx = np.ones(len(ops))
+    extranjera = monedas != MONEDA_BASE
+    valido = extranjera & (cambios != 1.0) & (cambios > 0)
+    fx[valido] = cambios[valido]
+    auto = extranjera & ~valido
+    sin_resolver = auto.copy()
+    if auto.any() and serie_cambio is not None:
+        fechas = ops['Fecha_dt'].to_numpy()
+        for mon in pd.unique(monedas[auto]):
+            filas = np.flatnonzero(auto & (monedas == mon))
+            serie = serie_cambio(mon)
+            if serie is not None and not serie.empty:
+                fx[filas] = _cambio_asof(fechas[filas], serie)
+                sin_resolver[filas] = False
+    return fx, auto, sin_resolver
+
+def _informe_cambios(ops, fx, auto, sin_resolver):
+    if not auto.any(): return []
+    fx = np.where(sin_resolver, np.nan, fx)  # Sin histórico: se ve como hueco, no como un cambio de 1.0
+    return pd.DataFrame({
+        'Ticker': _tickers(ops)[auto], 'Fecha': _columna_txt(ops, 'Fecha_str', '')[auto],
+        'Moneda': _columna_txt(ops, 'Moneda', MONEDA_BASE)[auto], 'Cambio Aplicado': fx[auto]
+    }).to_dict('records')
+
+def cambios_autocompletados(ops, serie_cambio=None):
+    """Informe de las operaciones cuyo Cambio se ha tomado del histórico."""
+    return _informe_cambios(ops, *completar_cambios(ops, serie_cambio))
+
+# --- COLA DE LOTES FIFO ---
+class Lote:
+    """Lote de compra. Admite lectura tipo dict (`lote['fecha_str']`) como las tablas de lotes."""
+    __slots__ = ('fecha', 'fecha_str', 'acciones_restantes', 'coste_por_accion_eur')
+
+    def __init__(self, fecha, fecha_str, acciones_restantes, coste_por_accion_eur):
+        self.fecha, self.fecha_str = fecha, fecha_str
+        self.acciones_restantes, self.coste_por_accion_eur = acciones_restantes, coste_por_accion_eur
+
+    def __getitem__(self, campo): return getattr(self, campo)
+
+class ColaLotes:
+    """Cola FIFO de lotes con consumo O(1) por la cabeza y totales de acciones/coste mantenidos al vuelo."""
+    __slots__ = ('_cola', '_columnas', 'acciones', 'coste')
+
+    def __init__(self):
+        self._cola, self._columnas = deque(), None
+        self.acciones, self.coste = 0.0, 0.0
+
+    @property
+    def _lotes(self):
+        # Una cola leída de un snapshot no crea sus objetos Lote hasta que se usa
+        if self._columnas is not None:
+            fechas, fechas_str, acciones, costes = self._columnas
+            self._cola, self._columnas = deque(map(Lote, list(fechas), fechas_str, acciones.tolist(), costes.tolist())), None
+        return self._cola
+
+    def __len__(self): return len(self._columnas[1]) if self._columnas is not None else len(self._cola)
+    def __iter__(self): return iter(self._lotes)
+    def __getitem__(self, i): return self._lotes[i]
+
+    # Se persiste por columnas (arrays + lista de str): mucho más barato de (des)serializar que un objeto por lote
+    def __getstate__(self):
+        if self._columnas is not None: return (*self._columnas, self.acciones, self.coste)
+        lotes = self._cola
+        return (np.array([l.fecha for l in lotes], dtype='datetime64[ns]'), [l.fecha_str for l in lotes],
+                np.array([l.acciones_restantes for l in lotes], dtype=float), np.array([l.coste_por_accion_eur for l in lotes], dtype=float),
+                self.acciones, self.coste)
+    def __setstate__(self, estado):
+        *columnas, self.acciones, self.coste = estado
+        self._cola, self._columnas = None, tuple(columnas)
+
+    def añadir(self, fecha, fecha_str, acciones, coste_por_accion):
+        self._lotes.append(Lote(fecha, fecha_str, acciones, coste_por_accion))
+        self.acciones += acciones
+        self.coste += acciones * coste_por_accion
+
+    def consumir(self, acciones_a_vender):
+        """Consume `acciones_a_vender` desde el lote más antiguo; devuelve [(lote, cantidad_consumida)]."""
+        consumos = []
+        lotes = self._lotes
+        while acciones_a_vender > 0.00000001 and lotes:
+            lote = lotes[0]
+            if lote.acciones_restantes <= acciones_a_vender + 0.000001:
+                cantidad = lote.acciones_restantes
+                acciones_a_vender -= cantidad
+                _ = lotes.popleft()
+            else:
+                cantidad = acciones_a_vender
+                lote.acciones_restantes -= cantidad
+                acciones_a_vender = 0
+            self.acciones -= cantidad
+            self.coste -= cantidad * lote.coste_por_accion_eur
+            consumos.append((lote, cantidad))
+        if not lotes: self.acciones, self.coste = 0.0, 0.0
+        return consumos
+
+CLAVES_TOTALES = ('total_div', 'total_comi', 'pnl_cerrado', 'compras_eur', 'ventas_coste')
+
+def acciones_vendidas(acciones_venta, acciones_en_cartera):
+    """PROTECCIÓN ANTI-DECIMALES: acciones que se venden de verdad, sin dejar residuos de redondeo."""
+    if acciones_en_cartera > 0 and MARGEN_VENTA_TOTAL[0] < acciones_venta / acciones_en_cartera < MARGEN_VENTA_TOTAL[1]:
+        return acciones_en_cartera
+    return acciones_venta
+
+def totales_vacios():
+    return dict.fromkeys(CLAVES_TOTALES, 0.0)
+
+def roi_vacio():
+    return {'fecha': np.empty(0, dtype='datetime64[ns]'), 'delta_profit': np.empty(0), 'delta_invest': np.empty(0)}
+
+def resultado_vacio():
+    """Estado del motor, independiente del año: totales y líneas fiscales van por ejercicio."""
+    return {
+        'cartera': {}, 'colas_fifo': {}, 'fiscal_por_año': {}, 'totales_por_año': {}, 'roi_log': roi_vacio(), 'validaciones_pendientes': [], 'cambios_autocompletados': [],
+        'cambios_sin_resolver': 0,
+    }
+
+# --- MOTOR FIFO ---
+def ordenar_operaciones(df):
+    """Orden cronológico estable para que el FIFO sea perfecto."""
+    return df.sort_values(by="Fecha_dt", kind="mergesort")
+
+def _tickers(ops):
+    if 'Ticker' not in ops.columns: return np.full(len(ops), 'None', dtype=object)
+    return ops['Ticker'].astype(str).str.strip().to_numpy(dtype=object)
+
+def detectar_validaciones(ops):
+    """VALIDACIÓN: operaciones en divisa con Cambio = 1.0 (olvido en edición manual)."""
+    monedas, cambios = _columna_txt(ops, 'Moneda', MONEDA_BASE), _columna_num(ops, 'Cambio', 1.0)
+    sin_cambio = (monedas != MONEDA_BASE) & (cambios == 1.0)
+    fechas_str = _columna_txt(ops, 'Fecha_str', 'None')
+    return [f"{t} | {f}" for t, f in zip(_tickers(ops)[sin_cambio], fechas_str[sin_cambio])]
+
+def adjuntar_movimientos(res, ops):
+    """Asigna a cada posición de `cartera` su tramo del libro (con la columna Fecha_Raw)."""
+    if ops is None or ops.empty: return res
+    movs = ops.assign(Fecha_Raw=ops['Fecha_dt'])
+    for tick, grupo in movs.groupby(_tickers(ops), sort=False):
+        if tick in res['cartera']: res['cartera'][tick]['movimientos'] = grupo
+    return res
+
+def _sumar_por_año(destino, clave, años, valores):
+    for año, valor in pd.Series(valores).groupby(años).sum().items():
+        destino.setdefault(int(año), totales_vacios())[clave] += float(valor)
+
+def aplicar_operaciones(res, ops, serie_cambio=None):
+    """Aplica `ops` (ya ordenadas) sobre el estado `res`, que se modifica y devuelve.
+
+    Una sola pasada para todos los ejercicios: totales, líneas fiscales y P&L por ticker
+    quedan repartidos por año y `vista_año` elige después el que se muestra. Los avisos de
+    Cambio se acumulan con el estado, así que reanudar un checkpoint no recorre todo el libro.
+    """
+    if ops is None or ops.empty: return res
+    n = len(ops)
+
+    tipos = _columna_txt(ops, 'Tipo', '')
+    ticks = _tickers(ops)
+    monedas = _columna_txt(ops, 'Moneda', MONEDA_BASE)
+    dinero = _columna_num(ops, 'Cantidad', 0.0)
+    precio = _columna_num(ops, 'Precio', 1.0)
+    comi = _columna_num(ops, 'Comision', 0.0)
+    fechas_dia = np.array([f.split(' ')[0] for f in _columna_txt(ops, 'Fecha_str', '')], dtype=object)
+    años = (ops['Año'] if 'Año' in ops.columns else ops['Fecha_dt'].dt.year).to_numpy(dtype=np.int64)
+    descs = ops['Descripcion'].to_numpy(dtype=object) if 'Descripcion' in ops.columns else ticks
+
+    fx, auto, sin_resolver = completar_cambios(ops, serie_cambio)
+    res['validaciones_pendientes'].extend(detectar_validaciones(ops))
+    res['cambios_autocompletados'].extend(_informe_cambios(ops, fx, auto, sin_resolver))
+    # Filas valoradas a 1.0 por falta de histórico: el estado no es definitivo y no se persiste
+    res['cambios_sin_resolver'] += int(sin_resolver.sum())
+    dinero_eur = dinero * fx
+    comi_eur = comi * fx
+    precio = np.where(precio <= 0, 1.0, precio)
+    acciones_op = np.round(dinero / precio, 8)
+
+    es_compra, es_div = tipos == "Compra", tipos == "Dividendo"
+    # --- FIX FISCAL V32.45: SUMAR COMISION AL COSTE BASE ---
+    coste_compra = dinero_eur + comi_eur
+
+    # Totales que no dependen del orden FIFO
+    tot = res['totales_por_año']
+    _sumar_por_año(tot, 'total_comi', años, comi_eur)
+    _sumar_por_año(tot, 'total_div', años, np.where(es_div, dinero_eur, 0.0))
+    _sumar_por_año(tot, 'compras_eur', años, np.where(es_compra, coste_compra, 0.0))
+
+    beneficios, costes_venta = [0.0] * n, [0.0] * n
+    lineas_fiscales = {}
+
+    # Partición por ticker (orden de primera aparición)
+    codigos, tickers = pd.factorize(ticks)
+    orden = np.argsort(codigos, kind='stable')
+    cortes = np.flatnonzero(np.diff(codigos[orden])) + 1
+
+    tipos_l, acc_l = tipos.tolist(), acciones_op.tolist()
+    fechas_dt = list(ops['Fecha_dt'].to_numpy())
+    neto_l, coste_l = (dinero_eur - comi_eur).tolist(), coste_compra.tolist()
+    bruto_l, gastos_l = dinero_eur.tolist(), comi_eur.tolist()
+
+    for tick, pos in zip(tickers, np.split(orden, cortes)):
+        if tick not in res['cartera']:
+            primera = pos[0]
+            desc_ini = descs[primera]
+            if desc_ini is None or (isinstance(desc_ini, float) and np.isnan(desc_ini)): desc_ini = tick
+            res['colas_fifo'][tick] = ColaLotes()
+            res['cartera'][tick] = {'acciones': 0.0, 'coste_total_eur': 0.0, 'desc': desc_ini, 'pnl_por_año': {}, 'pmc': 0.0, 'moneda_origen': monedas[primera], 'movimientos': _SIN_MOVIMIENTOS, 'lotes': res['colas_fifo'][tick]}
+        info, lotes = res['cartera'][tick], res['colas_fifo'][tick]
+        acciones, coste, pmc = info['acciones'], info['coste_total_eur'], info['pmc']
+
+        for p in pos.tolist():
+            tipo = tipos_l[p]
+            if tipo == "Compra":
+                acc = acc_l[p]
+                acciones += acc
+                coste += coste_l[p]
+                lotes.añadir(fechas_dt[p], fechas_dia[p], acc, coste_l[p] / acc if acc > 0 else 0)
+                if acciones > 0: pmc = coste / acciones
+
+            elif tipo == "Venta":
+                # --- PROTECCIÓN ANTI-DECIMALES (Limpieza de residuos) ---
+                acciones_a_vender = acciones_vendidas(acc_l[p], acciones)
+
+                valor_transmision_neto_total = neto_l[p]
+                precio_venta_neto_unitario = valor_transmision_neto_total / acciones_a_vender if acciones_a_vender > 0 else 0
+
+                coste_total_venta_fifo = 0.0
+                for lote, cantidad_consumida in lotes.consumir(acciones_a_vender):
+                    v_adquisicion = cantidad_consumida * lote.coste_por_accion_eur
+                    coste_total_venta_fifo += v_adquisicion
+
+                    v_transmision = cantidad_consumida * precio_venta_neto_unitario
+                    lineas_fiscales.setdefault(p, []).append({
+                        "Tipo": "Ganancia/Pérdida", "Ticker": tick, "Empresa": info['desc'],
+                        "Fecha Venta": fechas_dia[p], "Fecha Compra": lote.fecha_str, "Cantidad": cantidad_consumida,
+                        "V. Transmisión": v_transmision, "V. Adquisición": v_adquisicion, "Rendimiento": v_transmision - v_adquisicion
+                    })
+
+                beneficios[p] = valor_transmision_neto_total - coste_total_venta_fifo
+                costes_venta[p] = coste_total_venta_fifo
+
+                coste -= coste_total_venta_fifo
+                # RE-SINCRO: total de acciones de los lotes FIFO restantes (contador incremental de la cola)
+                acciones = lotes.acciones
+                if acciones < RESIDUO_ACCIONES: acciones, coste, pmc = 0.0, 0.0, 0.0
+                else: pmc = coste / acciones
+
+            elif tipo == "Dividendo":
+                lineas_fiscales[p] = [{
+                    "Tipo": "Dividendo", "Ticker": tick, "Empresa": info['desc'], "Fecha": fechas_dia[p],
+                    "Bruto": bruto_l[p], "Gastos": gastos_l[p], "Neto": neto_l[p]
+                }]
+
+        info['acciones'], info['coste_total_eur'], info['pmc'] = acciones, coste, pmc
+
+    for p in sorted(lineas_fiscales): res['fiscal_por_año'].setdefault(int(años[p]), []).extend(lineas_fiscales[p])
+
+    # Realizado por ejercicio, global y por ticker
+    beneficios, costes_venta = np.asarray(beneficios), np.asarray(costes_venta)
+    es_venta = tipos == "Venta"
+    _sumar_por_año(tot, 'pnl_cerrado', años, beneficios)
+    _sumar_por_año(tot, 'ventas_coste', años, costes_venta)
+    if es_venta.any():
+        realizado = pd.Series(beneficios[es_venta]).groupby([codigos[es_venta], años[es_venta]]).sum()
+        for (codigo, año), valor in realizado.items():
+            pnl = res['cartera'][tickers[codigo]]['pnl_por_año']
+            pnl[int(año)] = pnl.get(int(año), 0.0) + float(valor)
+
+    # Evolución ROI: deltas por operación en orden cronológico, como arrays (un tramo por llamada)
+    roi = res['roi_log']
+    roi['fecha'] = np.concatenate((roi['fecha'], ops['Fecha_dt'].to_numpy(dtype='datetime64[ns]')))
+    roi['delta_profit'] = np.concatenate((roi['delta_profit'], -comi_eur + np.where(es_div, dinero_eur, 0.0) + beneficios))
+    roi['delta_invest'] = np.concatenate((roi['delta_invest'], np.where(es_compra, coste_compra, 0.0)))
+    return res
+
+def calcular_estado(df, serie_cambio=None):
+    """Replay FIFO completo del libro de operaciones, agrupado por ticker, para todos los años."""
+    res = resultado_vacio()
+    if df is None or df.empty: return res
+    ops = ordenar_operaciones(df)
+    aplicar_operaciones(res, ops, serie_cambio)
+    return adjuntar_movimientos(res, ops)
+
+# --- VISTA DE UN EJERCICIO ---
+def _con_isin(lineas, resolver_isin):
+    """Copia de las líneas de venta con su ISIN; se resuelve al mostrar, nunca se guarda en el estado."""
+    isins = {}
+    def isin(tick):
+        if tick not in isins: isins[tick] = (resolver_isin(tick) if resolver_isin else None) or ""
+        return isins[tick]
+    return [{'Tipo': l['Tipo'], 'Ticker': l['Ticker'], 'Empresa': l['Empresa'], 'ISIN': isin(l['Ticker']), **l}
+            if l['Tipo'] == "Ganancia/Pérdida" else l for l in lineas]
+
+def vista_año(res, año_seleccionado=TODOS_LOS_AÑOS, resolver_isin=None):
+    """Proyección del estado sobre un año (o todos): elegir bucket, sin recalcular nada.
+
+    Devuelve un dict con `cartera`, `colas_fifo`, `reporte_fiscal_log`, `roi_log`,
+    `validaciones_pendientes`, `cambios_autocompletados`, `cambios_sin_resolver`, `totales` y
+    `totales_por_año`. El ISIN de las ventas se pide a `resolver_isin(ticker)` en cada proyección.
+    """
+    if año_seleccionado == TODOS_LOS_AÑOS: años = sorted(res['totales_por_año'])
+    else: años = [int(año_seleccionado)]
+    totales = totales_vacios()
+    for año in años:
+        for clave, valor in res['totales_por_año'].get(año, {}).items(): totales[clave] += valor
+    cartera = {t: {**i, 'pnl_cerrado': sum(i['pnl_por_año'].get(a, 0.0) for a in años)} for t, i in res['cartera'].items()}
+    return {
+        'cartera': cartera, 'colas_fifo': res['colas_fifo'], 'roi_log': res['roi_log'],
+        'reporte_fiscal_log': _con_isin([l for año in años for l in res['fiscal_por_año'].get(año, [])], resolver_isin),
+        'validaciones_pendientes': res['validaciones_pendientes'], 'cambios_autocompletados': res['cambios_autocompletados'],
+        'cambios_sin_resolver': res['cambios_sin_resolver'],
+        'totales': totales, 'totales_por_año': res['totales_por_año'],
+    }
+
+# --- EVOLUCIÓN DEL ROI ---
+GRANULARIDADES_ROI = ("Diaria", "Semanal", "Mensual")
+
+def _periodo_roi(dias, granularidad):
+    """Etiqueta de cada día (datetime64[D]) como en `resample`: el propio día, el domingo de su semana o fin de mes."""
+    if granularidad == "Diaria": return dias
+    if granularidad == "Semanal": return dias + (6 - (dias.astype(np.int64) + 3) % 7)  # 1970-01-01 fue jueves
+    return (dias.astype('datetime64[M]') + 1).astype('datetime64[D]') - 1
+
+def serie_roi(roi_log, granularidad="Semanal", año_seleccionado=TODOS_LOS_AÑOS):
+    """ROI acumulado (%) por periodo: beneficio acumulado / inversión acumulada, sin huecos entre periodos."""
+    fechas, delta_p, delta_i = roi_log['fecha'], roi_log['delta_profit'], roi_log['delta_invest']
+    if año_seleccionado != TODOS_LOS_AÑOS:
+        del_año = fechas.astype('datetime64[Y]').astype(np.int64) + 1970 == int(año_seleccionado)
+        fechas, delta_p, delta_i = fechas[del_año], delta_p[del_año], delta_i[del_año]
+    if len(fechas) == 0: return pd.DataFrame({'Fecha': pd.DatetimeIndex([]), 'ROI': np.empty(0)})
+    etiquetas, grupo = np.unique(_periodo_roi(fechas.astype('datetime64[D]'), granularidad), return_inverse=True)
+    cum_p = np.cumsum(np.bincount(grupo, weights=delta_p))
+    cum_i = np.cumsum(np.bincount(grupo, weights=delta_i))
+    # Rejilla continua de periodos: los vacíos arrastran el acumulado del anterior
+    if granularidad == "Mensual": rejilla = _periodo_roi(np.arange(etiquetas[0].astype('datetime64[M]'), etiquetas[-1].astype('datetime64[M]') + 1).astype('datetime64[D]'), granularidad)
+    else: rejilla = np.arange(etiquetas[0], etiquetas[-1] + 1, 7 if granularidad == "Semanal" else 1)
+    pos = np.searchsorted(etiquetas, rejilla, side='right') - 1
+    cum_p, cum_i = cum_p[pos], cum_i[pos]
+    roi = np.divide(cum_p * 100, cum_i, out=np.zeros_like(cum_p), where=cum_i > 0)
+    return pd.DataFrame({'Fecha': pd.DatetimeIndex(rejilla), 'ROI': roi})
+
+def calcular_cartera(df, año_seleccionado=TODOS_LOS_AÑOS, resolver_isin=None, serie_cambio=None):
+    """`calcular_estado` + `vista_año`. `resolver_isin(ticker)` y `serie_cambio(moneda)` son
+    opcionales; sin ellos el ISIN queda vacío y el cambio ausente vale 1.0.
+    """
+    return vista_año(calcular_estado(df, serie_cambio), año_seleccionado, resolver_isin)
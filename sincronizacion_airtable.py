@@ -0,0 +1,102 @@
+import json
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from almacen_local import conectar
+
+ARCHIVO_ESPEJO = "espejo_airtable.sqlite"
+# Claves de vista (espejo, Parquet, snapshots, cachés): la de un usuario lleva prefijo, así que
+# ningún nombre de usuario puede coincidir con la vista admin ni con la de otro usuario
+PREFIJO_VISTA_USUARIO = "usuario:"
+VISTA_TODOS = "admin:todos"
+# Columnas que usan el motor, el historial y los PDF; el resto de campos no viaja
+CAMPOS_LIBRO = ["Usuario", "Fecha", "Ticker", "Tipo", "Cantidad", "Precio", "Comision", "Moneda", "Cambio", "Descripcion"]
+MARGEN_RELOJ = 120                # Segundos que se solapan los deltas por desfase de reloj con Airtable
+RESINCRONIZACION_COMPLETA = 86400 # Los borrados no aparecen en un delta: lectura completa una vez al día
+
+def _literal(texto):
+    return "'" + str(texto).replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+def formula_campo(campo, valor):
+    return "{" + campo + "}=" + _literal(valor)
+
+def formula_usuario(usuario):
+    return formula_campo("Usuario", usuario)
+
+def vista_usuario(usuario):
+    return PREFIJO_VISTA_USUARIO + usuario
+
+def formula_vista(vista):
+    """Filtro de Airtable de una vista: las filas de su usuario, o ninguno para VISTA_TODOS."""
+    return formula_usuario(vista[len(PREFIJO_VISTA_USUARIO):]) if vista.startswith(PREFIJO_VISTA_USUARIO) else None
+
+def formula_modificados_desde(instante):
+    return f"IS_AFTER(LAST_MODIFIED_TIME(), DATETIME_PARSE('{instante.strftime('%Y-%m-%dT%H:%M:%S.000Z')}'))"
+
+def _y(*formulas):
+    formulas = [f for f in formulas if f]
+    if not formulas: return None
+    return formulas[0] if len(formulas) == 1 else f"AND({', '.join(formulas)})"
+
+class EspejoAirtable:
+    """Copia local (SQLite) de la tabla de operaciones, por vista: `vista_usuario(u)` o VISTA_TODOS.
+
+    La primera lectura de una vista trae sólo sus filas (`formula`) y sus columnas (`fields`);
+    las siguientes piden únicamente lo modificado desde la última marca (`LAST_MODIFIED_TIME()`)
+    y lo fusionan por id de registro.
+    """
+
+    def __init__(self, table, campos=CAMPOS_LIBRO, nombre=ARCHIVO_ESPEJO):
+        self.table, self.campos, self.nombre = table, list(campos), nombre
+        self._lock, self._locks_vista = threading.Lock(), {}
+        with conectar(self.nombre) as con:
+            con.execute("CREATE TABLE IF NOT EXISTS registros (vista TEXT, id TEXT, campos TEXT, PRIMARY KEY (vista, id))")
+            con.execute("CREATE TABLE IF NOT EXISTS marcas (vista TEXT PRIMARY KEY, watermark TEXT, completa REAL)")
+            # Vistas guardadas con las claves antiguas (nombre de usuario a secas, "__todos__")
+            for tabla in ("registros", "marcas"):
+                con.execute(f"DELETE FROM {tabla} WHERE vista NOT LIKE ? AND vista != ?", (PREFIJO_VISTA_USUARIO + "%", VISTA_TODOS))
+
+    def _marca(self, vista):
+        with conectar(self.nombre) as con:
+            fila = con.execute("SELECT watermark, completa FROM marcas WHERE vista=?", (vista,)).fetchone()
+        return (datetime.fromisoformat(fila[0]), fila[1]) if fila else (None, None)
+
+    def _descargar(self, formula):
+        kwargs = {'formula': formula} if formula else {}
+        try: return self.table.all(fields=self.campos, **kwargs)
+        except Exception as e:
+            # 422 UNKNOWN_FIELD_NAME: la tabla no tiene alguna de las columnas proyectadas
+            if getattr(getattr(e, 'response', None), 'status_code', None) != 422: raise
+            return self.table.all(**kwargs)
+
+    def sincronizar(self, vista, formula_base=None, completa=False):
+        """Trae a la vista lo nuevo o editado en Airtable. Devuelve ([registros recibidos], si fue completa)."""
+        with self._lock: lock_vista = self._locks_vista.setdefault(vista, threading.Lock())
+        with lock_vista:
+            watermark, ultima_completa = self._marca(vista)
+            completa = completa or watermark is None or time.time() - (ultima_completa or 0) > RESINCRONIZACION_COMPLETA
+            inicio = datetime.now(timezone.utc) - timedelta(seconds=MARGEN_RELOJ)
+            formula = formula_base if completa else _y(formula_base, formula_modificados_desde(watermark))
+            registros = self._descargar(formula)
+            with conectar(self.nombre) as con:
+                if completa: con.execute("DELETE FROM registros WHERE vista=?", (vista,))
+                con.executemany("INSERT OR REPLACE INTO registros VALUES (?, ?, ?)",
+                                [(vista, r['id'], json.dumps(r.get('fields', {}))) for r in registros])
+                con.execute("INSERT OR REPLACE INTO marcas VALUES (?, ?, ?)",
+                            (vista, inicio.isoformat(), time.time() if completa else ultima_completa))
+            return registros, completa
+
+    def fusionar(self, vista, registros):
+        """Añade a una vista ya sincronizada registros recién escritos desde la app, sin ir a Airtable."""
+        if self._marca(vista)[0] is None: return False
+        with conectar(self.nombre) as con:
+            con.executemany("INSERT OR REPLACE INTO registros VALUES (?, ?, ?)",
+                            [(vista, r['id'], json.dumps(r.get('fields', {}))) for r in registros])
+        return True
+
+    def registros(self, vista):
+        """Registros de la vista con la forma de `table.all()`: [{'id', 'fields'}]."""
+        with conectar(self.nombre) as con:
+            filas = con.execute("SELECT id, campos FROM registros WHERE vista=?", (vista,)).fetchall()
+        return [{'id': i, 'fields': json.loads(c)} for i, c in filas]
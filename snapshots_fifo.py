@@ -0,0 +1,145 @@
+import pickle
+import sys
+
+import numpy as np
+import pandas as pd
+
+import motor_fifo
+from almacen_local import conectar
+
+ARCHIVO_SNAPSHOTS = "snapshots_fifo.sqlite"
+# Columnas que alteran el resultado del motor: si cambian, la huella cambia
+COLUMNAS_HUELLA = ['Fecha_dt', 'Ticker', 'Tipo', 'Cantidad', 'Precio', 'Comision', 'Moneda', 'Cambio', 'Descripcion']
+BYTES_POR_LOTE = 200  # Lote con __slots__ + Timestamp + str de fecha
+
+# --- HUELLA ACUMULADA DEL LIBRO ---
+def huellas_acumuladas(ops):
+    """Hash acumulado (uint64, independiente del orden) de las operaciones hasta cada fila de `ops` ordenado."""
+    cols = [c for c in COLUMNAS_HUELLA if c in ops.columns]
+    return np.cumsum(pd.util.hash_pandas_object(ops[cols], index=False).to_numpy(dtype=np.uint64), dtype=np.uint64)
+
+class AlmacenSnapshots:
+    """Checkpoints del motor FIFO por (usuario, vista): fin de cada año y última operación.
+
+    Las líneas fiscales de un ejercicio ya cerrado no cambian, así que cada checkpoint guarda
+    sólo las de su propio año (`fiscal`) y el resto del estado (`estado`); al cargar se juntan
+    con las del último checkpoint de cada año anterior.
+    """
+
+    def __init__(self, nombre=ARCHIVO_SNAPSHOTS):
+        self.nombre = nombre
+        with conectar(self.nombre) as con:
+            con.execute("""CREATE TABLE IF NOT EXISTS snapshots (
+                usuario TEXT, vista TEXT, watermark TEXT, n_ops INTEGER, huella TEXT, estado BLOB, fiscal BLOB,
+                PRIMARY KEY (usuario, vista, watermark))""")
+            if 'fiscal' not in [c[1] for c in con.execute("PRAGMA table_info(snapshots)")]:
+                con.execute("ALTER TABLE snapshots ADD COLUMN fiscal BLOB")
+            # Checkpoints de otra versión del motor ya no son legibles
+            con.execute("DELETE FROM snapshots WHERE vista NOT LIKE ?", (f"v{motor_fifo.VERSION_ESTADO}|%",))
+
+    def listar(self, usuario, vista):
+        with conectar(self.nombre) as con:
+            filas = con.execute("SELECT watermark, n_ops, huella FROM snapshots WHERE usuario=? AND vista=? ORDER BY watermark",
+                                (usuario, vista)).fetchall()
+        return [(pd.Timestamp(w), n, int(h)) for w, n, h in filas]
+
+    def cargar(self, usuario, vista, watermark):
+        with conectar(self.nombre) as con:
+            fila = con.execute("SELECT estado FROM snapshots WHERE usuario=? AND vista=? AND watermark=?",
+                               (usuario, vista, watermark.isoformat())).fetchone()
+            if fila is None: return None
+            # Hay un checkpoint por año: el último de cada ejercicio lleva sus líneas definitivas
+            fiscales = con.execute("SELECT watermark, fiscal FROM snapshots WHERE usuario=? AND vista=? AND watermark<=? ORDER BY watermark",
+                                   (usuario, vista, watermark.isoformat())).fetchall()
+        estado = pickle.loads(fila[0])
+        estado['fiscal_por_año'] = {pd.Timestamp(w).year: pickle.loads(f) for w, f in fiscales if f is not None}
+        return estado
+
+    def guardar(self, usuario, vista, watermark, n_ops, huella, estado):
+        blob = pickle.dumps({**estado, 'fiscal_por_año': {}}, protocol=pickle.HIGHEST_PROTOCOL)
+        fiscal = pickle.dumps(estado['fiscal_por_año'].get(watermark.year, []), protocol=pickle.HIGHEST_PROTOCOL)
+        inicio_año = pd.Timestamp(year=watermark.year, month=1, day=1).isoformat()
+        with conectar(self.nombre) as con:
+            # Un checkpoint intermedio del mismo año queda superado por el nuevo
+            con.execute("DELETE FROM snapshots WHERE usuario=? AND vista=? AND watermark>=? AND watermark<?",
+                        (usuario, vista, inicio_año, watermark.isoformat()))
+            con.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (usuario, vista, watermark.isoformat(), int(n_ops), str(int(huella)), blob, fiscal))
+
+    def invalidar_desde(self, usuario, fecha, vista=None):
+        """Descarta los checkpoints con watermark >= fecha (edición con fecha atrasada)."""
+        sql, args = "DELETE FROM snapshots WHERE usuario=? AND watermark>=?", [usuario, pd.Timestamp(fecha).isoformat()]
+        if vista is not None: sql, args = sql + " AND vista=?", args + [vista]
+        with conectar(self.nombre) as con: con.execute(sql, args)
+
+    def borrar(self, usuario):
+        with conectar(self.nombre) as con: con.execute("DELETE FROM snapshots WHERE usuario=?", (usuario,))
+
+    def borrar_todos(self):
+        """Descarta los checkpoints de todas las vistas (p. ej. al cambiar el almacén común de divisas)."""
+        with conectar(self.nombre) as con: con.execute("DELETE FROM snapshots")
+
+def _estado_persistible(res):
+    """Copia del resultado sin `movimientos` (se reconstruyen del libro en cada ejecución)."""
+    cartera = {t: {k: v for k, v in i.items() if k != 'movimientos'} for t, i in res['cartera'].items()}
+    return {**res, 'cartera': cartera}
+
+def _bytes_registros(registros):
+    """Estimación por muestra: len × tamaño del primer dict (serializar el resultado entero es caro)."""
+    if not registros: return 0
+    muestra = registros[0]
+    return len(registros) * (sys.getsizeof(muestra) + sum(sys.getsizeof(v) for v in muestra.values()))
+
+def tamaño_resultado(res):
+    """Bytes aproximados de un estado del motor (para acotar la memoria de la caché de resultados)."""
+    movimientos = sum(int(i['movimientos'].memory_usage(deep=True).sum()) for i in res['cartera'].values() if 'movimientos' in i)
+    lotes = sum(len(c) for c in res['colas_fifo'].values()) * BYTES_POR_LOTE
+    fiscal = sum(_bytes_registros(lineas) for lineas in res['fiscal_por_año'].values())
+    return movimientos + lotes + fiscal + sum(a.nbytes for a in res['roi_log'].values())
+
+def tamaño_vista(vista):
+    """Bytes propios de una proyección `vista_año`: lotes, movimientos y ROI se comparten con el estado."""
+    return _bytes_registros(vista['reporte_fiscal_log']) + sum(sys.getsizeof(i) for i in vista['cartera'].values())
+
+# --- MOTOR INCREMENTAL ---
+def calcular_estado_incremental(df, usuario, almacen, serie_cambio=None):
+    """Como `motor_fifo.calcular_estado`, pero reanudando desde el último checkpoint válido.
+
+    Un checkpoint es válido si la huella acumulada del libro actual hasta su watermark coincide
+    con la guardada; así una edición con fecha atrasada invalida sólo los posteriores a ella.
+    El estado cubre todos los ejercicios, así que un mismo checkpoint sirve para cualquier año.
+    Desde el primer tramo con operaciones en divisa sin cambio histórico (valoradas a 1.0) no se
+    guarda ningún checkpoint: la huella no cubre las divisas y el error quedaría fijado.
+    """
+    if df is None or df.empty: return motor_fifo.resultado_vacio()
+    vista = f"v{motor_fifo.VERSION_ESTADO}|libro"
+    ops = motor_fifo.ordenar_operaciones(df)
+    fechas = ops['Fecha_dt'].to_numpy()
+    huellas = huellas_acumuladas(ops)
+
+    res, desde = None, 0
+    for watermark, n_ops, huella in reversed(almacen.listar(usuario, vista)):
+        corte = int(np.searchsorted(fechas, np.datetime64(watermark), side='right'))
+        if corte == n_ops and corte > 0 and int(huellas[corte - 1]) == huella:
+            res = almacen.cargar(usuario, vista, watermark)
+            if res is not None:
+                desde = corte
+                break
+        almacen.invalidar_desde(usuario, watermark, vista)
+    if res is None: res = motor_fifo.resultado_vacio()
+
+    # Sólo se reproducen las operaciones posteriores al watermark, cerrando checkpoint por año
+    pendientes = ops.iloc[desde:]
+    if not pendientes.empty:
+        años_pend = pendientes['Fecha_dt'].dt.year.to_numpy()
+        cortes = np.flatnonzero(np.diff(años_pend)) + 1
+        for tramo in np.split(np.arange(len(pendientes)), cortes):
+            motor_fifo.aplicar_operaciones(res, pendientes.iloc[tramo], serie_cambio)
+            fin = desde + int(tramo[-1]) + 1
+            if res['cambios_sin_resolver']: continue
+            almacen.guardar(usuario, vista, pd.Timestamp(fechas[fin - 1]), fin, huellas[fin - 1], _estado_persistible(res))
+
+    return motor_fifo.adjuntar_movimientos(res, ops)
+
+def calcular_cartera_incremental(df, usuario, almacen, año_seleccionado=motor_fifo.TODOS_LOS_AÑOS, resolver_isin=None, serie_cambio=None):
+    return motor_fifo.vista_año(calcular_estado_incremental(df, usuario, almacen, serie_cambio), año_seleccionado, resolver_isin)
@@ -0,0 +1,82 @@
+import pandas as pd
+import pytest
+
+from motor_fifo import TODOS_LOS_AÑOS, calcular_cartera
+
+# Libro escrito a mano: importes en la moneda de la operación, Cantidad = dinero (acciones = Cantidad / Precio)
+LIBRO = [
+    # Fecha,             Ticker, Tipo,        Cantidad, Precio, Comision, Moneda, Cambio
+    ("2023-01-10 10:00", "AAA", "Compra",    1000.00,  10.0,   2.0,      "EUR",  1.0),  # 100 acc. a 10,02
+    ("2023-02-10 10:00", "AAA", "Compra",    1200.00,  12.0,   3.0,      "EUR",  1.0),  # 100 acc. a 12,03
+    ("2023-06-01 10:00", "AAA", "Venta",     1650.00,  11.0,   5.0,      "EUR",  1.0),  # 150 acc.: lote 1 entero + mitad del 2
+    ("2023-09-01 10:00", "AAA", "Dividendo",   20.00,   1.0,   3.0,      "EUR",  1.0),
+    ("2024-03-01 10:00", "AAA", "Venta",      495.99,  10.0,   0.0,      "EUR",  1.0),  # 49,599 de 50 acc.: anti-residuo
+    ("2024-04-01 10:00", "BBB", "Compra",    1000.00, 100.0,   0.0,      "USD",  1.0),  # Cambio olvidado: se toma del histórico
+    ("2024-05-02 10:00", "BBB", "Venta",      550.00, 110.0,   0.0,      "USD",  0.8),
+]
+
+def _libro():
+    df = pd.DataFrame(LIBRO, columns=['Fecha', 'Ticker', 'Tipo', 'Cantidad', 'Precio', 'Comision', 'Moneda', 'Cambio'])
+    df['Fecha_dt'] = pd.to_datetime(df['Fecha'])
+    df['Fecha_str'] = df['Fecha_dt'].dt.strftime('%Y/%m/%d %H:%M')
+    df['Año'] = df['Fecha_dt'].dt.year
+    df['Descripcion'] = df['Ticker'] + " S.A."
+    return df.drop(columns='Fecha')
+
+def _serie_cambio(moneda):
+    assert moneda == "USD"
+    return pd.Series([0.95, 0.9], index=pd.DatetimeIndex(["2024-03-29", "2024-04-01"]))
+
+def _calcular(año=TODOS_LOS_AÑOS):
+    return calcular_cartera(_libro(), año, resolver_isin=lambda t: f"ES000{t}", serie_cambio=_serie_cambio)
+
+def _ventas(res, ticker):
+    return [l for l in res['reporte_fiscal_log'] if l['Tipo'] == "Ganancia/Pérdida" and l['Ticker'] == ticker]
+
+def test_venta_consume_lotes_fifo_parcialmente():
+    lineas = _ventas(_calcular(2023), "AAA")
+    assert [(l['Fecha Compra'], l['Cantidad']) for l in lineas] == [("2023/01/10", pytest.approx(100)), ("2023/02/10", pytest.approx(50))]
+    # Neto de la venta (1650 - 5) repartido por acción vendida
+    assert [l['V. Transmisión'] for l in lineas] == [pytest.approx(1645 * 100 / 150), pytest.approx(1645 * 50 / 150)]
+    assert [l['V. Adquisición'] for l in lineas] == [pytest.approx(1002.0), pytest.approx(601.5)]
+    assert sum(l['Rendimiento'] for l in lineas) == pytest.approx(41.5)
+    assert all(l['ISIN'] == "ES000AAA" for l in lineas)
+
+def test_venta_casi_total_liquida_la_posicion():
+    res = _calcular(2024)
+    (linea,) = _ventas(res, "AAA")
+    assert linea['Cantidad'] == pytest.approx(50)
+    assert linea['V. Transmisión'] == pytest.approx(495.99)
+    assert linea['Rendimiento'] == pytest.approx(495.99 - 601.5)
+    aaa = res['cartera']['AAA']
+    assert (aaa['acciones'], aaa['coste_total_eur'], aaa['pmc']) == (0.0, 0.0, 0.0)
+    assert len(res['colas_fifo']['AAA']) == 0
+
+def test_dividendo_descuenta_gastos():
+    res = _calcular(2023)
+    (div,) = [l for l in res['reporte_fiscal_log'] if l['Tipo'] == "Dividendo"]
+    assert (div['Fecha'], div['Bruto'], div['Gastos'], div['Neto']) == ("2023/09/01", 20.0, 3.0, 17.0)
+    assert res['totales']['total_div'] == pytest.approx(20.0)
+
+def test_cambio_olvidado_se_completa_con_el_historico():
+    res = _calcular(2024)
+    bbb = res['cartera']['BBB']
+    assert bbb['acciones'] == pytest.approx(5)
+    assert bbb['coste_total_eur'] == pytest.approx(450.0)  # 10 acc. a 100 USD × 0,9; quedan 5
+    (linea,) = _ventas(res, "BBB")
+    assert linea['V. Transmisión'] == pytest.approx(550 * 0.8)  # La venta trae su propio Cambio
+    assert linea['V. Adquisición'] == pytest.approx(450.0)
+    assert res['validaciones_pendientes'] == ["BBB | 2024/04/01 10:00"]
+    assert res['cambios_autocompletados'] == [{'Ticker': "BBB", 'Fecha': "2024/04/01 10:00", 'Moneda': "USD", 'Cambio Aplicado': pytest.approx(0.9)}]
+
+def test_totales_por_año():
+    res = _calcular()
+    t2023, t2024 = res['totales_por_año'][2023], res['totales_por_año'][2024]
+    assert t2023['compras_eur'] == pytest.approx(2205.0)
+    assert t2023['total_comi'] == pytest.approx(13.0)
+    assert t2023['pnl_cerrado'] == pytest.approx(41.5)
+    assert t2023['ventas_coste'] == pytest.approx(1603.5)
+    assert t2024['compras_eur'] == pytest.approx(900.0)
+    assert t2024['pnl_cerrado'] == pytest.approx(495.99 - 601.5 - 10.0)
+    assert res['totales']['pnl_cerrado'] == pytest.approx(t2023['pnl_cerrado'] + t2024['pnl_cerrado'])
+    assert res['cartera']['AAA']['pnl_cerrado'] == pytest.approx(41.5 + 495.99 - 601.5)
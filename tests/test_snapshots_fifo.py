@@ -0,0 +1,42 @@
+import pytest
+
+import almacen_local
+import motor_fifo
+from snapshots_fifo import AlmacenSnapshots, calcular_cartera_incremental
+from test_motor_fifo import _libro, _serie_cambio
+
+@pytest.fixture
+def almacen(tmp_path, monkeypatch):
+    monkeypatch.setattr(almacen_local, "DIR_DATOS", str(tmp_path))
+    return AlmacenSnapshots()
+
+def _comparables(res):
+    return {k: res[k] for k in ('reporte_fiscal_log', 'totales', 'validaciones_pendientes', 'cambios_autocompletados')}
+
+def test_reanudar_desde_checkpoint_da_el_replay_completo(almacen):
+    libro = _libro()
+    completo = motor_fifo.calcular_cartera(libro, serie_cambio=_serie_cambio)
+    # Primero el libro hasta 2023 y después entero: la segunda llamada reanuda del checkpoint de 2023
+    _ = calcular_cartera_incremental(libro[libro['Año'] == 2023], "u", almacen, serie_cambio=_serie_cambio)
+    reanudado = calcular_cartera_incremental(libro, "u", almacen, serie_cambio=_serie_cambio)
+    assert _comparables(reanudado) == _comparables(completo)
+    assert [(l.fecha_str, l.acciones_restantes) for l in reanudado['colas_fifo']['BBB']] == [("2024/04/01", pytest.approx(5))]
+    # Sin operaciones nuevas se sirve el checkpoint tal cual
+    assert _comparables(calcular_cartera_incremental(libro, "u", almacen, serie_cambio=_serie_cambio)) == _comparables(completo)
+
+def test_isin_no_se_guarda_en_el_checkpoint(almacen):
+    libro = _libro()
+    sin_isin = calcular_cartera_incremental(libro, "u", almacen, 2023, resolver_isin=lambda t: None, serie_cambio=_serie_cambio)
+    assert {l['ISIN'] for l in sin_isin['reporte_fiscal_log'] if l['Tipo'] == "Ganancia/Pérdida"} == {""}
+    con_isin = calcular_cartera_incremental(libro, "u", almacen, 2023, resolver_isin=lambda t: f"ES000{t}", serie_cambio=_serie_cambio)
+    assert {l['ISIN'] for l in con_isin['reporte_fiscal_log'] if l['Tipo'] == "Ganancia/Pérdida"} == {"ES000AAA"}
+
+def test_sin_historico_de_divisa_no_se_guarda_checkpoint(almacen):
+    libro = _libro()
+    # Sin red: la compra en USD de 2024 se valora a 1.0 y ese tramo no se persiste
+    sin_fx = calcular_cartera_incremental(libro, "u", almacen, serie_cambio=lambda moneda: None)
+    assert sin_fx['cambios_sin_resolver'] == 1
+    assert [w.year for w, _, _ in almacen.listar("u", f"v{motor_fifo.VERSION_ESTADO}|libro")] == [2023]
+    con_fx = calcular_cartera_incremental(libro, "u", almacen, serie_cambio=_serie_cambio)
+    assert con_fx['cambios_sin_resolver'] == 0
+    assert con_fx['cartera']['BBB']['coste_total_eur'] == pytest.approx(450.0)
@@ -0,0 +1,31 @@
+import pandas as pd
+
+from test_motor_fifo import _libro, _serie_cambio
+from valoracion import curva_valor
+
+MONEDAS = {"AAA": "EUR", "BBB": "USD"}
+
+def _cierres():
+    return pd.DataFrame({"AAA": 10.0, "BBB": 100.0}, index=pd.bdate_range("2023-01-02", "2024-06-28"))
+
+def _valor(curva, fecha):
+    return curva.set_index('Fecha').at[pd.Timestamp(fecha), 'Valor']
+
+def test_venta_casi_total_cierra_la_posicion_como_el_motor():
+    curva = curva_valor(_libro(), _cierres(), MONEDAS, {"USD": _serie_cambio("USD")}, hasta=pd.Timestamp("2024-03-29"))
+    assert _valor(curva, "2024-02-29") == 500.0
+    # 49,599 de 50 acciones: el motor FIFO da la posición por cerrada y la curva no deja residuo
+    assert _valor(curva, "2024-03-01") == 0.0
+
+def test_sin_historico_de_divisa_los_dias_quedan_sin_valorar():
+    curva = curva_valor(_libro(), _cierres(), MONEDAS, {}, hasta=pd.Timestamp("2024-06-28"))
+    con_bbb = (curva['Fecha'] >= "2024-04-01").to_numpy()
+    assert curva['Sin_cambio'].to_numpy().tolist() == con_bbb.tolist()
+    assert curva.loc[con_bbb, 'Valor'].isna().all()
+
+def test_extender_la_curva_da_lo_mismo_que_calcularla_entera():
+    series = {"USD": _serie_cambio("USD")}
+    entera = curva_valor(_libro(), _cierres(), MONEDAS, series, hasta=pd.Timestamp("2024-06-28"))
+    for previa in (curva_valor(_libro(), _cierres(), MONEDAS, series, hasta=pd.Timestamp("2024-04-15")),
+                   curva_valor(_libro(), _cierres(), MONEDAS, {}, hasta=pd.Timestamp("2024-04-15"))):
+        pd.testing.assert_frame_equal(curva_valor(_libro(), _cierres(), MONEDAS, series, hasta=pd.Timestamp("2024-06-28"), previa=previa), entera)
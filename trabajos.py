@@ -0,0 +1,96 @@
+import pickle
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from almacen_local import conectar
+
+ARCHIVO_TRABAJOS = "trabajos.sqlite"
+MAX_TRABAJADORES = 4
+ESTADOS_ACTIVOS = ("pendiente", "ejecutando")
+
+class GestorTrabajos:
+    """Trabajos largos (importaciones, descargas de divisas, informes) fuera del hilo del script.
+
+    El estado vive en SQLite: sobrevive a reruns y recargas de página, y la barra lateral lo
+    consulta por id o por usuario. El resultado se guarda serializado al terminar.
+    """
+
+    def __init__(self, nombre=ARCHIVO_TRABAJOS, max_trabajadores=MAX_TRABAJADORES):
+        self.nombre = nombre
+        self._pool = ThreadPoolExecutor(max_workers=max_trabajadores, thread_name_prefix="trabajo")
+        self._lock = threading.Lock()
+        with conectar(self.nombre) as con:
+            con.execute("""CREATE TABLE IF NOT EXISTS trabajos (
+                id TEXT PRIMARY KEY, usuario TEXT, tipo TEXT, descripcion TEXT, estado TEXT,
+                hechas INTEGER, total INTEGER, mensaje TEXT, resultado BLOB, visto INTEGER DEFAULT 0,
+                creado REAL, actualizado REAL)""")
+            # Lo que estaba en marcha cuando se paró el proceso ya no terminará
+            con.execute("UPDATE trabajos SET estado='interrumpido', mensaje='Proceso reiniciado' WHERE estado IN (?, ?)", ESTADOS_ACTIVOS)
+
+    def _actualizar(self, id_trabajo, **campos):
+        campos['actualizado'] = time.time()
+        asignaciones = ", ".join(f"{k}=?" for k in campos)
+        with self._lock, conectar(self.nombre) as con:
+            con.execute(f"UPDATE trabajos SET {asignaciones} WHERE id=?", (*campos.values(), id_trabajo))
+
+    def enviar(self, usuario, tipo, descripcion, funcion, *args, **kwargs):
+        """Encola `funcion(*args, progreso=..., **kwargs)` y devuelve el id del trabajo.
+
+        `progreso(hechas, total, mensaje="")` actualiza el avance que consulta la barra lateral;
+        encaja con el `progreso(hechas, total)` de `importar_csv` y `crear_en_lotes`.
+        """
+        id_trabajo = uuid.uuid4().hex[:12]
+        ahora = time.time()
+        with self._lock, conectar(self.nombre) as con:
+            con.execute("INSERT INTO trabajos (id, usuario, tipo, descripcion, estado, hechas, total, mensaje, creado, actualizado) VALUES (?, ?, ?, ?, 'pendiente', 0, 0, '', ?, ?)",
+                        (id_trabajo, usuario, tipo, descripcion, ahora, ahora))
+
+        def progreso(hechas, total, mensaje=""):
+            self._actualizar(id_trabajo, hechas=int(hechas), total=int(total), mensaje=mensaje)
+
+        def ejecutar():
+            self._actualizar(id_trabajo, estado="ejecutando")
+            try:
+                resultado = funcion(*args, progreso=progreso, **kwargs)
+                self._actualizar(id_trabajo, estado="completado", resultado=pickle.dumps(resultado, protocol=pickle.HIGHEST_PROTOCOL))
+            except Exception as e:
+                self._actualizar(id_trabajo, estado="error", mensaje=f"{e}\n{traceback.format_exc(limit=3)}")
+
+        self._pool.submit(ejecutar)
+        return id_trabajo
+
+    def _fila_a_dict(self, fila, con_resultado):
+        claves = ('id', 'usuario', 'tipo', 'descripcion', 'estado', 'hechas', 'total', 'mensaje', 'resultado', 'visto', 'creado', 'actualizado')
+        t = dict(zip(claves, fila))
+        t['resultado'] = pickle.loads(t['resultado']) if con_resultado and t['resultado'] is not None else None
+        return t
+
+    def estado(self, id_trabajo, con_resultado=True):
+        with conectar(self.nombre) as con:
+            fila = con.execute("SELECT * FROM trabajos WHERE id=?", (id_trabajo,)).fetchone()
+        return self._fila_a_dict(fila, con_resultado) if fila else None
+
+    def trabajos_usuario(self, usuario, limite=10, solo_avisos=False):
+        """Últimos trabajos del usuario (sin el resultado, que puede ser grande).
+
+        Con `solo_avisos`, sólo los que siguen en marcha o han terminado sin que se hayan visto.
+        """
+        sql, args = "SELECT * FROM trabajos WHERE usuario=?", [usuario]
+        if solo_avisos: sql, args = sql + " AND (estado IN (?, ?) OR visto=0)", args + list(ESTADOS_ACTIVOS)
+        with conectar(self.nombre) as con:
+            filas = con.execute(sql + " ORDER BY creado DESC LIMIT ?", (*args, limite)).fetchall()
+        return [self._fila_a_dict(f, False) for f in filas]
+
+    def hay_activos(self, usuario):
+        with conectar(self.nombre) as con:
+            return con.execute("SELECT 1 FROM trabajos WHERE usuario=? AND estado IN (?, ?) LIMIT 1", (usuario, *ESTADOS_ACTIVOS)).fetchone() is not None
+
+    def marcar_visto(self, id_trabajo):
+        self._actualizar(id_trabajo, visto=1)
+
+    def purgar(self, antiguedad=7 * 24 * 3600):
+        with self._lock, conectar(self.nombre) as con:
+            con.execute("DELETE FROM trabajos WHERE actualizado < ? AND estado NOT IN (?, ?)", (time.time() - antiguedad, *ESTADOS_ACTIVOS))
@@ -0,0 +1,104 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+from sincronizacion_airtable import formula_campo
+
+TTL_USUARIOS = 300            # Segundos que vale el índice de usuarios antes de releer la tabla
+TTL_AUSENTES = 30             # Un usuario no encontrado no se vuelve a buscar en Airtable durante este tiempo
+ITERACIONES_PBKDF2 = 200_000
+PREFIJO_HASH = "pbkdf2_sha256"
+CAMPOS_USUARIO = ["Username", "Password", "Nombre", "Rol"]
+# ":" separa prefijo y nombre en las claves de vista; "__todos__" fue la clave de la vista admin
+NOMBRES_RESERVADOS = {"__todos__"}
+
+# --- CONTRASEÑAS ---
+def hash_password(password, sal=None, iteraciones=ITERACIONES_PBKDF2):
+    sal = sal or os.urandom(16).hex()
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), sal.encode('utf-8'), iteraciones).hex()
+    return f"{PREFIJO_HASH}${iteraciones}${sal}${digest}"
+
+def verificar_password(password, almacenado):
+    """(ok, hay_que_rehashear). Admite las contraseñas antiguas en claro para migrarlas al entrar."""
+    almacenado = str(almacenado or "")
+    if almacenado.startswith(PREFIJO_HASH + "$"):
+        try:
+            _, iteraciones, sal, _ = almacenado.split("$")
+            esperado = hash_password(password, sal, int(iteraciones))
+        except ValueError: return False, False
+        return hmac.compare_digest(esperado, almacenado), int(iteraciones) != ITERACIONES_PBKDF2
+    ok = hmac.compare_digest(password.encode('utf-8'), almacenado.encode('utf-8'))
+    return ok, ok
+
+# Para que un usuario inexistente tarde lo mismo que una contraseña errónea
+_HASH_SEÑUELO = hash_password("señuelo")
+
+# --- DIRECTORIO ---
+class DirectorioUsuarios:
+    """Índice username -> registro de la tabla de usuarios, con TTL e invalidación al registrar.
+
+    Los logins se resuelven contra el índice en memoria; sólo un fallo de índice hace una consulta
+    puntual por fórmula, y la tabla completa se relee como mucho una vez cada `ttl` segundos.
+    """
+
+    def __init__(self, table, ttl=TTL_USUARIOS):
+        self.table, self.ttl = table, ttl
+        self._indice, self._ausentes, self._cargado = {}, {}, -1e9
+        self._lock = threading.Lock()
+
+    def _indice_vigente(self):
+        with self._lock:
+            if time.monotonic() - self._cargado > self.ttl:
+                try: records = self.table.all(fields=CAMPOS_USUARIO)
+                except: records = self.table.all()
+                self._indice = {r['fields']['Username']: r for r in records if 'Username' in r['fields']}
+                self._ausentes, self._cargado = {}, time.monotonic()
+            return self._indice
+
+    def invalidar(self, username=None):
+        with self._lock:
+            if username is None: self._cargado = -1e9
+            else:
+                self._indice.pop(username, None)
+                self._ausentes.pop(username, None)
+
+    def buscar(self, username):
+        """Registro {'id', 'fields'} del usuario o None."""
+        indice = self._indice_vigente()
+        if username in indice: return indice[username]
+        if time.monotonic() - self._ausentes.get(username, -1e9) < TTL_AUSENTES: return None
+        registro = self.table.first(formula=formula_campo("Username", username))
+        with self._lock:
+            if registro: self._indice[username] = registro
+            else: self._ausentes[username] = time.monotonic()
+        return registro
+
+    def autenticar(self, username, password):
+        """Campos del usuario si la contraseña es correcta; None en otro caso."""
+        registro = self.buscar(username) if username else None
+        if registro is None:
+            verificar_password(password, _HASH_SEÑUELO)
+            return None
+        ok, rehashear = verificar_password(password, registro['fields'].get('Password'))
+        if not ok: return None
+        if rehashear:
+            try:
+                self.table.update(registro['id'], {"Password": hash_password(password)})
+                self.invalidar(username)
+            except: pass  # La migración se reintenta en el próximo login
+        return registro['fields']
+
+    def registrar(self, username, password, name):
+        if not username or username != username.strip() or ":" in username or username.lower() in NOMBRES_RESERVADOS:
+            return False, "Nombre de usuario no válido."
+        try:
+            self.invalidar(username)
+            if self.buscar(username): return False, "El usuario ya existe."
+            registro = self.table.create({"Username": username, "Password": hash_password(password), "Nombre": name, "Rol": "user"})
+            with self._lock:
+                self._indice[username] = registro
+                self._ausentes.pop(username, None)
+            return True, "Usuario creado correctamente."
+        except Exception as e: return False, f"Error creando usuario: {e}"
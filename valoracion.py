@@ -0,0 +1,136 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from motor_fifo import RESIDUO_ACCIONES, acciones_vendidas
+
+MONEDA_BASE = "EUR"
+MAX_CURVAS = 16             # Curvas de valor (una por versión del libro) que se conservan (LRU)
+REVISION_CURVA = 3600       # Segundos antes de volver a valorar la última sesión de una curva
+
+def _columna(ops, col, defecto):
+    return ops[col].to_numpy() if col in ops.columns else np.full(len(ops), defecto, dtype=object)
+
+def _variaciones(tickers, signo, acciones):
+    """Cambio real de la posición de cada operación, con las reglas del motor FIFO: una venta
+    del 98-102 % de la posición la cierra entera, nunca se vende más de lo que hay y los residuos
+    por debajo de RESIDUO_ACCIONES se dan por cerrados."""
+    posicion, variacion = {}, np.zeros(len(acciones))
+    for i, (tick, s, acc) in enumerate(zip(tickers, signo.tolist(), acciones.tolist())):
+        if s == 0: continue
+        previa = posicion.get(tick, 0.0)
+        nueva = previa + acc if s > 0 else previa - acciones_vendidas(acc, previa)
+        if s < 0 and nueva < RESIDUO_ACCIONES: nueva = 0.0
+        posicion[tick], variacion[i] = nueva, nueva - previa
+    return variacion
+
+def matriz_posiciones(ops, dias, tickers):
+    """Acciones en cartera al cierre de cada día (filas `dias`, columnas `tickers`).
+
+    Cada compra/venta (Cantidad es el importe: Cantidad / Precio, como en el motor FIFO) mueve la
+    posición lo mismo que en el motor, en su día o el siguiente de `dias` (las anteriores al primero
+    van a él); el acumulado por columnas da la posición. `ops` va en orden cronológico.
+    """
+    posiciones = np.zeros((len(dias), len(tickers)))
+    if ops.empty: return posiciones
+    tipos = _columna(ops, 'Tipo', '')
+    dinero = pd.to_numeric(ops['Cantidad'], errors='coerce').fillna(0.0).to_numpy(dtype=float)
+    precio = pd.to_numeric(ops['Precio'], errors='coerce').fillna(1.0).to_numpy(dtype=float) if 'Precio' in ops.columns else np.ones(len(ops))
+    acciones = np.round(dinero / np.where(precio <= 0, 1.0, precio), 8)
+    signo = np.where(tipos == "Compra", 1.0, np.where(tipos == "Venta", -1.0, 0.0))
+    ticks = ops['Ticker'].astype(str).str.strip()
+    variacion = _variaciones(ticks.tolist(), signo, acciones)
+    fila = dias.searchsorted(ops['Fecha_dt'].dt.normalize().to_numpy(), side='left')
+    col = pd.Index(tickers).get_indexer(ticks)
+    valida = (signo != 0) & (fila < len(dias)) & (col >= 0)
+    np.add.at(posiciones, (fila[valida], col[valida]), variacion[valida])
+    posiciones = np.cumsum(posiciones, axis=0)
+    posiciones[np.abs(posiciones) < 1e-9] = 0.0
+    return posiciones
+
+def _alinear(tabla, dias):
+    """Reindexa `tabla` a `dias` arrastrando el último valor conocido (fines de semana, festivos)."""
+    return tabla.reindex(tabla.index.union(dias)).ffill().reindex(dias)
+
+def _curva_vacia():
+    return pd.DataFrame({'Fecha': pd.DatetimeIndex([]), 'Valor': np.empty(0), 'Sin_cambio': np.empty(0, dtype=bool)})
+
+def curva_valor(ops, cierres, monedas, series_cambio, hasta=None, previa=None):
+    """Valor de mercado diario de la cartera en EUR: columnas Fecha, Valor y Sin_cambio.
+
+    `cierres`: fechas × tickers en la moneda de cotización, sin ajustar por dividendos (los
+    ajustados rebajan el pasado y el valor de la cartera saldría por debajo del real); `monedas`: {ticker: moneda};
+    `series_cambio`: {moneda: Series de EUR por unidad}. Si un ticker no tiene histórico se
+    valora al precio de su última operación. Los días con posición en una moneda sin histórico
+    de cambio no se valoran: Valor NaN y Sin_cambio True.
+    `previa`: curva de las mismas `ops` calculada antes; se conserva y sólo se valora desde su
+    última sesión (que pudo guardarse con la sesión abierta) o desde su primer día Sin_cambio.
+    """
+    if ops is None or ops.empty: return _curva_vacia()
+    ops = ops.sort_values('Fecha_dt', kind='mergesort')
+    tickers = sorted(set(ops['Ticker'].astype(str).str.strip()))
+    inicio = ops['Fecha_dt'].min().normalize()
+    if previa is not None and not previa.empty:
+        inicio = previa['Fecha'].iloc[-1]
+        pendientes = previa['Fecha'][previa['Sin_cambio'].to_numpy()]
+        if not pendientes.empty: inicio = min(inicio, pendientes.iloc[0])
+        previa = previa[previa['Fecha'] < inicio]
+    dias = pd.bdate_range(inicio, hasta or pd.Timestamp.now().normalize())
+    posiciones = matriz_posiciones(ops, dias, tickers)
+
+    # Precios: histórico local y, donde falte, el precio de la última operación del libro
+    libro = ops.assign(Dia=ops['Fecha_dt'].dt.normalize(), T=ops['Ticker'].astype(str).str.strip())
+    anteriores = libro['Dia'] < dias[0] if len(dias) else libro['Dia'].isna()
+    libro = pd.concat([libro[anteriores].drop_duplicates('T', keep='last'), libro[~anteriores]])
+    precios_libro = libro.pivot_table(index='Dia', columns='T', values='Precio', aggfunc='last')
+    precios = _alinear(cierres.reindex(columns=tickers), dias) if not cierres.empty else pd.DataFrame(index=dias, columns=tickers, dtype=float)
+    precios = precios.fillna(_alinear(precios_libro.reindex(columns=tickers), dias)).to_numpy(dtype=float)
+
+    # Cambio a EUR por columna: una serie por moneda, repartida a sus tickers (NaN si no hay serie)
+    lista_monedas = sorted({monedas.get(t, MONEDA_BASE) for t in tickers})
+    cambios_moneda = np.ones((len(dias), len(lista_monedas)))
+    for j, moneda in enumerate(lista_monedas):
+        if moneda == MONEDA_BASE: continue
+        serie = series_cambio.get(moneda)
+        if serie is None or serie.empty: cambios_moneda[:, j] = np.nan
+        else: cambios_moneda[:, j] = _alinear(serie.to_frame(), dias).iloc[:, 0].bfill().to_numpy()
+    cambios = cambios_moneda[:, [lista_monedas.index(monedas.get(t, MONEDA_BASE)) for t in tickers]]
+
+    sin_cambio = ((posiciones != 0) & np.isnan(cambios)).any(axis=1)
+    valor = np.where(sin_cambio, np.nan, np.nansum(posiciones * precios * np.nan_to_num(cambios, nan=0.0), axis=1))
+    nueva = pd.DataFrame({'Fecha': dias, 'Valor': valor, 'Sin_cambio': sin_cambio})
+    return nueva if previa is None or previa.empty else pd.concat([previa, nueva], ignore_index=True)
+
+# --- CURVAS YA CALCULADAS ---
+class CurvasValor:
+    """Curvas de valor por clave del libro (vista, versión), extendidas en vez de recalculadas.
+
+    Pasado REVISION_CURVA (o al cambiar de día) sólo se valoran las sesiones nuevas y la última
+    guardada; la curva entera se calcula una vez por versión del libro.
+    """
+
+    def __init__(self, max_entradas=MAX_CURVAS, revision=REVISION_CURVA):
+        self.max_entradas, self.revision = max_entradas, revision
+        self._curvas = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obtener(self, clave, calcular):
+        """Curva de `clave`; `calcular(previa)` la calcula reutilizando la anterior (o None)."""
+        with self._lock:
+            entrada = self._curvas.get(clave)
+            if entrada is not None:
+                self._curvas.move_to_end(clave)
+                if time.monotonic() - entrada[0] < self.revision: return entrada[1]
+        curva = calcular(entrada[1] if entrada is not None else None)
+        with self._lock:
+            self._curvas[clave] = (time.monotonic(), curva)
+            self._curvas.move_to_end(clave)
+            while len(self._curvas) > self.max_entradas: self._curvas.popitem(last=False)
+        return curva
+
+    def invalidar(self):
+        """Descarta todas las curvas (p. ej. al llegar divisas nuevas)."""
+        with self._lock: self._curvas.clear()